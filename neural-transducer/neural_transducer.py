@@ -11,6 +11,12 @@ import time
 import bz2
 from scipy import spatial
 import math
+import threading
+import Queue
+import collections
+import subprocess
+import neural_transducer_metrics as metrics
+import neural_transducer_tracing as tracing
 
 # Implementation of the "A Neural Transducer" paper, Navdeep Jaitly et. al (2015): https://arxiv.org/abs/1511.04868
 
@@ -25,9 +31,14 @@ class ConstantsManager(object):
                  transducer_hidden_units, vocab_ids, input_block_size, beam_width, encoder_hidden_layers,
                  transducer_max_width, path_to_model, path_to_inputs, path_to_targets, path_to_alignments,
                  path_to_cons_manager, amount_of_aligners, device_to_run, device_soft_placement,
-                 debug_devices, max_cores):
+                 debug_devices, max_cores, checkpoints_to_keep=5, path_to_metrics=None, path_to_traces=None,
+                 trace_every_n=100, core_plan=None, max_aligners=None, aligner_adapt_interval=30,
+                 alignment_stream_interval=10, alignment_cache_size=0, alignment_max_age=50, cell_backend='lstm',
+                 training_window_blocks=0, swap_memory=False, alignment_beam_width=0,
+                 alignment_beam_threshold=None, alignment_band=0, alignment_band_max_widenings=3):
         assert transducer_hidden_units == 2 * encoder_hidden_units, 'Transducer has to have 2 times the amount ' \
                                                                     'of the encoder of units'
+        assert cell_backend in ['lstm', 'lstm_block', 'lstm_block_fused'], 'Unknown cell backend: ' + str(cell_backend)
         # Vocab vars
         self.vocab_ids = vocab_ids
         self.E_SYMBOL = len(self.vocab_ids)
@@ -48,6 +59,29 @@ class ConstantsManager(object):
         self.log_prob_init_value = 0
         self.encoder_hidden_layers = encoder_hidden_layers
         self.transducer_max_width = transducer_max_width
+        # LSTM implementation: 'lstm' (LSTMCell), 'lstm_block' (LSTMBlockCell, fused per time step) or
+        # 'lstm_block_fused' (LSTMBlockFusedCell for each encoder layer over all time steps, LSTMBlockCell for the
+        # transducer). All use the same variables, checkpoints load with any of them.
+        self.cell_backend = cell_backend
+        # Truncated training: sequences are trained in windows of this many blocks, the states are carried from one
+        # window to the next and every window is an update of its own. Bounds the memory of a training step for any
+        # input length. 0 trains on all blocks at once.
+        self.training_window_blocks = training_window_blocks
+        # Swap the activations kept for the backward pass of the encoder RNNs, the transducer decoders & the block loop
+        # from the GPU to host memory (slower, allows larger batches). The fused encoder (lstm_block_fused) keeps its
+        # activations on the GPU.
+        self.swap_memory = swap_memory
+        # Pruning of the alignment search (get_alignment): after every block only the alignment_beam_width most likely
+        # hypotheses are expanded further, and only those within alignment_beam_threshold (log prob) of the best one.
+        # 0 / None keep every hypothesis (exhaustive search), a width of 1 is the greedy search.
+        self.alignment_beam_width = alignment_beam_width
+        self.alignment_beam_threshold = alignment_beam_threshold
+        # Banded realignment: in each block only end positions within alignment_band targets of the sequence's previous
+        # alignment are searched (of its approximate one from the input frames if there is none), 0 searches all.
+        # When the best alignment ends a block on the edge of the band, the block is searched again with the band
+        # doubled, after alignment_band_max_widenings times without a band.
+        self.alignment_band = alignment_band
+        self.alignment_band_max_widenings = alignment_band_max_widenings
         # Path vars
         self.path_to_model = path_to_model
         self.path_to_inputs = path_to_inputs
@@ -60,12 +94,38 @@ class ConstantsManager(object):
         self.device_soft_placement = device_soft_placement
         self.debug_devices = debug_devices
         self.max_cores = max_cores
+        # Upper bound of the aligner pool, which then starts with amount_of_aligners & is resized every
+        # aligner_adapt_interval seconds by measured throughput. None keeps the pool fixed.
+        self.max_aligners = max_aligners
+        self.aligner_adapt_interval = aligner_adapt_interval
+        # Seconds between the parts a background realignment streams to the trainer
+        self.alignment_stream_interval = alignment_stream_interval
+        # Online alignments are reused for up to alignment_max_age training steps, for at most alignment_cache_size
+        # sequences (least recently used ones are evicted). 0 computes a new alignment for every sample.
+        self.alignment_cache_size = alignment_cache_size
+        self.alignment_max_age = alignment_max_age
+        # Checkpointing
+        self.checkpoints_to_keep = checkpoints_to_keep
+        # Metrics file of the training process, aligner processes write next to it (see neural_transducer_metrics.py)
+        self.path_to_metrics = path_to_metrics
+        # Op level traces of every n-th session run (see neural_transducer_tracing.py)
+        self.path_to_traces = path_to_traces
+        self.trace_every_n = trace_every_n
+        # Cores of the trainer & the aligners (see neural_transducer_resources.py), None to use max_cores everywhere
+        self.core_plan = core_plan
         # Research correlation
         self.alc_correlation_data = []
 
 
 # ---------------- Helper classes -------------------------------
 
+def get_alignment_part_path(path_to_alignments, index):
+    """
+    :return: Path of the index-th part a background realignment streams, e.g. alignments -> alignments.part3
+    """
+    return path_to_alignments + '.part' + str(index)
+
+
 class Alignment(object):
     def __init__(self, cons_manager):
         self.alignment_position = (0, 1)  # x = position in target (y~), y = block index, both start at 1
@@ -73,6 +133,7 @@ class Alignment(object):
         self.alignment_locations = []  # At which indices in the target output we need to insert <e>
         self.last_state_transducer = np.zeros(shape=(2, 1, cons_manager.transducer_hidden_units))  # Transducer state
         self.cons_manager = cons_manager
+        self.band_edge_block = None  # Last block that ended on the edge of the band of a banded search
 
     def __compute_sum_probabilities(self, transducer_outputs, targets, transducer_amount_outputs):
         def get_prob_at_timestep(timestep):
@@ -116,11 +177,142 @@ class Alignment(object):
         self.last_state_transducer = new_transducer_state
 
 
+def prune_alignments(alignments, beam_width, beam_threshold):
+    """
+    Prunes the hypotheses of the alignment search after a block.
+    :param alignments: List of Alignment objects.
+    :param beam_width: Amount of hypotheses to keep, the ones with the highest log prob. 0 or None keeps all.
+    :param beam_threshold: Keep only hypotheses with a log prob of at least the best one minus this. None keeps all.
+    :return: The kept alignments, most likely first.
+    """
+    if not beam_width and beam_threshold is None:
+        return alignments
+    # Stable sort, hypotheses with the same log prob keep their order
+    kept = sorted(alignments, key=lambda a: -a.log_prob)
+    if beam_threshold is not None:
+        kept = [a for a in kept if a.log_prob >= kept[0].log_prob - beam_threshold]
+    if beam_width:
+        kept = kept[0:beam_width]
+    metrics.increment('alignment_hypotheses_pruned', len(alignments) - len(kept))
+    return kept
+
+
+def run_alignment_blocks(run_new_block, total_blocks, initial_alignments, initial_encoder_state, band, max_widenings):
+    """
+    Runs the blocks of an alignment search. If the best alignment after a block ended it on the edge of the band, that
+    block is searched again with the band doubled (the blocks before are kept), after max_widenings times without a
+    band.
+    :param run_new_block: Function (previous_alignments, block_index, band, last_encoder_state) -> (new_alignments,
+    last_encoder_state_new), runs one block.
+    :param total_blocks: The amount of blocks to align.
+    :param initial_alignments: The alignments before the first block.
+    :param initial_encoder_state: The encoder state before the first block.
+    :param band: The band of the search, 0 for none.
+    :param max_widenings: Amount of times the band of a block is widened before it is dropped.
+    :return: The alignments after the last block, most likely first.
+    """
+    current_alignments, last_encoder_state = initial_alignments, initial_encoder_state
+    for block in range(1, total_blocks + 1):
+        block_band = band
+        widenings = 0
+        while True:
+            new_alignments, new_encoder_state = run_new_block(current_alignments, block, block_band, last_encoder_state)
+            if block_band == 0 or new_alignments[0].band_edge_block != block:
+                break
+            # The band cut off the best alignment, search the block again with a wider one
+            widenings += 1
+            block_band = block_band * 2 if widenings < max_widenings else 0
+            metrics.increment('alignment_band_widenings')
+        current_alignments, last_encoder_state = new_alignments, new_encoder_state
+    return current_alignments
+
+
 def softmax(x, axis=None):
     e_x = np.exp(x - np.max(x, axis=axis, keepdims=True))
     return e_x / np.sum(e_x, axis=axis, keepdims=True)
 
 
+def get_input_lengths(inputs, inputs_embedded=True):
+    """
+    Lengths of zero padded inputs, i.e. the frames up to the last non zero frame of each sequence.
+    :param inputs: Inputs of shape [max_time, batch_size, input_dimensions] (Time major)
+    :param inputs_embedded: False for inputs of ids, 0 is an id there, so they are taken as not padded.
+    :return: Lengths of shape [batch_size], at least 1.
+    """
+    if inputs_embedded is False:
+        return np.ones(shape=inputs.shape[1], dtype=np.int32) * inputs.shape[0]
+    frames = np.any(np.reshape(inputs, newshape=(inputs.shape[0], inputs.shape[1], -1)) != 0, axis=2)
+    lengths = inputs.shape[0] - np.argmax(frames[::-1], axis=0)
+    lengths[np.logical_not(np.any(frames, axis=0))] = 1
+    return lengths.astype(np.int32)
+
+
+def get_input_blocks(input_length, input_block_size):
+    """
+    :return: Amount of blocks covering input_length frames.
+    """
+    return int(np.ceil(float(input_length) / input_block_size))
+
+
+def get_bootstrap_alignments(inputs, target_lengths, input_block_size, transducer_max_width, correlation_param=1.0,
+                             chunk_size=1000):
+    """
+    Approximate alignments without running the network: blocks where the input frames change more than the average of
+    their sequence get proportionally more targets. Vectorized over the corpus, so a whole dataset takes seconds.
+    :param inputs: Inputs of shape [max_time, amount, input_dimensions] (Time major)
+    :param target_lengths: Length of each target sequence.
+    :param input_block_size: Frames per block.
+    :param transducer_max_width: Max targets per block.
+    :param correlation_param: How strongly the frame change steers the targets, 0 spreads them evenly.
+    :param chunk_size: Sequences processed at once, bounds the memory needed.
+    :return: List of alignments (Alignment.alignment_locations format), one per sequence.
+    """
+    max_time, amount, input_dimensions = inputs.shape
+    amount_of_blocks = int(np.ceil(max_time / float(input_block_size)))
+    alignments = []
+
+    for start in range(0, amount, chunk_size):
+        frames = np.zeros(shape=(amount_of_blocks * input_block_size, min(chunk_size, amount - start),
+                                 input_dimensions), dtype=np.float64)
+        frames[0:max_time] = inputs[:, start:start + chunk_size, :]
+        frames = np.reshape(frames, newshape=(amount_of_blocks, input_block_size, -1, input_dimensions))
+        lengths = np.asarray(target_lengths[start:start + chunk_size], dtype=np.float64)
+
+        # Cosine distance of consecutive frames within each block, 0 for empty (padding) frames
+        norms = np.linalg.norm(frames, axis=3)
+        dots = np.sum(frames[:, :-1] * frames[:, 1:], axis=3)
+        norm_products = norms[:, :-1] * norms[:, 1:]
+        distances = np.where(norm_products > 0, 1 - dots / np.maximum(norm_products, 1e-12), 0)
+        if input_block_size > 1:
+            activity = np.mean(np.abs(distances), axis=1)  # [blocks, sequences]
+        else:
+            activity = np.zeros(shape=(amount_of_blocks, frames.shape[2]))
+
+        # Share of the targets for each block, the blocks after the end of the inputs get none
+        input_blocks = np.ceil(get_input_lengths(inputs[:, start:start + chunk_size, :]) / float(input_block_size))
+        valid_blocks = np.arange(amount_of_blocks)[:, np.newaxis] < input_blocks[np.newaxis, :]
+        mean_activity = np.sum(activity * valid_blocks, axis=0) / np.maximum(np.sum(valid_blocks, axis=0), 1)
+        weights = np.maximum(1 + correlation_param * (activity - mean_activity), 0) * valid_blocks
+        weights = np.where(np.sum(weights, axis=0) > 0, weights, valid_blocks)
+        shares = weights / np.sum(weights, axis=0)
+
+        # Rounding the cumulative lengths keeps the total exact
+        locations = np.round(np.cumsum(shares, axis=0) * lengths).astype(np.int64)
+        counts = np.diff(np.concatenate([np.zeros(shape=(1, len(lengths)), dtype=np.int64), locations]), axis=0)
+
+        # Move what exceeds the max width to the next blocks, what's left at the end to the previous ones
+        carry = np.zeros(shape=len(lengths), dtype=np.int64)
+        for block_indices in [range(amount_of_blocks), reversed(range(amount_of_blocks))]:
+            for block in block_indices:
+                total = counts[block] + carry
+                counts[block] = np.minimum(total, transducer_max_width)
+                carry = total - counts[block]
+        counts[-1] += carry  # Only if the targets don't fit at all
+
+        alignments += np.cumsum(counts, axis=0).T.tolist()
+    return alignments
+
+
 def print_rel_distance(inputs):
     np.set_printoptions(edgeitems=10, precision=3, suppress=True, linewidth=300)
     print 'Cosine Distance: '
@@ -129,16 +321,120 @@ def print_rel_distance(inputs):
             inputs[i])
 
 
+class AsyncCheckpointWriter(object):
+
+    def __init__(self, variables, keep_last):
+        """
+        Writes checkpoints in a background thread, so that training does not wait on the disk. The training session
+        only copies the variable values to host memory, the writing is done from a separate graph & session.
+        The (forward) meta graph of the model is written once, each checkpoint gets a link to it, so that the
+        checkpoints can be loaded as usual (e.g. Model.load_model, InferenceManager.build_greedy_inference).
+        :param variables: List of variables to save.
+        :param keep_last: Amount of checkpoints to keep, older ones are deleted.
+        """
+        self.variables = variables
+        self.keep_last = keep_last
+        self.meta_graph_path = None
+        self.snapshots = Queue.Queue(maxsize=1)  # At most one snapshot waits while another one is written
+        self.thread = threading.Thread(target=self.__write_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def save(self, session, path_name, meta_graph_def):
+        """
+        Snapshots the variables and queues them for writing. Only blocks if the previous snapshot is still waiting.
+        :param session: The training session.
+        :param path_name: Path & prefix of the checkpoint.
+        :param meta_graph_def: The meta graph of the model, written once.
+        :return:
+        """
+        if self.meta_graph_path is None:
+            self.meta_graph_path = os.path.join(os.path.dirname(os.path.abspath(path_name)), 'graph.meta')
+            with tf.gfile.GFile(self.meta_graph_path, 'wb') as f:
+                f.write(meta_graph_def.SerializeToString())
+        values = session.run(self.variables)
+        with metrics.timer('checkpoint_queue_wait'):
+            self.snapshots.put((path_name, values))
+
+    def wait(self):
+        self.snapshots.join()
+
+    def __write_loop(self):
+        # Shadow variables of the same names, shapes & types, so that the checkpoints are identical to the model's
+        graph = tf.Graph()
+        with graph.as_default():
+            shadow_variables = [tf.Variable(tf.zeros(var.get_shape(), dtype=var.dtype.base_dtype), trainable=False)
+                                for var in self.variables]
+            saver = tf.train.Saver(var_list=dict(zip([var.op.name for var in self.variables], shadow_variables)),
+                                   max_to_keep=self.keep_last)
+        config = tf.ConfigProto(device_count={'GPU': 0}, inter_op_parallelism_threads=1,
+                                intra_op_parallelism_threads=1)
+
+        with tf.Session(graph=graph, config=config) as sess:
+            while True:
+                (path_name, values) = self.snapshots.get()
+                try:
+                    for var, value in zip(shadow_variables, values):
+                        var.load(value, sess)
+                    saver.save(sess, path_name, write_meta_graph=False)
+                    # Old links get deleted by the saver together with their checkpoint
+                    meta_link = path_name + '.meta'
+                    if os.path.lexists(meta_link):
+                        os.remove(meta_link)
+                    os.symlink(os.path.relpath(self.meta_graph_path, os.path.dirname(os.path.abspath(path_name))),
+                               meta_link)
+                    print 'Model saved to ' + str(path_name)
+                except Exception as e:
+                    print 'ERROR writing checkpoint ' + str(path_name) + ': ' + str(e)
+                self.snapshots.task_done()
+
+
+class AlignmentCache(object):
+
+    def __init__(self, max_size, max_age):
+        """
+        Least recently used cache for online alignments. An alignment computed at some training step is reused until
+        it is older than max_age steps, then it is computed again with the current weights.
+        :param max_size: Max amount of sequences cached, the least recently used one is evicted first.
+        :param max_age: Max age of a reused alignment in training steps.
+        """
+        self.max_size = max_size
+        self.max_age = max_age
+        self.entries = collections.OrderedDict()  # key = inputs.tostring, value = (alignment, training step)
+
+    def get(self, key, step):
+        """
+        :return: The cached alignment, or None if there is none or it is too old.
+        """
+        entry = self.entries.pop(key, None)
+        if entry is None or step - entry[1] > self.max_age:
+            metrics.increment('alignment_cache_misses')
+            return None
+        self.entries[key] = entry  # Now the most recently used
+        metrics.increment('alignment_cache_hits')
+        return entry[0]
+
+    def put(self, key, alignment, step):
+        self.entries.pop(key, None)
+        self.entries[key] = (alignment, step)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            metrics.increment('alignment_cache_evictions')
+
+
 class DataManager(object):
 
     def __init__(self, cons_manager, full_inputs, full_targets, model, session, online_alignments, use_greedy=False,
-                 inference=False):
+                 inference=False, save_data=True):
         """
         Loads the data manager
         :param cons_manager:
         :param full_inputs: Of shape [max_input_time, amount, ...] (Time major)
         :param full_targets: Of shape [amount, max_output_time, ...] (Batch major)
         :param model: The model object
+        :param save_data: With offline alignments, save the inputs, targets, model & constants manager for the aligner
+        processes (to the paths of the constants manager). False if they only load existing alignments (e.g. several
+        data managers on shards of the same data).
         """
         assert full_inputs.shape[1] == len(full_targets), 'Input batch size not equal to target batch size!'
 
@@ -151,9 +447,16 @@ class DataManager(object):
         self.online_alignments = online_alignments
         self.use_greedy = use_greedy
         self.inference = inference
+        self.realignment = None  # Process of the running background realignment
+        self.realignment_part = 0  # Next part to load from it
+        self.realignment_check_time = 0
+        self.training_steps = 0  # Counted by the training step, ages the cached online alignments
+        self.alignment_cache = None
+        if cons_manager.alignment_cache_size > 0:
+            self.alignment_cache = AlignmentCache(cons_manager.alignment_cache_size, cons_manager.alignment_max_age)
 
         # Save inputs, targets, model & cons_manager
-        if online_alignments is False:
+        if online_alignments is False and save_data is True:
             np.save(self.cons_manager.path_to_inputs, self.inputs)
             np.save(self.cons_manager.path_to_targets, np.asarray(self.targets))
             model.save_model_for_inference(session, path_name=self.cons_manager.path_to_model)
@@ -167,82 +470,128 @@ class DataManager(object):
                                                                       self.targets[sample_id],
                                                                       None)
 
-    def run_new_alignments(self):
+    def run_new_alignments(self, background=False):
+        """
+        Realigns all sequences with the current weights.
+        :param background: False blocks until all alignments are done. True returns right away, the aligners work
+        against a snapshot of the current weights while training continues and update_alignments() loads their results
+        as they complete.
+        :return: False if a background realignment is still running (no new one is started), otherwise True.
+        """
+        if self.realignment is not None:
+            return False
+
         print 'Loading in new alignments'
         # Save model and run new alignments
         self.model.save_model_for_inference(self.session, path_name=self.cons_manager.path_to_model)
-        os.system('python ./neural_transducer_helpers.py ' + str(self.cons_manager.path_to_cons_manager))
-
-        # Waits until new alignments are there, so the alignments file has changed
-        # TODO: something more elegant, maybe with parallel processing whilst training is running
+        # The aligner manager watches the utilization of this process when resizing its pool
+        command = ['python', './neural_transducer_helpers.py', str(self.cons_manager.path_to_cons_manager),
+                   str(os.getpid())]
+
+        if background is True:
+            # Parts of an earlier realignment are outdated
+            index = 0
+            while os.path.isfile(get_alignment_part_path(self.cons_manager.path_to_alignments, index)):
+                os.remove(get_alignment_part_path(self.cons_manager.path_to_alignments, index))
+                index += 1
+            self.realignment_part = 0
+            self.realignment = subprocess.Popen(command + [str(self.cons_manager.alignment_stream_interval)])
+            return True
+
+        subprocess.call(command)
 
         # Load in new alignments
         self.load_in_alignments()
+        return True
+
+    def update_alignments(self):
+        """
+        Loads the alignments a background realignment has completed since the last call (at most once a second, so
+        it can be called every training step). Each sequence keeps its latest alignment.
+        :return: True while the background realignment is running.
+        """
+        if self.realignment is None or time.time() - self.realignment_check_time < 1:
+            return self.realignment is not None
+        self.realignment_check_time = time.time()
+
+        # Parts are complete once they exist, all parts exist once the process is done
+        done = self.realignment.poll() is not None
+        path = get_alignment_part_path(self.cons_manager.path_to_alignments, self.realignment_part)
+        while os.path.isfile(path):
+            with bz2.BZ2File(path, 'r') as part_file:
+                new_alignments = cPickle.load(part_file)
+            self.apply_alignments(new_alignments)
+            os.remove(path)
+            metrics.increment('alignments_streamed', len(new_alignments))
+            self.realignment_part += 1
+            path = get_alignment_part_path(self.cons_manager.path_to_alignments, self.realignment_part)
+
+        if done is True:
+            print 'Background realignment done, parts loaded: ' + str(self.realignment_part)
+            self.realignment = None
+        return self.realignment is not None
 
     def load_in_alignments(self):
         with bz2.BZ2File(self.cons_manager.path_to_alignments, 'r') as new_al_file:
             new_alignments = cPickle.load(new_al_file)
-
-        # Apply new alignments to internal dictionary
-        for input_key in new_alignments:
-            self.data_dic[input_key] = (self.data_dic[input_key][0], self.data_dic[input_key][1], new_alignments[input_key])
+        self.apply_alignments(new_alignments)
         print 'New alignments loaded'
 
-    def get_new_sample(self, inputs):
-
-        def get_feed_dic(batch_size):
-            def get_random_numbers():
-                a = np.random.randint(100, 499)  # That way any 2 sequences are always the same length
-                b = np.random.randint(100, 499)
-                c = a + b
-
-                c *= 100  # TODO: 10 slightly works for alignment
-                # TODO: Check on teacher forcing
-
-                inputs = [int(d) for d in str(a)]
-                inputs.append(10)  # Space
-                inputs += list(reversed([int(d) for d in str(b)]))
-                targets = list(reversed([int(d) for d in str(c)]))
-                return inputs, targets
-
-            inputs = []
-            targets = []
-
-            for i in range(batch_size):
-                temp_inputs, temp_targets = get_random_numbers()
-                inputs.append(temp_inputs)
-                targets.append(temp_targets)
-
-            inputs = np.asarray(inputs)
-            inputs = np.transpose(inputs, axes=[1, 0])
-            inputs = np.reshape(inputs, newshape=(-1, batch_size, 1))
+    def apply_alignments(self, new_alignments):
+        # Apply new alignments to internal dictionary, the alignments can cover more sequences than this data manager
+        # holds (e.g. a shard in data parallel training)
+        for input_key in new_alignments:
+            if input_key in self.data_dic:
+                self.data_dic[input_key] = (self.data_dic[input_key][0], self.data_dic[input_key][1], new_alignments[input_key])
 
-            return inputs, targets
+    def bootstrap_alignments(self, correlation_param=1.0):
+        """
+        Gives every sequence an approximate alignment from its input frames (see get_bootstrap_alignments), e.g. to
+        start training right away while the model based alignments run in the background.
+        :param correlation_param: How strongly the frame change steers the targets, 0 spreads them evenly.
+        """
+        init_time = time.time()
+        alignments = get_bootstrap_alignments(self.inputs, [len(target) for target in self.targets],
+                                              self.cons_manager.input_block_size,
+                                              self.cons_manager.transducer_max_width, correlation_param)
+        self.apply_alignments(dict([(self.inputs[:, i, :].tostring(), alignments[i])
+                                    for i in range(len(alignments))]))
+        print 'Bootstrap alignments: ' + str(len(alignments)) + ' / Time: ' + str(time.time() - init_time)
+
+    def get_alignment(self, inputs, targets, prior_alignment=None):
+        """
+        Aligns one sequence with the live session.
+        :param prior_alignment: Earlier alignment of the sequence, for the banded search (cons_manager.alignment_band).
+        """
+        if self.use_greedy is True:
+            return self.model.get_alignment_greedy(session=self.session, inputs=inputs, targets=targets,
+                                                   input_block_size=self.cons_manager.input_block_size,
+                                                   transducer_max_width=self.cons_manager.transducer_max_width)
+        return self.model.get_alignment(session=self.session, inputs=inputs, targets=targets,
+                                        input_block_size=self.cons_manager.input_block_size,
+                                        transducer_max_width=self.cons_manager.transducer_max_width,
+                                        prior_alignment=prior_alignment)
 
+    def get_new_sample(self, inputs):
         if self.inference is False:
             if self.online_alignments is True:
-                #try:
-                #(inp, targ, _) = self.data_dic[inputs]
-                # TODO: Put testing away
-                inp, targ = get_feed_dic(1)
-                targ = targ[0]
-
-                if self.use_greedy is True:
-                    al = self.model.get_alignment_greedy(session=self.session, inputs=inp, targets=targ,
-                                                         input_block_size=self.cons_manager.input_block_size,
-                                                         transducer_max_width=self.cons_manager.transducer_max_width)
-                else:
-                    al = self.model.get_alignment(session=self.session, inputs=inp, targets=targ,
-                                                  input_block_size=self.cons_manager.input_block_size,
-                                                  transducer_max_width=self.cons_manager.transducer_max_width)
-                #except Exception as e:
-                #    print 'ERROR HERE: ' + str(e)
-                #    (inp, targ, al) = self.get_new_random_sample()
+                (inp, targ, prior_al) = self.data_dic[inputs]
+                al = None
+                if self.alignment_cache is not None:
+                    al = self.alignment_cache.get(inputs, self.training_steps)
+                if al is None:
+                    al = self.get_alignment(inp, targ, prior_al)
+                    if self.alignment_cache is not None:
+                        self.alignment_cache.put(inputs, al, self.training_steps)
+                    if self.cons_manager.alignment_band > 0:
+                        # The next banded search starts from this one
+                        self.data_dic[inputs] = (inp, targ, al)
             else:
-                # Skip None alignments
                 (inp, targ, al) = self.data_dic[inputs]
                 if al is None:
-                    (inp, targ, al) = self.get_new_random_sample()  # This could go bad
+                    # Not aligned yet (e.g. a background realignment hasn't reached it), align it now
+                    al = self.get_alignment(inp, targ)
+                    self.data_dic[inputs] = (inp, targ, al)
         else:
             (inp, targ, al) = self.data_dic[inputs]
         return inp, targ, al
@@ -267,21 +616,103 @@ class DataManager(object):
 
 # ----------------- Model ---------------------------------------
 
+# Interface of the forward (inference) graph, in the order it is bound by the inference manager. Frozen exports keep
+# these names, so they form the stable signature of an exported graph.
+INFERENCE_INPUT_NAMES = ['transducer_training/max_blocks:0',
+                         'transducer_training/inputs_full_raw:0',
+                         'transducer_training/transducer_list_outputs:0',
+                         'transducer_training/transducer_start_block:0',
+                         'transducer_training/encoder_hidden_init_fw:0',
+                         'transducer_training/encoder_hidden_init_bw:0',
+                         'transducer_training/trans_hidden_init:0',
+                         'transducer_training/teacher_forcing_targets:0',
+                         'transducer_training/inference_mode:0']
+# Optional input, missing in graphs exported before it existed
+INFERENCE_LENGTHS_NAME = 'transducer_training/inputs_lengths:0'
+INFERENCE_OUTPUT_NAMES = ['transducer_training/logits:0',
+                          'transducer_training/encoder_hidden_state_new_fw:0',
+                          'transducer_training/encoder_hidden_state_new_bw:0',
+                          'transducer_training/transducer_hidden_state_new:0']
+
+
+def freeze_inference_graph(session, path_name):
+    """
+    Writes a frozen, inference-only GraphDef. The graph is pruned to the inference outputs (no optimizer slots, training
+    ops or py_func) and all variables are folded into constants, so loading needs no checkpoint restore.
+    :param session: The session holding the trained variables.
+    :param path_name: File to write the frozen GraphDef to (e.g. model.pb).
+    :return:
+    """
+    graph_def = session.graph.as_graph_def()
+    for node in graph_def.node:
+        node.device = ''  # Let the loading process decide on placement
+    output_node_names = [name.split(':')[0] for name in INFERENCE_OUTPUT_NAMES]
+    frozen_graph_def = tf.graph_util.convert_variables_to_constants(session, graph_def, output_node_names)
+    with tf.gfile.GFile(path_name, 'wb') as f:
+        f.write(frozen_graph_def.SerializeToString())
+    print 'Frozen inference graph saved to ' + str(path_name) + ' (' + str(len(frozen_graph_def.node)) + ' nodes)'
+
+
 class Model(object):
 
-    def __init__(self, cons_manager):
+    def __init__(self, cons_manager, sync_replicas=None, objective='alignment'):
+        """
+        Builds the transducer and the training step of the objective.
+        :param cons_manager: The constants manager.
+        :param sync_replicas: For data parallel training (see nt_rimes_parallel.py): the amount of workers, the
+        gradients of the training step are averaged over all of them before being applied.
+        :param objective: Training step to build: 'alignment' (apply_training_step), 'direct_logits'
+        (apply_training_step_direct_logits) or None for only the forward graph (inference & alignment). Another
+        objective is built on its first use (see build_objective).
+        """
+        assert objective in [None, 'alignment', 'direct_logits'], 'Unknown objective: ' + str(objective)
 
         self.var_list = []
         self.cons_manager = cons_manager
+        self.sync_replicas = sync_replicas
+        self.sync_optimizer = None
+        self.global_step = None
+        self.targets = self.train_op = self.loss = None
+        self.direct_targets = self.direct_train_op = self.direct_loss = None
 
-        self.max_blocks, self.inputs_full_raw, self.transducer_list_outputs, self.start_block, \
+        self.max_blocks, self.inputs_full_raw, self.inputs_lengths, self.transducer_list_outputs, self.start_block, \
             self.encoder_hidden_init_fw, self.encoder_hidden_init_bw,\
             self.trans_hidden_init, self.teacher_forcing_targets, self.inference_mode, self.logits, \
             self.encoder_hidden_state_new_fw, self.encoder_hidden_state_new_bw, \
             self.transducer_hidden_state_new, self.train_saver = self.build_full_transducer()
+        self.saved_variables = tf.global_variables()  # What the train saver stores
+        self.checkpoint_writer = None
+
+        # Saved graphs only hold the forward graph, so taken before any training step is built. The variables of
+        # replicas live on the parameter server, their saved graphs should load anywhere.
+        self.meta_graph_def = self.train_saver.export_meta_graph(clear_devices=self.sync_replicas is not None)
 
-        self.targets, self.train_op, self.loss = self.build_training_step()
-        self.direct_targets, self.direct_train_op, self.direct_loss = self.build_training_step_direct_logits()
+        if objective is not None:
+            self.build_objective(objective)
+
+    def build_objective(self, objective, session=None):
+        """
+        Builds the training step & optimizer of an objective, unless it is built already.
+        :param objective: 'alignment' or 'direct_logits'.
+        :param session: If given, the new variables (optimizer slots) are initialized in it, e.g. when the objective is
+        built after the model was initialized.
+        :return:
+        """
+        assert objective in ['alignment', 'direct_logits'], 'Unknown objective: ' + str(objective)
+        if (objective == 'alignment' and self.train_op is not None) or \
+                (objective == 'direct_logits' and self.direct_train_op is not None):
+            return
+
+        existing_variables = set([var.name for var in tf.global_variables()])
+        # Built lazily by the first training step, outside of the device scope the model was built in
+        with tf.device(self.cons_manager.device_to_run):
+            if objective == 'alignment':
+                self.targets, self.train_op, self.loss = self.build_training_step()
+            else:
+                self.direct_targets, self.direct_train_op, self.direct_loss = self.build_training_step_direct_logits()
+        if session is not None:
+            session.run(tf.variables_initializer([var for var in tf.global_variables()
+                                                  if var.name not in existing_variables]))
 
     def build_full_transducer(self):
         with tf.variable_scope('transducer_training'):
@@ -327,6 +758,9 @@ class Model(object):
                                             dtype=tf.float32, name='inference_mode')  # Set 1.0 for inference, <1.0 for training
             # Get batch size
             batch_size = tf.shape(inputs_full_raw)[1]
+            # Frames of each sequence before its padding (see get_input_lengths), default is no padding
+            inputs_lengths = tf.placeholder_with_default(tf.fill([batch_size], tf.shape(inputs_full_raw)[0]),
+                                                         shape=(None,), name='inputs_lengths')  # [batch_size]
 
 
             # Temporary constants, maybe changed during inference
@@ -343,89 +777,129 @@ class Model(object):
                                                              self.cons_manager.input_dimensions])
             #inputs_full = tf.Print(inputs_full, [inputs_full], message='Inputs', summarize=10)
 
+            # Initiate cells
+            def get_lstm_cell(num_units):
+                if self.cons_manager.cell_backend == 'lstm':
+                    return tf.contrib.rnn.LSTMCell(num_units, state_is_tuple=True)
+                # Named like LSTMCell, with the same kernel & bias layout (gates i, c, f, o)
+                return tf.contrib.rnn.LSTMBlockCell(num_units, name='lstm_cell')
+
+            def get_encoder_cell():
+                if self.cons_manager.cell_backend == 'lstm_block_fused':
+                    # One fused cell per layer, run layer by layer (see run_encoder_direction)
+                    return [tf.contrib.rnn.LSTMBlockFusedCell(self.cons_manager.encoder_hidden_units, name='lstm_cell')
+                            for _ in range(self.cons_manager.encoder_hidden_layers)]
+                cell = []
+                for i in range(self.cons_manager.encoder_hidden_layers):
+                    cell.append(get_lstm_cell(self.cons_manager.encoder_hidden_units))
+                return tf.contrib.rnn.MultiRNNCell(cell, state_is_tuple=True)
+
+            encoder_cell_fw = get_encoder_cell()
+            encoder_cell_bw = get_encoder_cell()
+
+            transducer_cell = get_lstm_cell(self.cons_manager.transducer_hidden_units)
+
+            # --------------------- ENCODER --------------------------------------------------------------------------
+            # The encoder doesn't depend on the transducer, so it runs over all blocks at once, outside of the block
+            # loop. Per block it is a bidirectional RNN, both directions continue from the state of the previous
+            # block: forwards that is one RNN over the whole sequence, backwards one RNN over the sequence with each
+            # block reversed in place. Padded frames are skipped: the outputs there are zero and the states are held.
+            def get_state_tuple(state):
+                l_state = tf.unstack(state, axis=0)
+                return tuple([tf.nn.rnn_cell.LSTMStateTuple(l_state[idx][0], l_state[idx][1])
+                              for idx in range(self.cons_manager.encoder_hidden_layers)])
+
+            def get_state_tensor(state_tuple):
+                # Modify the encoder state so that it can be fed back in again without problems
+                state = tf.concat([tf.concat([ehs.c, ehs.h], axis=0) for ehs in state_tuple], axis=0)
+                return tf.reshape(state, shape=[self.cons_manager.encoder_hidden_layers, 2, batch_size,
+                                                self.cons_manager.encoder_hidden_units])
+
+            def reverse_blocks(blocks, block_lengths):
+                # Reverses the valid frames of each block in place, the padding stays at the end of the block
+                shape = tf.shape(blocks)
+                depth = blocks.get_shape()[3].value
+                frames = tf.reshape(tf.transpose(blocks, [1, 0, 2, 3]), shape=[shape[1], shape[0] * shape[2], depth])
+                frames = tf.reverse_sequence(frames, tf.reshape(block_lengths, shape=[-1]), seq_axis=0, batch_axis=1)
+                return tf.transpose(tf.reshape(frames, shape=[shape[1], shape[0], shape[2], depth]), [1, 0, 2, 3])
+
+            def run_encoder_direction(cell, blocks, block_lengths, init_state, scope):
+                # Blocks of shape [blocks, block_size, batch_size, input_dims] run as [time, batch_size, input_dims].
+                # The first block runs on its own, its state initializes the transducer. The padding of a sequence
+                # is at its end, so the valid frames of the blocks run as one sequence length.
+                def run(blocks, sequence_length, state):
+                    if self.cons_manager.inputs_embedded is True:
+                        encoder_inputs = tf.reshape(blocks, shape=[-1, batch_size, self.cons_manager.input_dimensions])
+                    else:
+                        encoder_inputs = tf.nn.embedding_lookup(embeddings, tf.reshape(blocks, shape=[-1, batch_size]))
+                    # Same variable names as tf.nn.bidirectional_dynamic_rnn
+                    with tf.variable_scope('bidirectional_rnn'):
+                        with tf.variable_scope(scope) as direction_scope:
+                            if isinstance(cell, list):
+                                # Fused layers, scoped like the layers of a MultiRNNCell
+                                layer_outputs = encoder_inputs
+                                layer_states = []
+                                for idx in range(len(cell)):
+                                    with tf.variable_scope('multi_rnn_cell/cell_' + str(idx)):
+                                        layer_outputs, (c, h) = cell[idx](layer_outputs, initial_state=state[idx],
+                                                                          dtype=tf.float32,
+                                                                          sequence_length=sequence_length)
+                                    layer_states.append(tf.nn.rnn_cell.LSTMStateTuple(c, h))
+                                return layer_outputs, tuple(layer_states)
+                            return tf.nn.dynamic_rnn(cell, encoder_inputs, sequence_length=sequence_length,
+                                                     initial_state=state, time_major=True, scope=direction_scope,
+                                                     swap_memory=self.cons_manager.swap_memory)
+
+                outputs_first, state_first = run(blocks[0:1], block_lengths[0], get_state_tuple(init_state))
+                state_first = get_state_tensor(state_first)
+
+                def run_rest():
+                    outputs_rest, state_rest = run(blocks[1:], tf.reduce_sum(block_lengths[1:], axis=0),
+                                                   get_state_tuple(state_first))
+                    return outputs_rest, get_state_tensor(state_rest)
+
+                def skip_rest():
+                    return tf.zeros(shape=[0, batch_size, self.cons_manager.encoder_hidden_units]), state_first
+
+                outputs_rest, state = tf.cond(tf.shape(blocks)[0] > 1, run_rest, skip_rest)
+                outputs = tf.reshape(tf.concat([outputs_first, outputs_rest], axis=0),
+                                     shape=[-1, self.cons_manager.input_block_size, batch_size,
+                                            self.cons_manager.encoder_hidden_units])
+                return outputs, state_first, state
+
+            inputs_blocks = inputs_full[start_block:start_block + max_blocks]
+            # Valid frames of each sequence in each block, [blocks, batch_size]
+            block_starts = tf.range(start_block, start_block + tf.shape(inputs_blocks)[0]) * \
+                self.cons_manager.input_block_size
+            block_lengths = tf.clip_by_value(tf.expand_dims(inputs_lengths, 0) - tf.expand_dims(block_starts, 1),
+                                             0, self.cons_manager.input_block_size)
+            inputs_blocks_reversed = reverse_blocks(inputs_blocks, block_lengths)
+            encoder_outputs_fw, encoder_first_state_fw, encoder_hidden_state_new_fw = run_encoder_direction(
+                encoder_cell_fw, inputs_blocks, block_lengths, encoder_hidden_init_fw, 'fw')
+            encoder_outputs_bw, encoder_first_state_bw, encoder_hidden_state_new_bw = run_encoder_direction(
+                encoder_cell_bw, inputs_blocks_reversed, block_lengths, encoder_hidden_init_bw, 'bw')
+            #   encoder_outputs_all: [blocks, block_size, batch_size, 2 * num_units]
+            encoder_outputs_all = tf.concat([encoder_outputs_fw, reverse_blocks(encoder_outputs_bw, block_lengths)], 3)
+            # Top encoder layer state after the first block
+            encoder_first_state = tf.concat([encoder_first_state_fw[-1], encoder_first_state_bw[-1]], 2)
+
             # Outputs
             outputs_ta = tf.TensorArray(dtype=tf.float32, size=max_blocks, infer_shape=False)
-            init_state = (start_block, outputs_ta, encoder_hidden_init_fw, encoder_hidden_init_bw, trans_hidden_init,
-                          0)
+            init_state = (start_block, outputs_ta, trans_hidden_init, 0)
 
-            # Initiate cells
-            cell = []
-            for i in range(self.cons_manager.encoder_hidden_layers):
-                cell.append(tf.contrib.rnn.LSTMCell(self.cons_manager.encoder_hidden_units, state_is_tuple=True))
-            encoder_cell_fw = tf.contrib.rnn.MultiRNNCell(cell, state_is_tuple=True)
-            cell = []
-            for i in range(self.cons_manager.encoder_hidden_layers):
-                cell.append(tf.contrib.rnn.LSTMCell(self.cons_manager.encoder_hidden_units, state_is_tuple=True))
-            encoder_cell_bw = tf.contrib.rnn.MultiRNNCell(cell, state_is_tuple=True)
-
-            transducer_cell = tf.contrib.rnn.LSTMCell(self.cons_manager.transducer_hidden_units)
-
-            def cond(current_block, outputs_int, encoder_hidden_fw, encoder_hidden_bw, trans_hidden, total_output):
+            def cond(current_block, outputs_int, trans_hidden, total_output):
                 return current_block < start_block + max_blocks
 
-            def body(current_block, outputs_int, encoder_hidden_fw, encoder_hidden_bw, trans_hidden, total_output):
-
-                # --------------------- ENCODER ----------------------------------------------------------------------
-                encoder_inputs = inputs_full[current_block]
-
-                if self.cons_manager.inputs_embedded is True:
-                    encoder_inputs_embedded = encoder_inputs
-                else:
-                    encoder_inputs = tf.reshape(encoder_inputs, shape=[-1, batch_size])
-                    encoder_inputs_embedded = tf.nn.embedding_lookup(embeddings, encoder_inputs)
-
-                # Build model
-                # Process encoder state
-
-                l_fw = tf.unstack(encoder_hidden_fw, axis=0)
-                encoder_hidden_state_fw = tuple(
-                    [tf.nn.rnn_cell.LSTMStateTuple(l_fw[idx][0], l_fw[idx][1])
-                     for idx in range(self.cons_manager.encoder_hidden_layers)]
-                )
-
-                l_bw = tf.unstack(encoder_hidden_bw, axis=0)
-                encoder_hidden_state_bw = tuple(
-                    [tf.nn.rnn_cell.LSTMStateTuple(l_bw[idx][0], l_bw[idx][1])
-                     for idx in range(self.cons_manager.encoder_hidden_layers)]
-                )
-                #   encoder_outputs: [max_time, batch_size, num_units]
-                ((encoder_outputs_fw, encoder_outputs_bw), (encoder_hidden_state_new_fw, encoder_hidden_state_new_bw)) = \
-                    tf.nn.bidirectional_dynamic_rnn(cell_fw=encoder_cell_fw, cell_bw=encoder_cell_bw,
-                                                    inputs=encoder_inputs_embedded,
-                                                    time_major=True,
-                                                    dtype=tf.float32,
-                                                    initial_state_fw=encoder_hidden_state_fw,
-                                                    initial_state_bw=encoder_hidden_state_bw)
-
-                encoder_outputs = tf.concat([encoder_outputs_fw, encoder_outputs_bw], 2)
-
-                # Modify output of encoder_hidden_state_new so that it can be fed back in again without problems.
-                encoder_hidden_state_new_fw = tf.concat(
-                    [tf.concat([ehs.c, ehs.h], axis=0) for ehs in encoder_hidden_state_new_fw],
-                    axis=0)
-                encoder_hidden_state_new_fw = tf.reshape(encoder_hidden_state_new_fw,
-                                                      shape=[self.cons_manager.encoder_hidden_layers,
-                                                             2,
-                                                             batch_size,
-                                                             self.cons_manager.encoder_hidden_units])
-
-                encoder_hidden_state_new_bw = tf.concat(
-                    [tf.concat([ehs.c, ehs.h], axis=0) for ehs in encoder_hidden_state_new_bw],
-                    axis=0)
-                encoder_hidden_state_new_bw = tf.reshape(encoder_hidden_state_new_bw,
-                                                         shape=[self.cons_manager.encoder_hidden_layers,
-                                                                2,
-                                                                batch_size,
-                                                                self.cons_manager.encoder_hidden_units])
+            def body(current_block, outputs_int, trans_hidden, total_output):
 
                 # --------------------- TRANSDUCER --------------------------------------------------------------------
                 # Each transducer block runs for the max transducer outputs in its respective block
 
-                encoder_raw_outputs = encoder_outputs
+                encoder_raw_outputs = encoder_outputs_all[current_block - start_block]
                 # Save/load the state as one tensor, use top encoder layer state as init if this is the first block
                 trans_hidden_state = tf.cond(current_block > 0,
                                              lambda: trans_hidden,
-                                             lambda: tf.concat([encoder_hidden_state_new_fw[-1], encoder_hidden_state_new_bw[-1]], 2))  # TODO: see if index is '0' or '-1'
+                                             lambda: encoder_first_state)  # TODO: see if index is '0' or '-1'
                 transducer_amount_outputs = transducer_list_outputs[current_block - start_block]
                 transducer_max_output = tf.reduce_max(transducer_amount_outputs)
 
@@ -442,8 +916,11 @@ class Model(object):
                 attention_states = tf.transpose(encoder_raw_outputs,
                                                 [1, 0, 2])  # attention_states: [batch_size, max_time, num_units]
 
+                # Only attend to the valid frames of the block (at least one, a block can be all padding for shorter
+                # sequences of the batch)
                 attention_mechanism = tf.contrib.seq2seq.LuongAttention(
-                    self.cons_manager.encoder_hidden_units * 2, attention_states)
+                    self.cons_manager.encoder_hidden_units * 2, attention_states,
+                    memory_sequence_length=tf.maximum(block_lengths[current_block - start_block], 1))
 
                 decoder_cell = tf.contrib.seq2seq.AttentionWrapper(
                     transducer_cell,
@@ -464,7 +941,8 @@ class Model(object):
                     output_layer=projection_layer)
                 outputs, transducer_hidden_state_new, _ = tf.contrib.seq2seq.dynamic_decode(decoder,
                                                                                             output_time_major=True,
-                                                                                            maximum_iterations=transducer_max_output)
+                                                                                            maximum_iterations=transducer_max_output,
+                                                                                            swap_memory=self.cons_manager.swap_memory)
                 logits = outputs.rnn_output  # logits of shape [max_time,batch_size,vocab_size]
                 decoder_prediction = outputs.sample_id  # For debugging
 
@@ -479,11 +957,11 @@ class Model(object):
                 # Note the outputs
                 outputs_int = outputs_int.write(current_block - start_block, logits)
 
-                return current_block + 1, outputs_int, encoder_hidden_state_new_fw, encoder_hidden_state_new_bw, \
-                    transducer_hidden_state_new, total_output + transducer_max_output
+                return current_block + 1, outputs_int, transducer_hidden_state_new, total_output + transducer_max_output
 
-            _, outputs_final, encoder_hidden_state_new_fw, encoder_hidden_state_new_bw, \
-                transducer_hidden_state_new, _ = tf.while_loop(cond, body, init_state, parallel_iterations=1)
+            _, outputs_final, transducer_hidden_state_new, _ = tf.while_loop(cond, body, init_state,
+                                                                             parallel_iterations=1,
+                                                                             swap_memory=self.cons_manager.swap_memory)
 
             # Process outputs
             logits = outputs_final.concat()  # And now its [max_output_time, batch_size, vocab]
@@ -496,8 +974,8 @@ class Model(object):
 
         train_saver = tf.train.Saver()  # For now save everything
 
-        return max_blocks, inputs_full_raw, transducer_list_outputs, start_block, encoder_hidden_init_fw, \
-            encoder_hidden_init_bw, trans_hidden_init, teacher_forcing_targets, inference_mode, \
+        return max_blocks, inputs_full_raw, inputs_lengths, transducer_list_outputs, start_block, \
+            encoder_hidden_init_fw, encoder_hidden_init_bw, trans_hidden_init, teacher_forcing_targets, inference_mode, \
             logits, encoder_hidden_state_new_fw, encoder_hidden_state_new_bw, transducer_hidden_state_new, train_saver
 
     def build_training_step(self):
@@ -514,7 +992,13 @@ class Model(object):
         stepwise_cross_entropy = tf.Print(stepwise_cross_entropy, [tf.argmax(self.logits, axis=2)], message='Argmax: ', summarize=100)
 
         loss = tf.reduce_mean(stepwise_cross_entropy)
-        train_op = tf.train.AdamOptimizer(epsilon=0.1).minimize(loss)
+        optimizer = tf.train.AdamOptimizer(epsilon=0.1)
+        if self.sync_replicas is not None:
+            self.global_step = tf.train.get_or_create_global_step()
+            self.sync_optimizer = tf.train.SyncReplicasOptimizer(optimizer, replicas_to_aggregate=self.sync_replicas,
+                                                                 total_num_replicas=self.sync_replicas)
+            optimizer = self.sync_optimizer
+        train_op = optimizer.minimize(loss, global_step=self.global_step)
         return targets, train_op, loss
 
     def build_training_step_direct_logits(self):
@@ -550,10 +1034,16 @@ class Model(object):
         train_op = tf.train.AdamOptimizer().minimize(loss)
         return targets, train_op, loss
 
-    def __create_loading_dic(self, list_vars, old_name, new_name):
+    def __create_loading_dic(self, list_vars, name_map=None):
+        # Name in the checkpoint -> variable
         dic = {}
         for var in list_vars:
-            dic[var.name] = var.name.replace(old_name, new_name)
+            name = var.op.name
+            for old_name, new_name in (name_map or {}).items():
+                name = name.replace(old_name, new_name)
+            assert name not in dic, 'name_map maps ' + dic[name].op.name + ' and ' + var.op.name + ' to the same ' \
+                                    'checkpoint variable: ' + name
+            dic[name] = var
         return dic
 
     def get_alignment_from_logits(self, logits, targets, amount_of_blocks, transducer_max_width):
@@ -628,6 +1118,7 @@ class Model(object):
                                                    new_alignment_width, None)
                     #print str(new_alignment.alignment_locations) + ': ' + str(new_alignment.log_prob)
                     new_alignments.append(new_alignment)
+                    metrics.increment('alignment_candidates_expanded')
 
             # Delete all overlapping alignments, keeping the highest log prob
             for a in reversed(new_alignments):
@@ -635,6 +1126,7 @@ class Model(object):
                     if o is not a and a.alignment_position == o.alignment_position and o.log_prob > a.log_prob:
                         if a in new_alignments:
                             new_alignments.remove(a)
+                            metrics.increment('alignment_recombinations')
 
             return new_alignments
 
@@ -753,6 +1245,7 @@ class Model(object):
         alignment.
         :return: Average loss of this training step.
         """
+        self.build_objective('direct_logits', session)
 
         inputs = []
         targets = []
@@ -810,7 +1303,7 @@ class Model(object):
         init_time = time.time()
 
         # Run training step
-        _, loss = session.run([self.direct_train_op, self.direct_loss], feed_dict={
+        _, loss = tracing.run(session, [self.direct_train_op, self.direct_loss], {
             self.max_blocks: amount_of_blocks,
             self.inputs_full_raw: inputs,
             self.transducer_list_outputs: [[self.cons_manager.transducer_max_width] * batch_size] * amount_of_blocks,
@@ -822,13 +1315,15 @@ class Model(object):
             self.trans_hidden_init: trans_hidden_init,
             self.inference_mode: 1.0,
             self.teacher_forcing_targets: teacher_targets_empty,
-        })
+        }, 'training_step_direct_logits')
 
-        print 'Training time: ' + str(time.time() - init_time)
+        metrics.add_time('training_session_run', time.time() - init_time)
+        metrics.increment('training_sequences', batch_size)
 
         return loss
 
-    def get_alignment(self, session, inputs, targets, input_block_size, transducer_max_width):
+    def get_alignment(self, session, inputs, targets, input_block_size, transducer_max_width, beam_width=None,
+                      beam_threshold=None, prior_alignment=None, band=None):
         """
         Finds the alignment of the target sequence to the actual output.
         :param session: The current session.
@@ -836,13 +1331,26 @@ class Model(object):
         :param targets: The target sequence of shape [time] where each enty is an index.
         :param input_block_size: The width of one encoder block.
         :param transducer_max_width: The max width of one transducer block.
+        :param beam_width: Hypotheses kept after each block, default is cons_manager.alignment_beam_width (0: all).
+        :param beam_threshold: Log prob distance to the best hypothesis for a hypothesis to be kept, default is
+        cons_manager.alignment_beam_threshold (None: all).
+        :param prior_alignment: Alignment to search around (e.g. the one of the previous realignment), the approximate
+        one from the input frames (see get_bootstrap_alignments) if None.
+        :param band: Max distance of the end position in each block to the prior alignment, default is
+        cons_manager.alignment_band (0: no band, prior_alignment is unused). Widened in the blocks where the best
+        alignment touches its edge (see run_alignment_blocks).
         :return: Returns a list of indices where <e>'s need to be inserted into the target sequence. (see paper)
         """
         model = self
-        self.full_time_needed_transducer = 0
+        if beam_width is None:
+            beam_width = self.cons_manager.alignment_beam_width
+        if beam_threshold is None:
+            beam_threshold = self.cons_manager.alignment_beam_threshold
+        if band is None:
+            band = self.cons_manager.alignment_band
 
         def run_new_block(session, full_inputs, previous_alignments, block_index, transducer_max_width, targets,
-                          total_blocks, last_encoder_state):
+                          total_blocks, last_encoder_state, band):
             """
             Runs one block of the alignment process.
             :param session: The current TF session.
@@ -853,6 +1361,7 @@ class Model(object):
             :param targets: The full target array of shape [time]
             :param total_blocks: The total amount of blocks.
             :param last_encoder_state: The encoder state of the previous step. Shape [2, 1, encoder_hidden_units]
+            :param band: Band around prior_alignment in this block, 0 for all end positions.
             :return: new_alignments as list of Alignment objects,
             last_encoder_state_new in shape of [2, 1, encoder_hidden_units]
             """
@@ -871,24 +1380,25 @@ class Model(object):
                 :return: transducer outputs [max_output_time, 1, vocab], transducer_state [2, 1, transducer_hidden_units],
                 encoder_state [2, 1, encoder_hidden_units]
                 """
-                teacher_targets_empty = np.ones([transducer_width, 1]) * self.cons_manager.GO_SYMBOL  # Only use go, rest is greedy
-
-                temp_init_time = time.time()
-
-                logits, trans_state, enc_state_fw, enc_state_bw = session.run([model.logits, model.transducer_hidden_state_new,
-                                                              model.encoder_hidden_state_new_fw, model.encoder_hidden_state_new_bw],
-                                                             feed_dict={
-                                                                 model.inputs_full_raw: inputs_full,
-                                                                 model.max_blocks: 1,
-                                                                 model.transducer_list_outputs: [[transducer_width]],
-                                                                 model.start_block: block_index - 1,
-                                                                 model.encoder_hidden_init_fw: encoder_state[0],
-                                                                 model.encoder_hidden_init_bw: encoder_state[1],
-                                                                 model.trans_hidden_init: transducer_state,
-                                                                 model.inference_mode: 1.0,
-                                                                 model.teacher_forcing_targets: teacher_targets_empty,
-                                                             })
-                model.full_time_needed_transducer += time.time() - temp_init_time
+                with metrics.timer('alignment_feed'):
+                    teacher_targets_empty = np.ones([transducer_width, 1]) * self.cons_manager.GO_SYMBOL  # Only use go, rest is greedy
+                    feed_dict = {
+                        model.inputs_full_raw: inputs_full,
+                        model.inputs_lengths: inputs_lengths,
+                        model.max_blocks: 1,
+                        model.transducer_list_outputs: [[transducer_width]],
+                        model.start_block: block_index - 1,
+                        model.encoder_hidden_init_fw: encoder_state[0],
+                        model.encoder_hidden_init_bw: encoder_state[1],
+                        model.trans_hidden_init: transducer_state,
+                        model.inference_mode: 1.0,
+                        model.teacher_forcing_targets: teacher_targets_empty,
+                    }
+
+                with metrics.timer('alignment_session_run'):
+                    logits, trans_state, enc_state_fw, enc_state_bw = tracing.run(
+                        session, [model.logits, model.transducer_hidden_state_new, model.encoder_hidden_state_new_fw,
+                                  model.encoder_hidden_state_new_bw], feed_dict, 'alignment')
 
                 # apply softmax on the outputs
                 trans_out = softmax(logits, axis=2)
@@ -909,8 +1419,14 @@ class Model(object):
                 max_index = alignment.alignment_position[0] + transducer_max_width + min(0, targets_length - (
                     alignment.alignment_position[0] + transducer_max_width))
 
+                # Banded search: only the end positions around the prior alignment, at least the closest valid one
+                band_min, band_max = min_index, max_index
+                if band > 0:
+                    band_min = max(min_index, min(prior_alignment[block_index - 1] - band, max_index))
+                    band_max = min(max_index, max(prior_alignment[block_index - 1] + band, min_index))
+
                 # new_alignment_index's value is equal to the index of y~ for that computation
-                for new_alignment_index in range(min_index, max_index + 1):  # +1 so that the max_index is also used
+                for new_alignment_index in range(band_min, band_max + 1):  # +1 so that the max_index is also used
                     # print 'Alignment index: ' + str(new_alignment_index)
                     # Create new alignment
                     new_alignment = copy.deepcopy(alignment)
@@ -925,7 +1441,11 @@ class Model(object):
                     #print targets
                     new_alignment.insert_alignment(new_alignment_index, block_index, trans_out, targets,
                                                    new_alignment_width, trans_state)
+                    if (new_alignment_index == band_min and band_min > min_index) or \
+                            (new_alignment_index == band_max and band_max < max_index):
+                        new_alignment.band_edge_block = block_index
                     new_alignments.append(new_alignment)
+                    metrics.increment('alignment_candidates_expanded')
 
             # Delete all overlapping alignments, keeping the highest log prob
             for a in reversed(new_alignments):
@@ -933,15 +1453,17 @@ class Model(object):
                     if o is not a and a.alignment_position == o.alignment_position and o.log_prob > a.log_prob:
                         if a in new_alignments:
                             new_alignments.remove(a)
+                            metrics.increment('alignment_recombinations')
 
-            return new_alignments, last_encoder_state_new
+            return prune_alignments(new_alignments, beam_width, beam_threshold), last_encoder_state_new
 
         # Manage variables
         amount_of_input_blocks = int(np.ceil(inputs.shape[0] / input_block_size))
-        current_block_index = 1
-        current_alignments = [Alignment(cons_manager=self.cons_manager)]
-        last_encoder_state = (np.zeros(shape=(self.cons_manager.encoder_hidden_layers, 2, 1, self.cons_manager.encoder_hidden_units)),
-                              np.zeros(shape=(self.cons_manager.encoder_hidden_layers, 2, 1, self.cons_manager.encoder_hidden_units)))
+        # Blocks after the end of the inputs are padding, the targets are aligned to the blocks before
+        inputs_lengths = get_input_lengths(inputs, self.cons_manager.inputs_embedded)
+        amount_of_aligned_blocks = min(amount_of_input_blocks,
+                                       max(get_input_blocks(inputs_lengths[0], input_block_size),
+                                           get_input_blocks(len(targets), transducer_max_width)))
 
         # Do assertions to check whether everything was correctly set up.
         assert inputs.shape[0] % input_block_size == 0, \
@@ -952,23 +1474,27 @@ class Model(object):
         assert transducer_max_width * amount_of_input_blocks >= len(
             targets), 'transducer_max_width to small for targets'
 
-        for block in range(current_block_index, amount_of_input_blocks + 1):
-            # Run all blocks
-            current_alignments, last_encoder_state = run_new_block(session=session, full_inputs=inputs,
-                                                                   previous_alignments=current_alignments,
-                                                                   block_index=block,
-                                                                   transducer_max_width=transducer_max_width,
-                                                                   targets=targets, total_blocks=amount_of_input_blocks,
-                                                                   last_encoder_state=last_encoder_state)
-            #for alignment in current_alignments:
-                #print str(alignment.alignment_locations) + ' ' + str(alignment.log_prob)
-
-            #print 'Size of alignments: ' + str(float(asizeof.asizeof(current_alignments))/(1024 * 1024))
+        if band > 0 and (prior_alignment is None or len(prior_alignment) < amount_of_aligned_blocks):
+            prior_alignment = get_bootstrap_alignments(inputs, [len(targets)], input_block_size,
+                                                       transducer_max_width)[0]
+
+        encoder_state_shape = (self.cons_manager.encoder_hidden_layers, 2, 1, self.cons_manager.encoder_hidden_units)
+        initial_encoder_state = (np.zeros(shape=encoder_state_shape), np.zeros(shape=encoder_state_shape))
+        current_alignments = run_alignment_blocks(
+            lambda previous_alignments, block_index, block_band, last_encoder_state: run_new_block(
+                session=session, full_inputs=inputs, previous_alignments=previous_alignments, block_index=block_index,
+                transducer_max_width=transducer_max_width, targets=targets, total_blocks=amount_of_aligned_blocks,
+                last_encoder_state=last_encoder_state, band=block_band),
+            total_blocks=amount_of_aligned_blocks, initial_alignments=[Alignment(cons_manager=self.cons_manager)],
+            initial_encoder_state=initial_encoder_state, band=band,
+            max_widenings=self.cons_manager.alignment_band_max_widenings)
         # Select first alignment if we have multiple with the same log prob (happens with ~1% probability in training)
 
-        print 'Full time needed for transducer: ' + str(self.full_time_needed_transducer)
+        metrics.increment('alignments')
 
-        return current_alignments[0].alignment_locations
+        # Nothing is emitted in the padding blocks
+        alignment_locations = current_alignments[0].alignment_locations
+        return alignment_locations + [alignment_locations[-1]] * (amount_of_input_blocks - amount_of_aligned_blocks)
 
     def get_alignment_greedy(self, session, inputs, targets, input_block_size, transducer_max_width):
         """
@@ -982,7 +1508,6 @@ class Model(object):
         """
 
         model = self
-        self.full_time_needed_transducer = 0
 
         def run_new_block(session, full_inputs, previous_alignments, block_index, transducer_max_width, targets,
                           total_blocks, last_encoder_state):
@@ -1014,25 +1539,25 @@ class Model(object):
                 :return: transducer outputs [max_output_time, 1, vocab], transducer_state [2, 1, transducer_hidden_units],
                 encoder_state [2, 1, encoder_hidden_units]
                 """
-                teacher_targets_empty = np.ones([transducer_width, 1]) * self.cons_manager.GO_SYMBOL  # Only use go, rest is greedy
-
-                temp_init_time = time.time()
-
-                logits, trans_state, enc_state_fw, enc_state_bw = session.run([model.logits, model.transducer_hidden_state_new,
-                                                              model.encoder_hidden_state_new_fw, model.encoder_hidden_state_new_bw],
-                                                             feed_dict={
-                                                                 model.inputs_full_raw: inputs_full,
-                                                                 model.max_blocks: 1,
-                                                                 model.transducer_list_outputs: [[transducer_width]],
-                                                                 model.start_block: block_index - 1,
-                                                                 model.encoder_hidden_init_fw: encoder_state[0],
-                                                                 model.encoder_hidden_init_bw: encoder_state[1],
-                                                                 model.trans_hidden_init: transducer_state,
-                                                                 model.inference_mode: 1.0,
-                                                                 model.teacher_forcing_targets: teacher_targets_empty,
-                                                             })
-
-                model.full_time_needed_transducer += time.time() - temp_init_time
+                with metrics.timer('alignment_feed'):
+                    teacher_targets_empty = np.ones([transducer_width, 1]) * self.cons_manager.GO_SYMBOL  # Only use go, rest is greedy
+                    feed_dict = {
+                        model.inputs_full_raw: inputs_full,
+                        model.inputs_lengths: inputs_lengths,
+                        model.max_blocks: 1,
+                        model.transducer_list_outputs: [[transducer_width]],
+                        model.start_block: block_index - 1,
+                        model.encoder_hidden_init_fw: encoder_state[0],
+                        model.encoder_hidden_init_bw: encoder_state[1],
+                        model.trans_hidden_init: transducer_state,
+                        model.inference_mode: 1.0,
+                        model.teacher_forcing_targets: teacher_targets_empty,
+                    }
+
+                with metrics.timer('alignment_session_run'):
+                    logits, trans_state, enc_state_fw, enc_state_bw = tracing.run(
+                        session, [model.logits, model.transducer_hidden_state_new, model.encoder_hidden_state_new_fw,
+                                  model.encoder_hidden_state_new_bw], feed_dict, 'alignment')
 
                 # apply softmax on the outputs
                 trans_out = softmax(logits, axis=2)
@@ -1069,6 +1594,7 @@ class Model(object):
                     new_alignment.insert_alignment(new_alignment_index, block_index, trans_out, targets,
                                                    new_alignment_width, trans_state)
                     new_alignments.append(new_alignment)
+                    metrics.increment('alignment_candidates_expanded')
 
             # Delete all overlapping alignments, keeping the highest log prob
             # TODO: Some very rare error probably here
@@ -1077,6 +1603,7 @@ class Model(object):
                     if o is not a and a.alignment_position == o.alignment_position and o.log_prob > a.log_prob:
                         if a in new_alignments:
                             new_alignments.remove(a)
+                            metrics.increment('alignment_recombinations')
             assert len(new_alignments) > 0, 'All alignments removed.'
             assert len(new_alignments) > 0 or new_alignments[0] is not None, 'First alignment None.'
 
@@ -1084,6 +1611,11 @@ class Model(object):
 
         # Manage variables
         amount_of_input_blocks = int(np.ceil(inputs.shape[0] / input_block_size))
+        # Blocks after the end of the inputs are padding, the targets are aligned to the blocks before
+        inputs_lengths = get_input_lengths(inputs, self.cons_manager.inputs_embedded)
+        amount_of_aligned_blocks = min(amount_of_input_blocks,
+                                       max(get_input_blocks(inputs_lengths[0], input_block_size),
+                                           get_input_blocks(len(targets), transducer_max_width)))
         current_block_index = 1
         current_alignments = [Alignment(cons_manager=self.cons_manager)]
         last_encoder_state = (np.zeros(shape=(self.cons_manager.encoder_hidden_layers, 2, 1, self.cons_manager.encoder_hidden_units)),
@@ -1098,13 +1630,13 @@ class Model(object):
         assert transducer_max_width * amount_of_input_blocks >= len(
             targets), 'transducer_max_width to small for targets'
 
-        for block in range(current_block_index, amount_of_input_blocks + 1):
+        for block in range(current_block_index, amount_of_aligned_blocks + 1):
             # Run all blocks
             current_alignments, last_encoder_state = run_new_block(session=session, full_inputs=inputs,
                                                                    previous_alignments=current_alignments,
                                                                    block_index=block,
                                                                    transducer_max_width=transducer_max_width,
-                                                                   targets=targets, total_blocks=amount_of_input_blocks,
+                                                                   targets=targets, total_blocks=amount_of_aligned_blocks,
                                                                    last_encoder_state=last_encoder_state)
             # Select the best from current_alignments (Thus we only have the best alignment at every block -> greedy)
             # TODO: test out as beam search
@@ -1120,56 +1652,32 @@ class Model(object):
 
         # Select first alignment if we have multiple with the same log prob (happens with ~1% probability in training)
 
-        print 'Greedy Full time needed for transducer: ' + str(self.full_time_needed_transducer)
+        metrics.increment('alignments')
 
-        return current_alignments[0].alignment_locations
+        # Nothing is emitted in the padding blocks
+        alignment_locations = current_alignments[0].alignment_locations
+        return alignment_locations + [alignment_locations[-1]] * (amount_of_input_blocks - amount_of_aligned_blocks)
 
     def get_alignment_cosine_distance(self, inputs, targets, input_block_size, transducer_max_width, correlation_param):
-        amount_of_input_blocks = int(np.ceil(inputs.shape[0] / input_block_size))
-        # Get summed distance within blocks
-        blocks = [[0] * input_block_size] * amount_of_input_blocks
-        for block in range(0, amount_of_input_blocks):
-            dist = []
-            for input_index in range(0, input_block_size - 1):
-                dist.append(abs(spatial.distance.cosine(inputs[block + input_index], inputs[block + input_index + 1])))
-            blocks[block] = dist
-
-        # Calculate mean
-        mean = sum([sum(x) for x in blocks]) / (input_block_size * amount_of_input_blocks)
-
-        # TODO: maybe linear regression based on sampling from exact to determine correlation_param
-
-        avg_targets_per_block = int(len(targets) / amount_of_input_blocks)
-        block_lengths = [avg_targets_per_block] * amount_of_input_blocks
-        for i in range(0, len(block_lengths)):
-            # Apply change
-            block_lengths[i] += block_lengths[i] * correlation_param * ((sum(blocks[i])/input_block_size) - mean)
-
-        normalization = len(targets) / sum(block_lengths)
-        block_lengths = [max(0.0, min(round(block * normalization), transducer_max_width)) for block in block_lengths]
-        # TODO: check rounding so that total length is equal to target length
-        alignment = []
-        loc = 0
-        for i in range(len(block_lengths)):
-            alignment.append(loc + block_lengths[i])
-            loc += block_lengths[i]
-        return alignment
-
-    def apply_training_step(self, session, batch_size, data_manager):
+        """
+        Approximate alignment of one sequence from the cosine distances of its input frames, see
+        get_bootstrap_alignments.
+        """
+        inputs = np.reshape(inputs, newshape=(inputs.shape[0], 1, -1))
+        return get_bootstrap_alignments(inputs, [len(targets)], input_block_size, transducer_max_width,
+                                        correlation_param)[0]
+
+    def apply_training_step(self, session, batch_size, data_manager, timings=None):
         """
         Applies a training step to the transducer model. This method can be called multiple times from e.g. a loop.
         :param session: The current session.
-        :param inputs: The full inputs. Shape: [max_time, batch_size, input_dimensions]
-        :param targets: The full targets. Shape: [batch_size, time]. Each entry is an index. Use lists.
-        All targets have to have the same length. (tl;dr: A list containing a list for each target, same lengths).
-        :param input_block_size: The block width for the inputs.
-        :param transducer_max_width: The max width for the transducer. Not including the output symbol <e>
-        :param training_steps_per_alignment: The amount of times to repeat the training step whilst caching the same
-        alignment.
-        :return: Average loss of this training step.
+        :param batch_size: The amount of sequences to train on.
+        :param data_manager: The data manager to sample sequences & alignments from.
+        :param timings: Optional dictionary, receives the time needed for each part of the step ('sampling', 'targets',
+        'feed' & 'run').
+        :return: Loss of this training step.
         """
-
-
+        self.build_objective('alignment', session)
 
         # Get vars
         alignments = []
@@ -1188,18 +1696,108 @@ class Model(object):
 
         inputs = np.concatenate(inputs, axis=1)
 
-        print 'Alignment time: ' + str(time.time() - init_time)
+        # Skip the blocks which are padding for the whole batch (in them every alignment only emits <e>)
+        inputs_lengths = get_input_lengths(inputs, self.cons_manager.inputs_embedded)
+        amount_of_blocks = get_input_blocks(np.max(inputs_lengths), self.cons_manager.input_block_size)
+        for alignment in alignments:
+            amount_of_blocks = max(amount_of_blocks, alignment.index(alignment[-1]) + 1)
+        if amount_of_blocks < len(alignments[0]):
+            metrics.increment('training_blocks_skipped', len(alignments[0]) - amount_of_blocks)
+            inputs = inputs[0:amount_of_blocks * self.cons_manager.input_block_size]
+            alignments = [alignment[0:amount_of_blocks] for alignment in alignments]
+
+        sampling_time = time.time() - init_time
         print 'Alignment: \n' + str(alignments)
 
-        f = open('/proc/{pid}/stat'.format(pid=str(os.getpid())), 'rb')
-        print 'Running main training on core: ' + str(f.read().split(' ')[-14])
-        f.close()
+        if metrics.is_enabled():
+            with open('/proc/{pid}/stat'.format(pid=str(os.getpid())), 'rb') as f:
+                metrics.set_gauge('training_cpu_core', int(f.read().split(' ')[-14]))
+
+        init_time = time.time()
+        targets, teacher_forcing, lengths = self.build_training_targets(targets, alignments)
+        targets_time = time.time() - init_time
+
+        batch_size = inputs.shape[1]
+
+        # Init values
+        encoder_hidden_state = (np.zeros(shape=(self.cons_manager.encoder_hidden_layers, 2, batch_size, self.cons_manager.encoder_hidden_units)),
+                                np.zeros(shape=(self.cons_manager.encoder_hidden_layers, 2, batch_size, self.cons_manager.encoder_hidden_units)))
+        trans_hidden_state = np.zeros(shape=(2, batch_size, self.cons_manager.transducer_hidden_units))
+
+        # Windows of blocks to train on, the rows of the targets of each block
+        amount_of_blocks = len(lengths)
+        window_blocks = self.cons_manager.training_window_blocks
+        if window_blocks <= 0:
+            window_blocks = amount_of_blocks
+        block_rows = np.concatenate([[0], np.cumsum(np.max(lengths, axis=1))])
+
+        feed_time = run_time = 0
+        loss = 0
+        for start in range(0, amount_of_blocks, window_blocks):
+            end = min(start + window_blocks, amount_of_blocks)
+            init_time = time.time()
+            feed_dict = {
+                self.max_blocks: end - start,
+                self.inputs_full_raw: inputs,
+                self.inputs_lengths: inputs_lengths,
+                self.transducer_list_outputs: lengths[start:end],
+                self.targets: targets[block_rows[start]:block_rows[end]],
+                self.start_block: start,
+                self.encoder_hidden_init_fw: encoder_hidden_state[0],
+                self.encoder_hidden_init_bw: encoder_hidden_state[1],
+                self.trans_hidden_init: trans_hidden_state,
+                self.inference_mode: 0,  # TODO: Set this back to 0
+                self.teacher_forcing_targets: teacher_forcing[block_rows[start]:block_rows[end]],
+            }
+            feed_time += time.time() - init_time
+
+            init_time = time.time()
+
+            # Run training step, the next window continues from the states at the end of this one (no gradients flow
+            # back across windows)
+            if end < amount_of_blocks:
+                _, window_loss, encoder_state_fw, encoder_state_bw, trans_hidden_state = tracing.run(
+                    session, [self.train_op, self.loss, self.encoder_hidden_state_new_fw,
+                              self.encoder_hidden_state_new_bw, self.transducer_hidden_state_new],
+                    feed_dict, 'training_step')
+                encoder_hidden_state = (encoder_state_fw, encoder_state_bw)
+            else:
+                _, window_loss = tracing.run(session, [self.train_op, self.loss], feed_dict, 'training_step')
+            metrics.increment('training_windows')
+
+            # Loss over all targets, like the loss of a single window
+            loss += window_loss * float(block_rows[end] - block_rows[start]) / block_rows[-1]
+            run_time += time.time() - init_time
+
+        metrics.add_time('training_sampling', sampling_time)
+        metrics.add_time('training_targets', targets_time)
+        metrics.add_time('training_feed', feed_time)
+        metrics.add_time('training_session_run', run_time)
+        metrics.increment('training_sequences', batch_size)
+        data_manager.training_steps += 1
+
+        if timings is not None:
+            timings['sampling'] = sampling_time
+            timings['targets'] = targets_time
+            timings['feed'] = feed_time
+            timings['run'] = run_time
+
+        return loss
 
+    def build_training_targets(self, targets, alignments):
+        """
+        Inserts the <e>'s of the alignments into the targets and pads every transducer block to the longest sequence
+        of the batch.
+        :param targets: List of target lists (Batch major), modified in place.
+        :param alignments: List of alignments, one per target.
+        :return: targets of shape [max_time, batch_size], teacher forcing targets of shape [max_time, batch_size] and
+        the lengths of each transducer block of shape [amount_of_blocks, batch_size].
+        """
         # Set vars
         teacher_forcing = []
         lengths = []
         max_lengths = [0] * len(alignments[0])
-        batch_size = inputs.shape[1]
+        batch_size = len(targets)
 
         # First calculate (max) lengths for all sequences
         for batch_index in range(batch_size):
@@ -1215,7 +1813,7 @@ class Model(object):
             lengths.append(lengths_temp)
 
         # Next modify so that each sequence is of equal length in each transducer block & targets have alignments
-        for batch_index in range(inputs.shape[1]):
+        for batch_index in range(batch_size):
             alignment = alignments[batch_index]
 
             # Modify targets so that it has the appropriate alignment
@@ -1259,70 +1857,76 @@ class Model(object):
         lengths = np.asarray(lengths)
         lengths = np.transpose(lengths, axes=[1, 0])
 
-        # Init values
-        encoder_hidden_init = (np.zeros(shape=(self.cons_manager.encoder_hidden_layers, 2, batch_size, self.cons_manager.encoder_hidden_units)),
-                               np.zeros(shape=(self.cons_manager.encoder_hidden_layers, 2, batch_size, self.cons_manager.encoder_hidden_units)))
-        trans_hidden_init = np.zeros(shape=(2, batch_size, self.cons_manager.transducer_hidden_units))
-
-        init_time = time.time()
+        return targets, teacher_forcing, lengths
 
-        # Run training step
-        _, loss = session.run([self.train_op, self.loss], feed_dict={
-            self.max_blocks: len(lengths),
-            self.inputs_full_raw: inputs,
-            self.transducer_list_outputs: lengths,
-            self.targets: targets,
-            self.start_block: 0,
-            self.encoder_hidden_init_fw: encoder_hidden_init[0],
-            self.encoder_hidden_init_bw: encoder_hidden_init[1],
-            self.trans_hidden_init: trans_hidden_init,
-            self.inference_mode: 0,  # TODO: Set this back to 0
-            self.teacher_forcing_targets: teacher_forcing,
-        })
+    def save_model_for_inference(self, session, path_name, asynchronous=False):
+        """
+        Saves the model variables & meta graph.
+        :param session: The current session.
+        :param path_name: Path & prefix of the checkpoint.
+        :param asynchronous: Only snapshot the variables and write them in a background thread (see
+        AsyncCheckpointWriter). Keeps the last cons_manager.checkpoints_to_keep asynchronous checkpoints.
+        :return:
+        """
+        if asynchronous is True:
+            if self.checkpoint_writer is None:
+                self.checkpoint_writer = AsyncCheckpointWriter(self.saved_variables,
+                                                               keep_last=self.cons_manager.checkpoints_to_keep)
+            self.checkpoint_writer.save(session, path_name, self.meta_graph_def)
+            print 'Model snapshot taken for ' + str(path_name)
+        else:
+            # The meta graph of the forward graph only (see __init__)
+            self.train_saver.save(session, path_name, write_meta_graph=False)
+            with tf.gfile.GFile(path_name + '.meta', 'wb') as f:
+                f.write(self.meta_graph_def.SerializeToString())
+            print 'Model saved to ' + str(path_name)
 
-        print 'Training time: ' + str(time.time() - init_time)
+    def wait_for_checkpoints(self):
+        """
+        Blocks until all asynchronous checkpoints are written.
+        """
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.wait()
 
-        return loss
+    def save_frozen_model_for_inference(self, session, path_name):
+        freeze_inference_graph(session, path_name)
 
-    def save_model_for_inference(self, session, path_name):
-        self.train_saver.save(session, path_name, write_meta_graph=True)
-        print 'Model saved to ' + str(path_name)
+    def load_model(self, session, path, name_map=None, partial=False):
+        """
+        Warm start: restores the values of a checkpoint into the variables of this model. The graph stays as it is,
+        nothing is imported.
+        :param session: The current session.
+        :param path: Path & prefix of the checkpoint.
+        :param name_map: Optional dictionary of renames, each key in a variable name is replaced by its value to get the
+        name in the checkpoint (e.g. {'transducer_training/': 'old_scope/'}).
+        :param partial: Only restore the variables found in the checkpoint with the same shape, the others keep their
+        values (e.g. after adding a layer). Otherwise all variables have to be found.
+        :return: List of the names of the variables that were not restored.
+        """
+        reader = tf.train.NewCheckpointReader(path)
+        checkpoint_shapes = reader.get_variable_to_shape_map()
+        loading_dic = self.__create_loading_dic(self.saved_variables, name_map)
 
-    def load_model(self, session, path):
-        saver = tf.train.import_meta_graph(path + '.meta')
-        saver.restore(session, path)
-        # Setup constants
-        graph = tf.get_default_graph()
-        # self.end_symbol = graph.get_tensor_by_name(name='transducer_training/end_symbol:0')
-        # Get inputs
-        self.max_blocks = graph.get_tensor_by_name(name='transducer_training/max_blocks:0')
-        self.inputs_full_raw = graph.get_tensor_by_name(name='transducer_training/inputs_full_raw:0')
-        self.transducer_list_outputs = graph.get_tensor_by_name(name='transducer_training/transducer_list_outputs:0')
-        self.start_block = graph.get_tensor_by_name(name='transducer_training/transducer_start_block:0')
-        self.encoder_hidden_init_fw = graph.get_tensor_by_name(name='transducer_training/encoder_hidden_init_fw:0')
-        self.encoder_hidden_init_bw = graph.get_tensor_by_name(name='transducer_training/encoder_hidden_init_bw:0')
-        self.trans_hidden_init = graph.get_tensor_by_name(name='transducer_training/trans_hidden_init:0')
-        self.teacher_forcing_targets = graph.get_tensor_by_name(name='transducer_training/teacher_forcing_targets:0')
-        self.inference_mode = graph.get_tensor_by_name(name='transducer_training/inference_mode:0')
-        # Get return ops
-        self.logits = graph.get_operation_by_name(name='transducer_training/logits').outputs[0]
-        self.encoder_hidden_state_new_fw = \
-            graph.get_operation_by_name(name='transducer_training/encoder_hidden_state_new_fw').outputs[0]
-        self.encoder_hidden_state_new_bw = \
-            graph.get_operation_by_name(name='transducer_training/encoder_hidden_state_new_bw').outputs[0]
-        self.transducer_hidden_state_new = \
-            graph.get_operation_by_name(name='transducer_training/transducer_hidden_state_new').outputs[0]
+        skipped = [loading_dic[name].op.name for name in loading_dic
+                   if name not in checkpoint_shapes or
+                   checkpoint_shapes[name] != loading_dic[name].get_shape().as_list()]
+        assert partial is True or len(skipped) == 0, 'Variables not in checkpoint: ' + str(skipped)
+        for var in skipped:
+            print 'Not restored: ' + var
 
-        #print session.run(tf.get_default_graph().get_tensor_by_name('transducer_training/bidirectional_rnn/bw/multi_rnn_cell/cell_0/lstm_cell/bias:0'))
-        print 'Loaded in model from: ' + str(path)
+        loading_dic = dict([(name, var) for name, var in loading_dic.items() if var.op.name not in skipped])
+        if len(loading_dic) > 0:
+            tf.train.Saver(var_list=loading_dic).restore(session, path)
+        print 'Loaded in model from: ' + str(path) + ' (' + str(len(loading_dic)) + ' variables)'
+        return skipped
 
 
 class InferenceManager(object):
 
     def __init__(self, cons_manager):
         self.cons_manager = cons_manager
-        # Init the interface for model loading
-        self.max_blocks = self.inputs_full_raw = self.transducer_list_outputs = self.start_block = \
+        # Init the interface for model loading, graphs exported before the input lengths existed have no inputs_lengths
+        self.max_blocks = self.inputs_full_raw = self.inputs_lengths = self.transducer_list_outputs = self.start_block = \
             self.encoder_hidden_init_fw = self.encoder_hidden_init_bw = \
             self.trans_hidden_init = self.teacher_forcing_targets = self.inference_mode = self.logits = \
             self.encoder_hidden_state_new_fw = self.encoder_hidden_state_new_bw = \
@@ -1338,6 +1942,10 @@ class InferenceManager(object):
         # Get inputs
         self.max_blocks = graph.get_tensor_by_name(name='transducer_training/max_blocks:0')
         self.inputs_full_raw = graph.get_tensor_by_name(name='transducer_training/inputs_full_raw:0')
+        try:
+            self.inputs_lengths = graph.get_tensor_by_name(name=INFERENCE_LENGTHS_NAME)
+        except KeyError:
+            self.inputs_lengths = None
         self.transducer_list_outputs = graph.get_tensor_by_name(name='transducer_training/transducer_list_outputs:0')
         self.start_block = graph.get_tensor_by_name(name='transducer_training/transducer_start_block:0')
         self.encoder_hidden_init_fw = graph.get_tensor_by_name(name='transducer_training/encoder_hidden_init_fw:0')
@@ -1354,6 +1962,46 @@ class InferenceManager(object):
         self.transducer_hidden_state_new = \
         graph.get_operation_by_name(name='transducer_training/transducer_hidden_state_new').outputs[0]
 
+    def build_frozen_inference(self, path, session):
+        """
+        Loads a frozen inference graph written by freeze_inference_graph. Nothing has to be restored, so this is much
+        quicker and lighter than importing the full training meta graph.
+        :param path: Path to the frozen GraphDef (e.g. model.pb).
+        :param session: The current session, the graph is imported into the graph of this session.
+        :return:
+        """
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(path, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        # Bind via return_elements, so that this also works if the names are already taken in the session graph
+        names = INFERENCE_INPUT_NAMES + INFERENCE_OUTPUT_NAMES
+        if INFERENCE_LENGTHS_NAME.split(':')[0] in [node.name for node in graph_def.node]:
+            names = names + [INFERENCE_LENGTHS_NAME]
+        with session.graph.as_default():
+            elements = tf.import_graph_def(graph_def, return_elements=names, name='')
+        self.max_blocks, self.inputs_full_raw, self.transducer_list_outputs, self.start_block, \
+            self.encoder_hidden_init_fw, self.encoder_hidden_init_bw, self.trans_hidden_init, \
+            self.teacher_forcing_targets, self.inference_mode, self.logits, self.encoder_hidden_state_new_fw, \
+            self.encoder_hidden_state_new_bw, self.transducer_hidden_state_new = elements[0:13]
+        self.inputs_lengths = elements[13] if len(elements) > 13 else None
+        print 'Loaded in frozen inference graph from: ' + str(path)
+
+    def build_from_model(self, model):
+        """
+        Uses the graph of an already built model (e.g. the one being trained), so no graph needs to be loaded.
+        :param model: The Model object.
+        :return:
+        """
+        self.inputs_lengths = model.inputs_lengths
+        self.max_blocks, self.inputs_full_raw, self.transducer_list_outputs, self.start_block, \
+            self.encoder_hidden_init_fw, self.encoder_hidden_init_bw, self.trans_hidden_init, \
+            self.teacher_forcing_targets, self.inference_mode, self.logits, self.encoder_hidden_state_new_fw, \
+            self.encoder_hidden_state_new_bw, self.transducer_hidden_state_new = \
+            model.max_blocks, model.inputs_full_raw, model.transducer_list_outputs, model.start_block, \
+            model.encoder_hidden_init_fw, model.encoder_hidden_init_bw, model.trans_hidden_init, \
+            model.teacher_forcing_targets, model.inference_mode, model.logits, model.encoder_hidden_state_new_fw, \
+            model.encoder_hidden_state_new_bw, model.transducer_hidden_state_new
+
     def run_inference(self, session, full_inputs, clean_e):
         # Can only process 1 sequence at a time
         model = self
@@ -1363,25 +2011,28 @@ class InferenceManager(object):
             teacher_targets_empty = np.ones(
                 [transducer_amount_out, 1]) * self.cons_manager.GO_SYMBOL  # Only use go, rest is greedy
 
+            feed_dict = {
+                model.inputs_full_raw: full_inputs,
+                model.max_blocks: 1,
+                model.transducer_list_outputs: [[transducer_amount_out]],
+                model.start_block: current_block,
+                model.encoder_hidden_init_fw: encoder_init_state[0],
+                model.encoder_hidden_init_bw: encoder_init_state[1],
+                model.trans_hidden_init: transducer_init_state,
+                model.inference_mode: 1.0,
+                model.teacher_forcing_targets: teacher_targets_empty,
+            }
+            if model.inputs_lengths is not None:
+                feed_dict[model.inputs_lengths] = inputs_lengths
             logits, trans_state, enc_state_fw, enc_state_bw = session.run(
                 [model.logits, model.transducer_hidden_state_new,
-                 model.encoder_hidden_state_new_fw, model.encoder_hidden_state_new_bw],
-                feed_dict={
-                    model.inputs_full_raw: full_inputs,
-                    model.max_blocks: 1,
-                    model.transducer_list_outputs: [[transducer_amount_out]],
-                    model.start_block: current_block,
-                    model.encoder_hidden_init_fw: encoder_init_state[0],
-                    model.encoder_hidden_init_bw: encoder_init_state[1],
-                    model.trans_hidden_init: transducer_init_state,
-                    model.inference_mode: 1.0,
-                    model.teacher_forcing_targets: teacher_targets_empty,
-                })
+                 model.encoder_hidden_state_new_fw, model.encoder_hidden_state_new_bw], feed_dict=feed_dict)
             logits = softmax(logits, axis=2)
             return logits, (enc_state_fw, enc_state_bw), trans_state
 
-        # Meta parameters
-        amount_of_input_blocks = int(np.ceil(full_inputs.shape[0] / self.cons_manager.input_block_size))
+        # Meta parameters, the blocks after the end of the inputs are padding
+        inputs_lengths = get_input_lengths(full_inputs, self.cons_manager.inputs_embedded)
+        amount_of_input_blocks = get_input_blocks(inputs_lengths[0], self.cons_manager.input_block_size)
         # Init encoder/decoder states
         last_encoder_state = (np.zeros(shape=(self.cons_manager.encoder_hidden_layers, 2, 1, self.cons_manager.encoder_hidden_units)),
                               np.zeros(shape=(self.cons_manager.encoder_hidden_layers, 2, 1, self.cons_manager.encoder_hidden_units)))
@@ -1392,7 +2043,10 @@ class InferenceManager(object):
         for current_input_block in range(0, amount_of_input_blocks):
                 max_e = 0
                 new_logits = None
+                new_encoder_state = last_encoder_state
+                new_transducer_state = last_transducer_state
 
+                # Every width starts from the states at the beginning of the block
                 for temp_width in range(1, self.cons_manager.transducer_max_width):
                     temp_logits, temp_enc, temp_trans = \
                         run_greedy_transducer_block(session=session,
@@ -1404,9 +2058,11 @@ class InferenceManager(object):
 
                     if temp_logits[-1, 0, self.cons_manager.E_SYMBOL] > max_e:
                         max_e = temp_logits[-1, 0, self.cons_manager.E_SYMBOL]
-                        last_encoder_state = temp_enc
-                        last_transducer_state = temp_trans
+                        new_encoder_state = temp_enc
+                        new_transducer_state = temp_trans
                         new_logits = temp_logits
+                last_encoder_state = new_encoder_state
+                last_transducer_state = new_transducer_state
                 logits.append(new_logits)
 
         # Post process logits into one np array and transform into list of ids
@@ -1424,6 +2080,78 @@ class InferenceManager(object):
 
         return predict_id, predicted_chars
 
+    def run_inference_batch(self, session, full_inputs, clean_e):
+        """
+        Same greedy search as run_inference, but for a whole batch at once: one session run per block and transducer
+        width for all sequences together.
+        :param session: The current session.
+        :param full_inputs: The full inputs. Shape: [max_time, batch_size, input_dimensions], all padded to max_time.
+        :param clean_e: Remove the <e> symbols from the predictions.
+        :return: List of predicted ids and list of predicted chars, one entry per sequence.
+        """
+        batch_size = full_inputs.shape[1]
+        # Blocks after the end of the inputs are padding, they are skipped once all sequences of the batch ended
+        inputs_lengths = get_input_lengths(full_inputs, self.cons_manager.inputs_embedded)
+        input_blocks = [get_input_blocks(length, self.cons_manager.input_block_size) for length in inputs_lengths]
+        amount_of_input_blocks = max(input_blocks)
+        # Init encoder/decoder states
+        last_encoder_state = (np.zeros(shape=(self.cons_manager.encoder_hidden_layers, 2, batch_size, self.cons_manager.encoder_hidden_units)),
+                              np.zeros(shape=(self.cons_manager.encoder_hidden_layers, 2, batch_size, self.cons_manager.encoder_hidden_units)))
+        last_transducer_state = np.zeros(shape=(2, batch_size, self.cons_manager.transducer_hidden_units))
+        predict_ids = [[] for _ in range(batch_size)]
+
+        for current_input_block in range(0, amount_of_input_blocks):
+            max_e = np.zeros(shape=(batch_size,))
+            new_transducer_state = np.copy(last_transducer_state)
+            new_encoder_state = last_encoder_state
+            new_ids = [[] for _ in range(batch_size)]
+
+            for temp_width in range(1, self.cons_manager.transducer_max_width):
+                teacher_targets_empty = np.ones([temp_width, batch_size]) * self.cons_manager.GO_SYMBOL
+                feed_dict = {
+                    self.inputs_full_raw: full_inputs,
+                    self.max_blocks: 1,
+                    self.transducer_list_outputs: [[temp_width] * batch_size],
+                    self.start_block: current_input_block,
+                    self.encoder_hidden_init_fw: last_encoder_state[0],
+                    self.encoder_hidden_init_bw: last_encoder_state[1],
+                    self.trans_hidden_init: last_transducer_state,
+                    self.inference_mode: 1.0,
+                    self.teacher_forcing_targets: teacher_targets_empty,
+                }
+                if self.inputs_lengths is not None:
+                    feed_dict[self.inputs_lengths] = inputs_lengths
+                logits, trans_state, enc_state_fw, enc_state_bw = session.run(
+                    [self.logits, self.transducer_hidden_state_new,
+                     self.encoder_hidden_state_new_fw, self.encoder_hidden_state_new_bw], feed_dict=feed_dict)
+                logits = softmax(logits, axis=2)
+                # The encoder state does not depend on the width
+                new_encoder_state = (enc_state_fw, enc_state_bw)
+
+                # Keep the width with the most likely <e> at the end, per sequence
+                e_probs = logits[-1, :, self.cons_manager.E_SYMBOL]
+                better = e_probs > max_e
+                max_e = np.where(better, e_probs, max_e)
+                new_transducer_state[:, better, :] = trans_state[:, better, :]
+                ids = np.argmax(logits, axis=2)
+                for batch_index in np.nonzero(better)[0]:
+                    new_ids[batch_index] = ids[:, batch_index].tolist()
+
+            last_encoder_state = new_encoder_state
+            last_transducer_state = new_transducer_state
+            for batch_index in range(batch_size):
+                if current_input_block < input_blocks[batch_index]:
+                    predict_ids[batch_index] += new_ids[batch_index]
+
+        if clean_e is True:
+            predict_ids = [[i for i in p if i != self.cons_manager.E_SYMBOL] for p in predict_ids]
+
+        def lookup(i):
+            return self.cons_manager.vocab_ids[i]
+        predicted_chars = [map(lookup, p) for p in predict_ids]
+
+        return predict_ids, predicted_chars
+
 
 # Visualization
 """
@@ -0,0 +1,160 @@
+from neural_transducer import ConstantsManager
+import tensorflow as tf
+import numpy as np
+import contextlib
+import datetime
+import platform
+import tempfile
+import json
+import sys
+import os
+
+# Shared pieces of the benchmark entry points (nt_benchmark_*.py): model presets with random weights, synthetic
+# RIMES shaped data, latency statistics and JSON results that can be compared against a baseline run.
+
+# Model sizes & sequence lengths, the 'rimes' preset corresponds to nt_rimes.py (inputs cut to 300, targets up to 18)
+PRESETS = {
+    'tiny': dict(input_dimensions=4, encoder_hidden_units=16, encoder_hidden_layers=1, input_block_size=5,
+                 transducer_max_width=4, vocab_size=10, input_length=20, target_length=8),
+    'small': dict(input_dimensions=16, encoder_hidden_units=64, encoder_hidden_layers=2, input_block_size=20,
+                  transducer_max_width=8, vocab_size=30, input_length=100, target_length=12),
+    'rimes': dict(input_dimensions=16, encoder_hidden_units=512, encoder_hidden_layers=3, input_block_size=100,
+                  transducer_max_width=8, vocab_size=64, input_length=300, target_length=18),
+}
+
+
+def get_preset_constants_manager(preset, **overrides):
+    """
+    Creates a constants manager from a preset. All paths point into a temporary directory.
+    :param preset: Name of the preset, see PRESETS.
+    :param overrides: Preset values to override (e.g. encoder_hidden_layers=2, input_block_size=50,
+    cell_backend='lstm_block', training_window_blocks=2).
+    :return: The constants manager.
+    """
+    settings = dict(PRESETS[preset])
+    settings.update(overrides)
+    path = tempfile.mkdtemp(prefix='nt_benchmark_')
+    return ConstantsManager(input_dimensions=settings['input_dimensions'],
+                            input_embedding_size=settings['input_dimensions'], inputs_embedded=True,
+                            encoder_hidden_units=settings['encoder_hidden_units'],
+                            transducer_hidden_units=2 * settings['encoder_hidden_units'],
+                            vocab_ids=[str(i) for i in range(settings['vocab_size'])],
+                            input_block_size=settings['input_block_size'], beam_width=5,
+                            encoder_hidden_layers=settings['encoder_hidden_layers'],
+                            transducer_max_width=settings['transducer_max_width'],
+                            path_to_model=path + '/model', path_to_inputs=path + '/inputs.npy',
+                            path_to_targets=path + '/targets.npy', path_to_alignments=path + '/alignments',
+                            path_to_cons_manager=path + '/cons_manager', amount_of_aligners=1, device_to_run='CPU:0',
+                            device_soft_placement=True, debug_devices=False, max_cores=settings.get('max_cores', 1),
+                            cell_backend=settings.get('cell_backend', 'lstm'),
+                            training_window_blocks=settings.get('training_window_blocks', 0),
+                            swap_memory=settings.get('swap_memory', False),
+                            alignment_beam_width=settings.get('alignment_beam_width', 0),
+                            alignment_beam_threshold=settings.get('alignment_beam_threshold', None),
+                            alignment_band=settings.get('alignment_band', 0))
+
+
+def get_session_config(cons_manager):
+    config = tf.ConfigProto(allow_soft_placement=cons_manager.device_soft_placement,
+                            log_device_placement=cons_manager.debug_devices,
+                            device_count={'CPU': cons_manager.max_cores},
+                            inter_op_parallelism_threads=cons_manager.max_cores,
+                            intra_op_parallelism_threads=cons_manager.max_cores)
+    config.gpu_options.allow_growth = True
+    return config
+
+
+def get_synthetic_sequence(cons_manager, amount_of_blocks, target_length, batch_size=1):
+    """
+    Random inputs & targets shaped like the RIMES data.
+    :param cons_manager: The constants manager.
+    :param amount_of_blocks: Amount of input blocks.
+    :param target_length: Length of each target sequence.
+    :param batch_size: Amount of sequences.
+    :return: inputs of shape [amount_of_blocks * input_block_size, batch_size, input_dimensions] (Time major) and
+    targets as list of lists of ids (Batch major), without the special symbols.
+    """
+    inputs = np.random.rand(amount_of_blocks * cons_manager.input_block_size, batch_size,
+                            cons_manager.input_dimensions)
+    targets = np.random.randint(0, cons_manager.E_SYMBOL, size=(batch_size, target_length)).tolist()
+    return inputs, targets
+
+
+def get_synthetic_alignment(target_length, amount_of_blocks):
+    """
+    Spreads the targets evenly over the blocks.
+    :return: Alignment in the format of Alignment.alignment_locations, the amount of targets emitted up to and
+    including each block.
+    """
+    return [int(round((block + 1) * target_length / float(amount_of_blocks))) for block in range(amount_of_blocks)]
+
+
+@contextlib.contextmanager
+def quiet():
+    # The model prints a lot on its hot paths, keep that out of the benchmark output
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
+
+
+def get_latency_stats(times):
+    """
+    :param times: List of durations in seconds.
+    :return: Dictionary of summary statistics.
+    """
+    times = np.asarray(times)
+    return {'runs': len(times),
+            'mean_s': float(np.mean(times)),
+            'min_s': float(np.min(times)),
+            'p50_s': float(np.percentile(times, 50)),
+            'p95_s': float(np.percentile(times, 95))}
+
+
+def get_run_info(cons_manager, preset):
+    return {'preset': preset,
+            'time': str(datetime.datetime.now()),
+            'host': platform.node(),
+            'tensorflow': tf.__version__,
+            'cpu_count': os.sysconf('SC_NPROCESSORS_ONLN'),
+            'input_dimensions': cons_manager.input_dimensions,
+            'encoder_hidden_units': cons_manager.encoder_hidden_units,
+            'encoder_hidden_layers': cons_manager.encoder_hidden_layers,
+            'input_block_size': cons_manager.input_block_size,
+            'transducer_max_width': cons_manager.transducer_max_width,
+            'vocab_size': cons_manager.vocab_size}
+
+
+def write_results(path, info, results):
+    with open(path, 'w') as f:
+        json.dump({'info': info, 'results': results}, f, indent=2, sort_keys=True)
+    print 'Benchmark results written to ' + str(path)
+
+
+def compare_to_baseline(results, path_to_baseline, key_fields, tolerance=1.2):
+    """
+    Compares the p50 latency of each result against the result with the same key in a previous run.
+    :param results: List of result dictionaries of this run.
+    :param path_to_baseline: JSON file written by write_results.
+    :param key_fields: Fields identifying a result (e.g. ['function', 'blocks', 'target_length']).
+    :param tolerance: Allowed slowdown factor.
+    :return: List of (key, ratio) of all results slower than tolerance * baseline.
+    """
+    with open(path_to_baseline, 'r') as f:
+        baseline = json.load(f)['results']
+
+    def key(result):
+        return tuple([result.get(k) for k in key_fields])
+
+    baseline = dict([(key(r), r) for r in baseline])
+    regressions = []
+    for result in results:
+        if key(result) in baseline:
+            ratio = result['p50_s'] / max(baseline[key(result)]['p50_s'], 1e-12)
+            print str(key(result)) + ': ' + '{0:.3f}x baseline'.format(ratio)
+            if ratio > tolerance:
+                regressions.append((key(result), ratio))
+    return regressions
@@ -3,9 +3,15 @@ import tensorflow as tf
 import numpy as np
 import copy
 import sys
-from multiprocessing import Process, Queue
+import os
+from multiprocessing import Process, Queue, Event
+from Queue import Empty
 import cPickle
-from neural_transducer import ConstantsManager, Alignment
+from neural_transducer import ConstantsManager, Alignment, get_alignment_part_path, get_input_lengths, \
+    get_input_blocks, prune_alignments, get_bootstrap_alignments, run_alignment_blocks
+import neural_transducer_metrics as metrics
+import neural_transducer_tracing as tracing
+from neural_transducer_resources import pin_to_cores, get_session_config
 import time
 import psutil
 from pympler import asizeof
@@ -23,15 +29,14 @@ class AlignerWorker(object):
     def __init__(self, cons_manager, cpu_core):
         self.cons_manager = cons_manager
         # Init the interface for model loading
-        self.max_blocks = self.inputs_full_raw = self.transducer_list_outputs = self.start_block = \
+        self.max_blocks = self.inputs_full_raw = self.inputs_lengths = self.transducer_list_outputs = self.start_block = \
             self.encoder_hidden_init_fw = self.encoder_hidden_init_bw = \
             self.trans_hidden_init = self.teacher_forcing_targets = self.inference_mode = self.logits = \
             self.encoder_hidden_state_new_fw = self.encoder_hidden_state_new_bw = \
             self.transducer_hidden_state_new = None
-        self.full_time_needed_transducer = 0
         self.cpu_core = cpu_core
 
-    def get_alignment(self, session, inputs, targets, input_block_size, transducer_max_width):
+    def get_alignment(self, session, inputs, targets, input_block_size, transducer_max_width, prior_alignment=None):
         """
         Finds the alignment of the target sequence to the actual output.
         :param session: The current session.
@@ -39,13 +44,13 @@ class AlignerWorker(object):
         :param targets: The target sequence of shape [time] where each enty is an index.
         :param input_block_size: The width of one encoder block.
         :param transducer_max_width: The max width of one transducer block.
+        :param prior_alignment: Previous alignment of the sequence, searched around with cons_manager.alignment_band.
         :return: Returns a list of indices where <e>'s need to be inserted into the target sequence. (see paper)
         """
         model = self
-        self.full_time_needed_transducer = 0
 
         def run_new_block(session, full_inputs, previous_alignments, block_index, transducer_max_width, targets,
-                          total_blocks, last_encoder_state):
+                          total_blocks, last_encoder_state, band):
             """
             Runs one block of the alignment process.
             :param session: The current TF session.
@@ -56,6 +61,7 @@ class AlignerWorker(object):
             :param targets: The full target array of shape [time]
             :param total_blocks: The total amount of blocks.
             :param last_encoder_state: The encoder state of the previous step. Shape [2, 1, encoder_hidden_units]
+            :param band: Band around prior_alignment in this block, 0 for all end positions.
             :return: new_alignments as list of Alignment objects,
             last_encoder_state_new in shape of [2, 1, encoder_hidden_units]
             """
@@ -74,24 +80,25 @@ class AlignerWorker(object):
                 :return: transducer outputs [max_output_time, 1, vocab], transducer_state [2, 1, transducer_hidden_units],
                 encoder_state [2, 1, encoder_hidden_units]
                 """
-                teacher_targets_empty = np.ones([transducer_width, 1]) * self.cons_manager.GO_SYMBOL  # Only use go, rest is greedy
-
-                temp_init_time = time.time()
-
-                logits, trans_state, enc_state_fw, enc_state_bw = session.run([model.logits, model.transducer_hidden_state_new,
-                                                              model.encoder_hidden_state_new_fw, model.encoder_hidden_state_new_bw],
-                                                             feed_dict={
-                                                                 model.inputs_full_raw: inputs_full,
-                                                                 model.max_blocks: 1,
-                                                                 model.transducer_list_outputs: [[transducer_width]],
-                                                                 model.start_block: block_index - 1,
-                                                                 model.encoder_hidden_init_fw: encoder_state[0],
-                                                                 model.encoder_hidden_init_bw: encoder_state[1],
-                                                                 model.trans_hidden_init: transducer_state,
-                                                                 model.inference_mode: 1.0,
-                                                                 model.teacher_forcing_targets: teacher_targets_empty,
-                                                             })
-                model.full_time_needed_transducer += time.time() - temp_init_time
+                with metrics.timer('alignment_feed'):
+                    teacher_targets_empty = np.ones([transducer_width, 1]) * self.cons_manager.GO_SYMBOL  # Only use go, rest is greedy
+                    feed_dict = {
+                        model.inputs_full_raw: inputs_full,
+                        model.inputs_lengths: inputs_lengths,
+                        model.max_blocks: 1,
+                        model.transducer_list_outputs: [[transducer_width]],
+                        model.start_block: block_index - 1,
+                        model.encoder_hidden_init_fw: encoder_state[0],
+                        model.encoder_hidden_init_bw: encoder_state[1],
+                        model.trans_hidden_init: transducer_state,
+                        model.inference_mode: 1.0,
+                        model.teacher_forcing_targets: teacher_targets_empty,
+                    }
+
+                with metrics.timer('alignment_session_run'):
+                    logits, trans_state, enc_state_fw, enc_state_bw = tracing.run(
+                        session, [model.logits, model.transducer_hidden_state_new, model.encoder_hidden_state_new_fw,
+                                  model.encoder_hidden_state_new_bw], feed_dict, 'alignment')
 
                 # apply softmax on the outputs
                 trans_out = softmax(logits, axis=2)
@@ -112,8 +119,14 @@ class AlignerWorker(object):
                 max_index = alignment.alignment_position[0] + transducer_max_width + min(0, targets_length - (
                     alignment.alignment_position[0] + transducer_max_width))
 
+                # Banded search: only the end positions around the prior alignment, at least the closest valid one
+                band_min, band_max = min_index, max_index
+                if band > 0:
+                    band_min = max(min_index, min(prior_alignment[block_index - 1] - band, max_index))
+                    band_max = min(max_index, max(prior_alignment[block_index - 1] + band, min_index))
+
                 # new_alignment_index's value is equal to the index of y~ for that computation
-                for new_alignment_index in range(min_index, max_index + 1):  # +1 so that the max_index is also used
+                for new_alignment_index in range(band_min, band_max + 1):  # +1 so that the max_index is also used
                     # print 'Alignment index: ' + str(new_alignment_index)
                     # Create new alignment
                     new_alignment = copy.deepcopy(alignment)
@@ -127,7 +140,11 @@ class AlignerWorker(object):
 
                     new_alignment.insert_alignment(new_alignment_index, block_index, trans_out, targets,
                                                    new_alignment_width, trans_state)
+                    if (new_alignment_index == band_min and band_min > min_index) or \
+                            (new_alignment_index == band_max and band_max < max_index):
+                        new_alignment.band_edge_block = block_index
                     new_alignments.append(new_alignment)
+                    metrics.increment('alignment_candidates_expanded')
 
             # Delete all overlapping alignments, keeping the highest log prob
             for a in reversed(new_alignments):
@@ -135,15 +152,18 @@ class AlignerWorker(object):
                     if o is not a and a.alignment_position == o.alignment_position and o.log_prob > a.log_prob:
                         if a in new_alignments:
                             new_alignments.remove(a)
+                            metrics.increment('alignment_recombinations')
 
-            return new_alignments, last_encoder_state_new
+            return prune_alignments(new_alignments, self.cons_manager.alignment_beam_width,
+                                    self.cons_manager.alignment_beam_threshold), last_encoder_state_new
 
         # Manage variables
         amount_of_input_blocks = int(np.ceil(inputs.shape[0] / input_block_size))
-        current_block_index = 1
-        current_alignments = [Alignment(cons_manager=self.cons_manager)]
-        last_encoder_state = (np.zeros(shape=(self.cons_manager.encoder_hidden_layers, 2, 1, self.cons_manager.encoder_hidden_units)),
-                              np.zeros(shape=(self.cons_manager.encoder_hidden_layers, 2, 1, self.cons_manager.encoder_hidden_units)))
+        # Blocks after the end of the inputs are padding, the targets are aligned to the blocks before
+        inputs_lengths = get_input_lengths(inputs, self.cons_manager.inputs_embedded)
+        amount_of_aligned_blocks = min(amount_of_input_blocks,
+                                       max(get_input_blocks(inputs_lengths[0], input_block_size),
+                                           get_input_blocks(len(targets), transducer_max_width)))
 
         # Do assertions to check whether everything was correctly set up.
         assert inputs.shape[0] % input_block_size == 0, \
@@ -154,22 +174,31 @@ class AlignerWorker(object):
         assert transducer_max_width * amount_of_input_blocks >= len(
             targets), 'transducer_max_width to small for targets'
 
-        for block in range(current_block_index, amount_of_input_blocks + 1):
-            # Run all blocks
-            current_alignments, last_encoder_state = run_new_block(session=session, full_inputs=inputs,
-                                                                   previous_alignments=current_alignments,
-                                                                   block_index=block,
-                                                                   transducer_max_width=transducer_max_width,
-                                                                   targets=targets, total_blocks=amount_of_input_blocks,
-                                                                   last_encoder_state=last_encoder_state)
-            #print 'Size of alignments: ' + str(float(asizeof.asizeof(current_alignments))/(1024 * 1024))
-            sys.stdout.flush()
+        # Banded search around the previous alignment (see Model.get_alignment)
+        band = self.cons_manager.alignment_band
+        if band > 0 and (prior_alignment is None or len(prior_alignment) < amount_of_aligned_blocks):
+            prior_alignment = get_bootstrap_alignments(inputs, [len(targets)], input_block_size,
+                                                       transducer_max_width)[0]
+
+        encoder_state_shape = (self.cons_manager.encoder_hidden_layers, 2, 1, self.cons_manager.encoder_hidden_units)
+        initial_encoder_state = (np.zeros(shape=encoder_state_shape), np.zeros(shape=encoder_state_shape))
+        current_alignments = run_alignment_blocks(
+            lambda previous_alignments, block_index, block_band, last_encoder_state: run_new_block(
+                session=session, full_inputs=inputs, previous_alignments=previous_alignments, block_index=block_index,
+                transducer_max_width=transducer_max_width, targets=targets, total_blocks=amount_of_aligned_blocks,
+                last_encoder_state=last_encoder_state, band=block_band),
+            total_blocks=amount_of_aligned_blocks, initial_alignments=[Alignment(cons_manager=self.cons_manager)],
+            initial_encoder_state=initial_encoder_state, band=band,
+            max_widenings=self.cons_manager.alignment_band_max_widenings)
+        sys.stdout.flush()
 
         # Select first alignment if we have multiple with the same log prob (happens with ~1% probability in training)
 
-        print 'Full time needed for transducer: ' + str(self.full_time_needed_transducer)
+        metrics.increment('alignments')
 
-        return current_alignments[0].alignment_locations
+        # Nothing is emitted in the padding blocks
+        alignment_locations = current_alignments[0].alignment_locations
+        return alignment_locations + [alignment_locations[-1]] * (amount_of_input_blocks - amount_of_aligned_blocks)
 
     def get_model(self, path):
         # Restore graph
@@ -181,6 +210,7 @@ class AlignerWorker(object):
         # Get inputs
         self.max_blocks = graph.get_tensor_by_name(name='transducer_training/max_blocks:0')
         self.inputs_full_raw = graph.get_tensor_by_name(name='transducer_training/inputs_full_raw:0')
+        self.inputs_lengths = graph.get_tensor_by_name(name='transducer_training/inputs_lengths:0')
         self.transducer_list_outputs = graph.get_tensor_by_name(name='transducer_training/transducer_list_outputs:0')
         self.start_block = graph.get_tensor_by_name(name='transducer_training/transducer_start_block:0')
         self.encoder_hidden_init_fw = graph.get_tensor_by_name(name='transducer_training/encoder_hidden_init_fw:0')
@@ -195,22 +225,46 @@ class AlignerWorker(object):
         self.transducer_hidden_state_new = graph.get_operation_by_name(name='transducer_training/transducer_hidden_state_new').outputs[0]
         return saver
 
-    def run(self, queue_input, queue_output, init_path):
+    def run(self, queue_input, queue_output, init_path, targets, prior_alignments=None, stop_event=None):
+        """
+        Aligns the sequences whose indices come in over queue_input and sends (index, alignment, worker) back over
+        queue_output, until the queue is empty or stop_event is set.
+        :param targets: Target sequences of all sequences (Batch major lists of ids).
+        :param prior_alignments: Previous alignment of each sequence (or None) for the banded search, or None.
+        """
         temp_list = []  # Holds the processed data
+        # Memory mapped, all aligners read the sequences from the same pages instead of getting copies over the queue
+        full_inputs = np.load(self.cons_manager.path_to_inputs, mmap_mode='r')
 
         # Init session
-        config = tf.ConfigProto(allow_soft_placement=self.cons_manager.device_soft_placement,
-                                log_device_placement=self.cons_manager.debug_devices,
-                                device_count={'CPU': self.cons_manager.max_cores},
-                                inter_op_parallelism_threads=self.cons_manager.max_cores,
-                                intra_op_parallelism_threads=self.cons_manager.max_cores)
-        config.gpu_options.allow_growth = True
+        device = '/cpu:' + str(self.cpu_core)
+        if self.cons_manager.core_plan is not None:
+            # Pinned to the cores of the plan, with thread pools of the same size
+            aligner_cores = self.cons_manager.core_plan['aligners']
+            cores = aligner_cores[(self.cpu_core - 1) % len(aligner_cores)]
+            pin_to_cores(cores)
+            config = get_session_config(self.cons_manager, cores)
+            device = '/cpu:0'
+        else:
+            config = tf.ConfigProto(allow_soft_placement=self.cons_manager.device_soft_placement,
+                                    log_device_placement=self.cons_manager.debug_devices,
+                                    device_count={'CPU': self.cons_manager.max_cores},
+                                    inter_op_parallelism_threads=self.cons_manager.max_cores,
+                                    intra_op_parallelism_threads=self.cons_manager.max_cores)
+            config.gpu_options.allow_growth = True
 
         print 'Child process alive: ' + str(self.cpu_core)
         sys.stdout.flush()
 
+        if self.cons_manager.path_to_metrics is not None:
+            metrics.enable(process='aligner_' + str(self.cpu_core))
+            metrics_path = metrics.get_process_path(self.cons_manager.path_to_metrics, 'aligner_' + str(self.cpu_core))
+        if self.cons_manager.path_to_traces is not None:
+            tracing.enable(self.cons_manager.path_to_traces, every_n=self.cons_manager.trace_every_n,
+                           prefix='aligner_' + str(self.cpu_core) + '_')
+
         # Do init graph loading
-        with tf.device('/cpu:' + str(self.cpu_core)):
+        with tf.device(device):
             saver = self.get_model(init_path)
 
         with tf.Session(config=config) as sess:
@@ -221,103 +275,256 @@ class AlignerWorker(object):
 
             sys.stdout.flush()
 
-            # Main loop
-            while queue_input.empty() is False:
+            # Main loop, until there is no more work or the manager shrinks the pool
+            while queue_input.empty() is False and (stop_event is None or stop_event.is_set() is False):
                 # Process new alignment
                 if queue_input.empty() is False:
-                    (inputs, target) = queue_input.get()  # Retrieve new data
-                    if inputs is not None and target is not None:
+                    try:
+                        with metrics.timer('aligner_queue_wait'):
+                            index = queue_input.get(timeout=1)  # Retrieve new data
+                    except Empty:
+                        continue  # Another worker got the last one
+                    if index is not None:
                         init_time = time.time()
-                        new_alignment = self.get_alignment(sess, inputs=inputs, targets=target,
+                        inputs = np.reshape(full_inputs[:, index, :], newshape=(-1, 1, self.cons_manager.input_dimensions))
+                        new_alignment = self.get_alignment(sess, inputs=inputs, targets=targets[index],
                                                            input_block_size=self.cons_manager.input_block_size,
-                                                           transducer_max_width=self.cons_manager.transducer_max_width)
-                        temp_list.append((inputs.tostring(), new_alignment))
-                        print 'Aligner time needed full: ' + str(time.time() - init_time)
+                                                           transducer_max_width=self.cons_manager.transducer_max_width,
+                                                           prior_alignment=prior_alignments[index]
+                                                           if prior_alignments is not None else None)
+                        temp_list.append((index, new_alignment, self.cpu_core))
+                        metrics.add_time('aligner_alignment', time.time() - init_time)
+                        if metrics.is_enabled():
+                            metrics.export(metrics_path)
+                        tracing.export_summary()
                         sys.stdout.flush()
 
                 # Debugging
                 sys.stdout.flush()
 
                 # Push all new alignments onto the output queue
-                for a in temp_list:
-                    if queue_output.full() is False:
-                        queue_output.put(a)
-                        temp_list.remove(a)
-                time.sleep(1)
+                while len(temp_list) > 0 and queue_output.full() is False:
+                    queue_output.put(temp_list.pop(0))
+                if len(temp_list) > 0:
+                    time.sleep(1)  # Output queue is full, give the manager time to catch up
+
+            # Nothing may get lost when stopping
+            for a in temp_list:
+                queue_output.put(a)
 
             print 'Child process dead.'
             sys.stdout.flush()
 
 
 class AlignerManager(object):
-    def __init__(self, cons_manager):
-        self.alignment_dic = {}  # key = inputs.tostring, value = (alignment)
-        self.input_queue = Queue(10 * cons_manager.amount_of_aligners)
-        self.output_queue = Queue(10 * cons_manager.amount_of_aligners)
-        self.processes = []
+    def __init__(self, cons_manager, targets, prior_alignments=None, trainer_pid=None, stream_interval=None):
+        """
+        :param cons_manager: The constants manager.
+        :param targets: Target sequences (Batch major lists of ids), handed to every aligner when it starts.
+        :param prior_alignments: Previous alignment of each sequence (or None) for the banded search, or None.
+        """
+        self.alignment_dic = {}  # key = sequence index, value = (alignment)
+        self.targets = targets
+        self.prior_alignments = prior_alignments
+        self.inputs = None
+        max_aligners = max(cons_manager.amount_of_aligners, cons_manager.max_aligners or 0)
+        self.input_queue = Queue(10 * max_aligners)
+        self.output_queue = Queue(10 * max_aligners)
+        self.workers = {}  # key = worker index, value = (process, stop event)
+        self.processes = []  # All processes ever started, including stopped ones
         self.cons_manager = cons_manager
 
+        # Streaming to a training process: the alignments since the last part are written every stream_interval seconds
+        self.stream_interval = stream_interval
+        self.stream_alignments = {}
+        self.stream_parts = 0
+
+        # Pool sizing
+        self.window_alignments = {}  # key = worker index, value = alignments received in the current window
+        self.pool_throughputs = {}  # key = pool size, value = (sequences per second, window)
+        self.pool_direction = 1
+        self.pool_settling = True
+        self.windows = 0
+        self.trainer_process = None
+        if trainer_pid is not None and psutil.pid_exists(trainer_pid):
+            self.trainer_process = psutil.Process(trainer_pid)
+            self.trainer_process.cpu_percent(interval=None)  # The first call only starts the measurement
+
+    def start_aligner(self, index):
+        stop_event = Event()
+        a = AlignerWorker(cons_manager=self.cons_manager, cpu_core=index)
+        p = Process(target=a.run, args=(self.input_queue, self.output_queue, self.cons_manager.path_to_model,
+                                         self.targets, self.prior_alignments, stop_event))
+        p.daemon = True
+        self.workers[index] = (p, stop_event)
+        self.processes.append(p)
+        p.start()
+
+    def stop_aligner(self):
+        # The newest worker finishes its current alignment, hands it in and exits
+        index = max(self.workers)
+        self.workers.pop(index)[1].set()
+
     def start_aligners(self):
         # Start new processes for aligners
         for i in range(self.cons_manager.amount_of_aligners):
-            a = AlignerWorker(cons_manager=self.cons_manager, cpu_core=i+1)
-            p = Process(target=a.run, args=(self.input_queue, self.output_queue, self.cons_manager.path_to_model))
-            p.daemon = True
-            self.processes.append(p)
-            p.start()
+            self.start_aligner(i + 1)
 
-    def run_new_alignments(self, inputs, targets):
+    def get_trainer_utilization(self):
+        """
+        :return: CPU utilization of the trainer since the last call, relative to its cores (0 to 1). 0 if unknown.
+        """
+        if self.trainer_process is None:
+            return 0.0
+        try:
+            percent = self.trainer_process.cpu_percent(interval=None)
+        except psutil.NoSuchProcess:
+            return 0.0
+        if self.cons_manager.core_plan is not None:
+            return percent / 100.0 / len(self.cons_manager.core_plan['trainer'])
+        return percent / 100.0 / self.cons_manager.max_cores
+
+    def adapt_pool(self, window_time):
+        """
+        Measures the throughput of the last window and resizes the aligner pool by hill climbing on it: the pool keeps
+        growing (shrinking) while that pays off (doesn't hurt) and turns around otherwise. Each pool size remembers its
+        throughput for 10 windows, so known worse sizes aren't retried until then. The pool doesn't grow while the
+        trainer is busy, new aligners would take cores from it.
+        :param window_time: Length of the window in seconds.
+        """
+        self.workers = dict([(i, w) for i, w in self.workers.items() if w[0].is_alive()])
+        size = len(self.workers)
+        throughput = sum(self.window_alignments.values()) / window_time
+        worker_throughputs = [(i, self.window_alignments.get(i, 0) / window_time) for i in sorted(self.workers)]
+        self.window_alignments = {}
+        self.windows += 1
+
+        # The window after a change includes the graph loading of new workers
+        if self.pool_settling is True or size == 0:
+            self.pool_settling = False
+            return
+
+        trainer_utilization = self.get_trainer_utilization()
+        print '\n Aligner pool: ' + str(size) + ' workers / Throughput: {0:.3f} seq/s / Trainer utilization: ' \
+              '{1:.2f} / Per worker: '.format(throughput, trainer_utilization) + \
+              ', '.join(['{0}: {1:.3f}'.format(i, t) for i, t in worker_throughputs])
+        metrics.set_gauge('aligner_pool_size', size)
+        metrics.set_gauge('aligner_pool_throughput', throughput)
+        metrics.set_gauge('trainer_utilization', trainer_utilization)
+        if self.cons_manager.max_aligners is None:
+            return
+
+        self.pool_throughputs[size] = (throughput, self.windows)
+        self.pool_throughputs = dict([(s, v) for s, v in self.pool_throughputs.items() if self.windows - v[1] < 10])
+
+        # Did the last step pay off?
+        previous = self.pool_throughputs.get(size - self.pool_direction)
+        if previous is not None:
+            if (self.pool_direction > 0 and throughput < previous[0] * 1.05) or \
+                    (self.pool_direction < 0 and throughput < previous[0] * 0.95):
+                self.pool_direction = -self.pool_direction
+
+        # Only grow for a known gain, shrink unless it is known to hurt
+        new_size = size + self.pool_direction
+        known = self.pool_throughputs.get(new_size)
+        if new_size < 1 or new_size > self.cons_manager.max_aligners:
+            return
+        if self.pool_direction > 0 and (trainer_utilization > 0.9 or
+                                        (known is not None and known[0] < throughput * 1.05)):
+            return
+        if self.pool_direction < 0 and known is not None and known[0] < throughput * 0.95:
+            return
+
+        if self.pool_direction > 0:
+            self.start_aligner(min(set(range(1, size + 2)) - set(self.workers)))
+        else:
+            self.stop_aligner()
+        self.pool_settling = True
+        metrics.increment('aligner_pool_resizes')
+        print '\n Aligner pool resized to: ' + str(new_size)
+
+    def write_stream_part(self):
+        if self.stream_interval is None or len(self.stream_alignments) == 0:
+            return
+        # Renamed when complete, the trainer loads a part once it exists
+        path = get_alignment_part_path(self.cons_manager.path_to_alignments, self.stream_parts)
+        with bz2.BZ2File(path + '.tmp', 'w') as part_file:
+            cPickle.dump(self.stream_alignments, part_file)
+        os.rename(path + '.tmp', path)
+        self.stream_alignments = {}
+        self.stream_parts += 1
+
+    def run_new_alignments(self, inputs):
+        """
+        Aligns all sequences with the aligner pool and writes the alignments to cons_manager.path_to_alignments. Only
+        the sequence indices go to the aligners, they read the inputs from cons_manager.path_to_inputs themselves.
+        :param inputs: Inputs of shape [max_time, amount, input_dimensions] (Time major), as saved in
+        cons_manager.path_to_inputs (e.g. memory mapped), for the keys of the alignments.
+        """
+        self.inputs = inputs
         batch_size = inputs.shape[1]
         i = 0
         init_time = time.time()
         temp_debug_time = time.time()
-
-        # Debugging
-        process_data = []
-        for p in self.processes:
-            process_data.append(psutil.Process(p.pid))
+        adapt_time = time.time()
+        stream_time = time.time()
 
         # Run for the whole inputs
         while i < batch_size:
             # Send new data out
             if self.input_queue.full() is False:
-                self.input_queue.put(obj=(
-                        np.reshape(inputs[:, i, :], newshape=(-1, 1, self.cons_manager.input_dimensions)),
-                        targets[i]))
-                self.alignment_dic[inputs[:, i, :].tostring()] = None
+                self.input_queue.put(obj=i)
+                self.alignment_dic[i] = None
                 i += 1
             # Receive new data
             self.retrieve_new_alignments()
+            if self.stream_interval is not None and time.time() - stream_time > self.stream_interval:
+                self.write_stream_part()
+                stream_time = time.time()
 
             # Monitoring
             if time.time() - temp_debug_time > 2:
                 mem_usage = 0
                 temp_debug_time = time.time()
-                for p in process_data:
-                    mem_usage += p.memory_info().rss
-                for p in self.processes:
-                    f = open('/proc/{pid}/stat'.format(pid=str(p.pid)), 'rb')
-                    print '\n Process running on core: ' + str(f.read().split(' ')[-14])
-                    f.close()
+                for p, _ in self.workers.values():
+                    try:
+                        mem_usage += psutil.Process(p.pid).memory_info().rss
+                        f = open('/proc/{pid}/stat'.format(pid=str(p.pid)), 'rb')
+                        print '\n Process running on core: ' + str(f.read().split(' ')[-14])
+                        f.close()
+                    except (psutil.NoSuchProcess, IOError):
+                        pass  # Stopped in the meantime
 
                 mem_usage = float(mem_usage)/(1024 * 1024 * 1024) * 10
                 sys.stdout.write(
                     '\n Progress: {0:02.3f}% / Time running: {1:08d} / Memory Usage: {2:.3f}G / Amount of child processes: {3:02d} / Size of dic: {4: 010d}  '.format(
-                        float(i) / batch_size * 100, int(time.time() - init_time), mem_usage, len(self.processes), sys.getsizeof(self.alignment_dic)))
+                        float(i) / batch_size * 100, int(time.time() - init_time), mem_usage, len(self.workers), sys.getsizeof(self.alignment_dic)))
                 sys.stdout.flush()
 
-        # Wait for cleanup:
-        time.sleep(5)  # Give another 5 seconds to clean up
-        while self.input_queue.empty() is False:
+            # Pool sizing
+            if time.time() - adapt_time > self.cons_manager.aligner_adapt_interval:
+                self.adapt_pool(time.time() - adapt_time)
+                adapt_time = time.time()
+                if metrics.is_enabled():
+                    metrics.export(metrics.get_process_path(self.cons_manager.path_to_metrics, 'aligner_manager'))
+
+        # Wait for cleanup: workers exit once the queue is empty, after handing in their last alignments
+        while self.input_queue.empty() is False or any([p.is_alive() for p in self.processes]):
             self.retrieve_new_alignments()
+            if self.stream_interval is not None and time.time() - stream_time > self.stream_interval:
+                self.write_stream_part()
+                stream_time = time.time()
+            time.sleep(0.1)
+        self.retrieve_new_alignments()
+        self.write_stream_part()
 
         # Finally process results into new dictionary
 
         save_dic = {}  # Now: key = inputs.tostring, value = alignment
-        for key in self.alignment_dic:
+        for index in self.alignment_dic:
             # In case of errors
-            if self.alignment_dic[key] is not None:
-                save_dic[key] = self.alignment_dic[key]
+            if self.alignment_dic[index] is not None:
+                save_dic[inputs[:, index, :].tostring()] = self.alignment_dic[index]
         print 'Size of save dic: ' + str(sys.getsizeof(self.alignment_dic))
 
         with bz2.BZ2File(self.cons_manager.path_to_alignments, 'w') as file_alignments:
@@ -325,8 +532,11 @@ class AlignerManager(object):
 
     def retrieve_new_alignments(self):
         while self.output_queue.empty() is False:
-            (inputs_hash, alignment) = self.output_queue.get()
-            self.alignment_dic[inputs_hash] = alignment
+            (index, alignment, worker_index) = self.output_queue.get()
+            self.alignment_dic[index] = alignment
+            if self.stream_interval is not None:
+                self.stream_alignments[self.inputs[:, index, :].tostring()] = alignment
+            self.window_alignments[worker_index] = self.window_alignments.get(worker_index, 0) + 1.0
 
 
 def main():
@@ -337,13 +547,27 @@ def main():
     cons_man_file.close()
 
     # Make alignment manager
-    align_manager = AlignerManager(cons_manager)
-    align_manager.start_aligners()
-
-    # Load inputs and targets
-    inputs = np.load(cons_manager.path_to_inputs)
+    trainer_pid = int(sys.argv[2]) if len(sys.argv) >= 3 else None
+    # Streams the alignments in parts every n seconds, while the trainer keeps running
+    stream_interval = float(sys.argv[3]) if len(sys.argv) >= 4 else None
+    if cons_manager.path_to_metrics is not None:
+        metrics.enable(process='aligner_manager')
+
+    # Load inputs and targets, the inputs are memory mapped (the aligners map the same file)
+    inputs = np.load(cons_manager.path_to_inputs, mmap_mode='r')
     targets = np.load(cons_manager.path_to_targets).tolist()
-    align_manager.run_new_alignments(inputs, targets)
+    # The banded search starts from the alignments of the previous realignment
+    prior_alignments = None
+    if cons_manager.alignment_band > 0 and os.path.isfile(cons_manager.path_to_alignments):
+        with bz2.BZ2File(cons_manager.path_to_alignments, 'r') as prior_file:
+            prior_dic = cPickle.load(prior_file)
+        prior_alignments = [prior_dic.get(inputs[:, i, :].tostring()) for i in range(inputs.shape[1])]
+
+    # The aligners get the targets & prior alignments when they start, afterwards only sequence indices
+    align_manager = AlignerManager(cons_manager, targets, prior_alignments=prior_alignments, trainer_pid=trainer_pid,
+                                   stream_interval=stream_interval)
+    align_manager.start_aligners()
+    align_manager.run_new_alignments(inputs)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,155 @@
+import json
+import os
+import time
+
+# Named timers, counters & gauges for the hot paths (alignment, training step, aligner queues). Everything is kept per
+# process in this module. Until enable() is called all calls return right away, so the instrumentation stays in place
+# at close to no cost. export() writes Prometheus text format (for the node exporter textfile collector) or JSON.
+
+_enabled = False
+_labels = {}
+_timers = {}  # name -> [count, total seconds]
+_counters = {}
+_gauges = {}
+
+
+def enable(**labels):
+    """
+    Starts collecting metrics in this process.
+    :param labels: Constant labels added to every exported metric (e.g. process='aligner_1').
+    """
+    global _enabled, _labels
+    _enabled = True
+    _labels = labels
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    _timers.clear()
+    _counters.clear()
+    _gauges.clear()
+
+
+def increment(name, amount=1):
+    if _enabled:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def set_gauge(name, value):
+    if _enabled:
+        _gauges[name] = value
+
+
+def add_time(name, seconds):
+    if _enabled:
+        timer_value = _timers.setdefault(name, [0, 0.0])
+        timer_value[0] += 1
+        timer_value[1] += seconds
+
+
+class _Timer(object):
+    def __init__(self, name):
+        self.name = name
+        self.init_time = 0
+
+    def __enter__(self):
+        self.init_time = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        add_time(self.name, time.time() - self.init_time)
+
+
+class _NoTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+_NO_TIMER = _NoTimer()
+
+
+def timer(name):
+    """
+    Times a with block, e.g. "with metrics.timer('alignment_session_run'): session.run(...)".
+    :param name: Name of the timer.
+    :return: Context manager.
+    """
+    if _enabled:
+        return _Timer(name)
+    return _NO_TIMER
+
+
+def get_snapshot():
+    return {'labels': dict(_labels),
+            'timers': dict([(name, {'count': v[0], 'seconds': v[1]}) for name, v in _timers.items()]),
+            'counters': dict(_counters),
+            'gauges': dict(_gauges)}
+
+
+def get_timer_summary():
+    """
+    :return: Console summary of the timers, one line per timer: count, total & mean seconds.
+    """
+    return '\n'.join(['{0}: {1} / {2:.3f}s / mean {3:.4f}s'.format(name, _timers[name][0], _timers[name][1],
+                                                                  _timers[name][1] / max(_timers[name][0], 1))
+                      for name in sorted(_timers)])
+
+
+def get_prometheus_text(prefix='neural_transducer'):
+    """
+    :param prefix: Prefix of every metric name.
+    :return: All metrics in Prometheus text format. Timers become summaries (_seconds_sum & _seconds_count).
+    """
+    labels = ','.join(['{0}="{1}"'.format(k, str(v).replace('"', '\\"')) for k, v in sorted(_labels.items())])
+    labels = '{' + labels + '}' if labels != '' else ''
+    lines = []
+    for name in sorted(_timers):
+        metric = prefix + '_' + name + '_seconds'
+        lines.append('# TYPE ' + metric + ' summary')
+        lines.append(metric + '_sum' + labels + ' ' + repr(_timers[name][1]))
+        lines.append(metric + '_count' + labels + ' ' + str(_timers[name][0]))
+    for name in sorted(_counters):
+        metric = prefix + '_' + name + '_total'
+        lines.append('# TYPE ' + metric + ' counter')
+        lines.append(metric + labels + ' ' + str(_counters[name]))
+    for name in sorted(_gauges):
+        metric = prefix + '_' + name
+        lines.append('# TYPE ' + metric + ' gauge')
+        lines.append(metric + labels + ' ' + str(_gauges[name]))
+    return '\n'.join(lines) + '\n'
+
+
+def get_process_path(path, process_name):
+    """
+    :return: Metrics path for another process, e.g. metrics.prom -> metrics.aligner_1.prom
+    """
+    root, extension = os.path.splitext(path)
+    return root + '.' + process_name + extension
+
+
+def export(path):
+    """
+    Writes all metrics of this process, as JSON if the path ends with .json, otherwise in Prometheus text format.
+    The file is replaced atomically, so readers never see a partial file.
+    :param path: Path of the metrics file.
+    """
+    if not _enabled:
+        return
+    temp_path = path + '.tmp' + str(os.getpid())
+    with open(temp_path, 'w') as f:
+        if path.endswith('.json'):
+            json.dump(get_snapshot(), f, indent=2, sort_keys=True)
+        else:
+            f.write(get_prometheus_text())
+    os.rename(temp_path, path)
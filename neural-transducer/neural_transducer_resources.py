@@ -0,0 +1,93 @@
+import tensorflow as tf
+import psutil
+
+# Splits the cores of a node between the trainer and the aligner processes. Every process is pinned to its own cores
+# and sizes its TF thread pools to them, instead of every process using max_cores threads on all cores.
+
+
+def get_available_cores():
+    """
+    :return: Sorted list of the cores this process may run on.
+    """
+    process = psutil.Process()
+    if hasattr(process, 'cpu_affinity'):
+        return sorted(process.cpu_affinity())
+    return range(psutil.cpu_count())
+
+
+def get_core_plan(amount_of_aligners, trainer_cores=None, available_cores=None):
+    """
+    Assigns cores to the trainer and the aligners. The trainer gets a contiguous block of cores first, the remaining
+    cores are split as evenly as possible among the aligners. With fewer remaining cores than aligners, aligners share
+    cores.
+    :param amount_of_aligners: Amount of aligner processes.
+    :param trainer_cores: Amount of cores for the trainer, default is one core per aligner and the rest for the trainer,
+    but at least half of the cores.
+    :param available_cores: List of cores to plan with, default are the cores this process may run on.
+    :return: Dictionary with the cores of the 'trainer' (list) & the 'aligners' (list of lists, one per aligner).
+    """
+    if available_cores is None:
+        available_cores = get_available_cores()
+    if trainer_cores is None:
+        trainer_cores = max(len(available_cores) // 2, len(available_cores) - amount_of_aligners)
+    trainer_cores = max(1, min(trainer_cores, len(available_cores) - (1 if amount_of_aligners > 0 else 0)))
+
+    trainer = available_cores[0:trainer_cores]
+    remaining = available_cores[trainer_cores:]
+    if len(remaining) == 0:
+        remaining = available_cores
+
+    aligners = []
+    if amount_of_aligners > 0:
+        if len(remaining) >= amount_of_aligners:
+            # Contiguous blocks, the first ones get one core more if it doesn't divide evenly
+            per_aligner, extra = divmod(len(remaining), amount_of_aligners)
+            start = 0
+            for i in range(amount_of_aligners):
+                amount = per_aligner + (1 if i < extra else 0)
+                aligners.append(remaining[start:start + amount])
+                start += amount
+        else:
+            aligners = [[remaining[i % len(remaining)]] for i in range(amount_of_aligners)]
+
+    return {'trainer': trainer, 'aligners': aligners}
+
+
+def describe_core_plan(core_plan):
+    """
+    :return: Human readable layout of the plan, one line per process.
+    """
+    lines = ['Trainer: cores ' + str(core_plan['trainer']) + ' (' + str(len(core_plan['trainer'])) + ' threads)']
+    for i in range(len(core_plan['aligners'])):
+        cores = core_plan['aligners'][i]
+        lines.append('Aligner ' + str(i + 1) + ': cores ' + str(cores) + ' (' + str(len(cores)) + ' threads)')
+    used = core_plan['trainer'] + [c for cores in core_plan['aligners'] for c in cores]
+    if len(used) != len(set(used)):
+        lines.append('Warning: processes share cores, consider fewer aligners')
+    return '\n'.join(lines)
+
+
+def pin_to_cores(cores):
+    """
+    Sets the OS CPU affinity of this process (if the platform supports it).
+    :param cores: List of cores.
+    """
+    process = psutil.Process()
+    if hasattr(process, 'cpu_affinity'):
+        process.cpu_affinity(list(cores))
+
+
+def get_session_config(cons_manager, cores):
+    """
+    Session config with thread pools sized to the cores of this process.
+    :param cons_manager: The constants manager.
+    :param cores: List of cores this process is pinned to.
+    :return: The ConfigProto.
+    """
+    config = tf.ConfigProto(allow_soft_placement=cons_manager.device_soft_placement,
+                            log_device_placement=cons_manager.debug_devices,
+                            device_count={'CPU': len(cores)},
+                            inter_op_parallelism_threads=len(cores),
+                            intra_op_parallelism_threads=len(cores))
+    config.gpu_options.allow_growth = True
+    return config
@@ -0,0 +1,116 @@
+import numpy as np
+
+# Levenshtein based scoring (CER/WER) for whole batches of hypotheses and references.
+# The dynamic programming table is filled one anti-diagonal at a time, vectorized over the batch and the diagonal,
+# so scoring needs O(max_hyp_length + max_ref_length) numpy operations per batch instead of per line python loops.
+
+
+def pad_sequences(sequences, pad_value=-1):
+    """
+    Turns a list of id sequences into a padded matrix.
+    :param sequences: List of lists (or 1D arrays) of ids.
+    :param pad_value: Value to pad with, should not be a valid id.
+    :return: Matrix of shape [amount, max_length] and lengths of shape [amount]
+    """
+    lengths = np.asarray([len(s) for s in sequences], dtype=np.int32)
+    padded = np.full((len(sequences), max([1] + lengths.tolist())), pad_value, dtype=np.int64)
+    for i in range(len(sequences)):
+        padded[i, 0:lengths[i]] = sequences[i]
+    return padded, lengths
+
+
+def remove_ids(sequences, ids):
+    """
+    Removes ids that aren't scored (e.g. the one of the padding letter) from every sequence.
+    :param sequences: List of id sequences.
+    :param ids: The ids to remove.
+    :return: List of lists of ids.
+    """
+    return [[x for x in s if x not in ids] for s in sequences]
+
+
+def edit_distances(hypotheses, references):
+    """
+    Computes the Levenshtein distance of every hypothesis to its reference.
+    :param hypotheses: List of id sequences.
+    :param references: List of id sequences, same amount as hypotheses.
+    :return: Array of shape [amount] with the amount of substitutions, insertions and deletions per line.
+    """
+    assert len(hypotheses) == len(references), 'Amount of hypotheses not equal to amount of references!'
+    if len(hypotheses) == 0:
+        return np.zeros(0, dtype=np.int32)
+
+    hyp, hyp_lengths = pad_sequences(hypotheses, pad_value=-1)
+    ref, ref_lengths = pad_sequences(references, pad_value=-2)
+    n = hyp.shape[1]
+    m = ref.shape[1]
+
+    # table[:, i, j] = distance between hyp[:, :i] and ref[:, :j]
+    table = np.zeros((len(hypotheses), n + 1, m + 1), dtype=np.int32)
+    table[:, :, 0] = np.arange(n + 1)
+    table[:, 0, :] = np.arange(m + 1)
+
+    # Every cell on diagonal d = i + j only depends on the two previous diagonals
+    for d in range(2, n + m + 1):
+        i = np.arange(max(1, d - m), min(n, d - 1) + 1)
+        j = d - i
+        substitution = table[:, i - 1, j - 1] + (hyp[:, i - 1] != ref[:, j - 1])
+        deletion = table[:, i - 1, j] + 1
+        insertion = table[:, i, j - 1] + 1
+        table[:, i, j] = np.minimum(substitution, np.minimum(deletion, insertion))
+
+    # Padding only influences cells outside of the true lengths
+    return table[np.arange(len(hypotheses)), hyp_lengths, ref_lengths]
+
+
+def character_error_rate(hypotheses, references):
+    """
+    CER over a batch of lines.
+    :param hypotheses: List of id sequences.
+    :param references: List of id sequences.
+    :return: CER over all lines (total errors / total reference length) and the errors per line.
+    """
+    errors = edit_distances(hypotheses, references)
+    total_length = sum([len(r) for r in references])
+    return float(errors.sum()) / max(total_length, 1), errors
+
+
+def split_words(sequence, separator):
+    """
+    Splits an id sequence into words.
+    :param sequence: List of ids.
+    :param separator: The id separating words (e.g. the id of the space character).
+    :return: List of words, each a tuple of ids. Empty words (repeated separators) are dropped.
+    """
+    words = []
+    word = []
+    for x in sequence:
+        if x == separator:
+            if len(word) > 0:
+                words.append(tuple(word))
+            word = []
+        else:
+            word.append(x)
+    if len(word) > 0:
+        words.append(tuple(word))
+    return words
+
+
+def word_error_rate(hypotheses, references, separator):
+    """
+    WER over a batch of lines. Words are mapped to ids and scored with the same edit distance as the characters.
+    :param hypotheses: List of id sequences.
+    :param references: List of id sequences.
+    :param separator: The id separating words (e.g. the id of the space character).
+    :return: WER over all lines (total word errors / total reference words) and the word errors per line.
+    """
+    word_ids = {}
+
+    def to_word_ids(sequence):
+        return [word_ids.setdefault(w, len(word_ids)) for w in split_words(sequence, separator)]
+
+    hyp_words = [to_word_ids(h) for h in hypotheses]
+    ref_words = [to_word_ids(r) for r in references]
+    errors = edit_distances(hyp_words, ref_words)
+    total_length = sum([len(r) for r in ref_words])
+    return float(errors.sum()) / max(total_length, 1), errors
@@ -0,0 +1,129 @@
+from tensorflow.python.client import timeline
+import tensorflow as tf
+import os
+import re
+
+# Opt-in op level tracing of the session runs on the hot paths (training step, alignment). Every n-th run of each
+# kind is run with a full trace: its Chrome trace (open in chrome://tracing) is written to the trace directory and its
+# op timings are added to a summary over all traced runs. Untraced runs go straight to session.run.
+
+_enabled = False
+_path = None
+_prefix = ''
+_every_n = 100
+_max_traces = 10
+_runs = {}  # name -> amount of runs
+_traces = {}  # name -> amount of traces written
+_traced = {}  # name -> amount of traced runs
+_op_stats = {}  # (name, node name) -> [op type, count, total micros]
+
+
+def enable(path, every_n=100, max_traces=10, prefix=''):
+    """
+    Starts tracing in this process.
+    :param path: Directory for the Chrome traces and the op summary.
+    :param every_n: Trace every n-th run of each kind (the first run is skipped, as it includes the warm up).
+    :param max_traces: Maximum amount of Chrome traces written per kind, op timings are aggregated for all traces.
+    :param prefix: Prefix for the files of this process (e.g. 'aligner_1_').
+    """
+    global _enabled, _path, _every_n, _max_traces, _prefix
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    _enabled = True
+    _path = path
+    _every_n = every_n
+    _max_traces = max_traces
+    _prefix = prefix
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def run(session, fetches, feed_dict, name):
+    """
+    Drop in replacement for session.run, which traces a sample of the runs.
+    :param session: The session.
+    :param fetches: Fetches of session.run.
+    :param feed_dict: Feed dictionary of session.run.
+    :param name: Kind of the run (e.g. 'training_step'), sampling & summaries are per kind.
+    :return: Result of session.run.
+    """
+    if not _enabled:
+        return session.run(fetches, feed_dict=feed_dict)
+
+    run_index = _runs.get(name, 0)
+    _runs[name] = run_index + 1
+    if run_index == 0 or run_index % _every_n != 0:
+        return session.run(fetches, feed_dict=feed_dict)
+
+    run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+    run_metadata = tf.RunMetadata()
+    result = session.run(fetches, feed_dict=feed_dict, options=run_options, run_metadata=run_metadata)
+    _traced[name] = _traced.get(name, 0) + 1
+
+    add_step_stats(name, run_metadata.step_stats)
+    if _traces.get(name, 0) < _max_traces:
+        _traces[name] = _traces.get(name, 0) + 1
+        trace = timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format()
+        with open(os.path.join(_path, _prefix + name + '_' + str(run_index) + '.json'), 'w') as f:
+            f.write(trace)
+    return result
+
+
+def add_step_stats(name, step_stats):
+    """
+    Adds the op timings of one traced run to the summary.
+    :param name: Kind of the run.
+    :param step_stats: StepStats of the RunMetadata.
+    """
+    for device_stats in step_stats.dev_stats:
+        # Skip the duplicated stream timings of GPUs, keep the op timings of the device itself
+        if '/stream:' in device_stats.device:
+            continue
+        for node_stats in device_stats.node_stats:
+            # Labels look like "node_name = OpType(inputs)"
+            match = re.match(r'.* = ([^(]*)\(', node_stats.timeline_label)
+            op_type = match.group(1) if match else node_stats.node_name
+            stats = _op_stats.setdefault((name, node_stats.node_name), [op_type, 0, 0])
+            stats[1] += 1
+            stats[2] += node_stats.all_end_rel_micros
+
+
+def get_summary(name):
+    """
+    :param name: Kind of the run.
+    :return: List of (node name, op type, count, total micros) sorted by total time, and per op type the total micros.
+    """
+    nodes = [(node, stats[0], stats[1], stats[2]) for (kind, node), stats in _op_stats.items() if kind == name]
+    nodes.sort(key=lambda x: -x[3])
+    op_types = {}
+    for node in nodes:
+        op_types[node[1]] = op_types.get(node[1], 0) + node[3]
+    return nodes, op_types
+
+
+def export_summary():
+    """
+    Writes the aggregated op timings of every kind as tab separated file <prefix><name>_op_summary.txt, slowest first.
+    """
+    if not _enabled:
+        return
+    for name in set([kind for kind, _ in _op_stats]):
+        nodes, op_types = get_summary(name)
+        total = max(sum([node[3] for node in nodes]), 1)
+        with open(os.path.join(_path, _prefix + name + '_op_summary.txt'), 'w') as f:
+            f.write('Traced runs: ' + str(_traced.get(name, 0)) + '\n\n')
+            f.write('op_type\ttotal_ms\tshare\n')
+            for op_type, micros in sorted(op_types.items(), key=lambda x: -x[1]):
+                f.write('{0}\t{1:.3f}\t{2:.4f}\n'.format(op_type, micros / 1000.0, float(micros) / total))
+            f.write('\nnode\top_type\tcount\ttotal_ms\tmean_ms\tshare\n')
+            for node, op_type, count, micros in nodes:
+                f.write('{0}\t{1}\t{2}\t{3:.3f}\t{4:.3f}\t{5:.4f}\n'.format(node, op_type, count, micros / 1000.0,
+                                                                          micros / 1000.0 / count,
+                                                                          float(micros) / total))
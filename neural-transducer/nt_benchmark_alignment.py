@@ -0,0 +1,124 @@
+from neural_transducer import Model
+from neural_transducer_benchmarks import get_preset_constants_manager, get_session_config, get_synthetic_sequence, \
+    get_latency_stats, get_run_info, write_results, compare_to_baseline, quiet
+import neural_transducer_metrics as metrics
+import tensorflow as tf
+import numpy as np
+import sys
+import time
+
+# USAGE:
+# Param 1: Preset of the model (tiny/small/rimes, see neural_transducer_benchmarks.py)
+# Param 2: Path of the JSON results file to write (e.g. ./benchmarks/alignment/tiny.json)
+# Param 3 (optional): Repetitions per measurement, default is 3
+# Param 4 (optional): JSON results of a previous run, exits with 1 if any measurement is over 20% slower
+
+# Times the alignment functions of a randomly initialized model over synthetic sequences.
+
+AMOUNT_OF_BLOCKS = [1, 2, 4, 8]
+TARGETS_PER_BLOCK = [1, 3]
+BEAM_WIDTH = 3
+BAND = 1
+
+
+def get_logits(session, model, inputs):
+    """
+    Runs the transducer with max width in every block, like the direct logit training does.
+    :return: Logits of shape [transducer_max_width * amount_of_blocks, vocab_size]
+    """
+    cons_manager = model.cons_manager
+    amount_of_blocks = inputs.shape[0] / cons_manager.input_block_size
+    logits = session.run(model.logits, feed_dict={
+        model.max_blocks: amount_of_blocks,
+        model.inputs_full_raw: inputs,
+        model.transducer_list_outputs: [[cons_manager.transducer_max_width]] * amount_of_blocks,
+        model.start_block: 0,
+        model.encoder_hidden_init_fw: np.zeros(shape=(cons_manager.encoder_hidden_layers, 2, 1,
+                                                      cons_manager.encoder_hidden_units)),
+        model.encoder_hidden_init_bw: np.zeros(shape=(cons_manager.encoder_hidden_layers, 2, 1,
+                                                      cons_manager.encoder_hidden_units)),
+        model.trans_hidden_init: np.zeros(shape=(2, 1, cons_manager.transducer_hidden_units)),
+        model.inference_mode: 1.0,
+        model.teacher_forcing_targets: np.ones([cons_manager.transducer_max_width * amount_of_blocks, 1]) *
+                                       cons_manager.GO_SYMBOL,
+    })
+    return logits[:, 0, :]
+
+
+def main():
+    preset = sys.argv[1]
+    path_to_results = sys.argv[2]
+    repetitions = int(sys.argv[3]) if len(sys.argv) >= 4 else 3
+
+    np.random.seed(42)
+    tf.set_random_seed(42)
+
+    cons_manager = get_preset_constants_manager(preset)
+    with tf.device(cons_manager.device_to_run):
+        model = Model(cons_manager=cons_manager, objective=None)
+    init = tf.global_variables_initializer()
+
+    # The session run time of the aligners comes from their metrics timer
+    metrics.enable()
+    results = []
+    with tf.Session(config=get_session_config(cons_manager)) as sess:
+        sess.run(init)
+
+        for amount_of_blocks in AMOUNT_OF_BLOCKS:
+            for targets_per_block in TARGETS_PER_BLOCK:
+                # The logit aligner needs one step per block for <e>
+                target_length = min(targets_per_block, cons_manager.transducer_max_width - 1) * amount_of_blocks
+                inputs, targets = get_synthetic_sequence(cons_manager, amount_of_blocks, target_length)
+                targets = targets[0]
+                logits = get_logits(sess, model, inputs)
+
+                functions = [
+                    ('get_alignment', lambda: model.get_alignment(sess, inputs, targets, cons_manager.input_block_size,
+                                                                  cons_manager.transducer_max_width)),
+                    ('get_alignment_greedy', lambda: model.get_alignment_greedy(sess, inputs, targets,
+                                                                                cons_manager.input_block_size,
+                                                                                cons_manager.transducer_max_width)),
+                    ('get_alignment_beam_' + str(BEAM_WIDTH), lambda: model.get_alignment(
+                        sess, inputs, targets, cons_manager.input_block_size, cons_manager.transducer_max_width,
+                        beam_width=BEAM_WIDTH)),
+                    ('get_alignment_band_' + str(BAND), lambda: model.get_alignment(
+                        sess, inputs, targets, cons_manager.input_block_size, cons_manager.transducer_max_width,
+                        band=BAND)),
+                    ('get_alignment_from_logits', lambda: model.get_alignment_from_logits(
+                        logits, np.asarray(targets), amount_of_blocks, cons_manager.transducer_max_width)),
+                ]
+
+                for name, function in functions:
+                    with quiet():
+                        function()  # Warm up
+                    times = []
+                    transducer_times = []
+                    for _ in range(repetitions):
+                        metrics.reset()
+                        init_time = time.time()
+                        with quiet():
+                            function()
+                        times.append(time.time() - init_time)
+                        transducer_times.append(metrics.get_snapshot()['timers'].get('alignment_session_run',
+                                                                                      {'seconds': 0.0})['seconds'])
+
+                    result = get_latency_stats(times)
+                    result.update({'function': name, 'blocks': amount_of_blocks, 'target_length': target_length,
+                                   'sequences_per_second': 1.0 / max(result['p50_s'], 1e-12)})
+                    if name != 'get_alignment_from_logits':
+                        result['transducer_time_s'] = float(np.median(transducer_times))
+                    results.append(result)
+                    print name + ' / Blocks: ' + str(amount_of_blocks) + ' / Target length: ' + \
+                        str(target_length) + ' / p50: ' + '{0:.4f}s'.format(result['p50_s'])
+
+    write_results(path_to_results, get_run_info(cons_manager, preset), results)
+
+    if len(sys.argv) >= 5:
+        regressions = compare_to_baseline(results, sys.argv[4], ['function', 'blocks', 'target_length'])
+        if len(regressions) > 0:
+            print 'Regressions: ' + str(regressions)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+from neural_transducer import Model, DataManager
+from neural_transducer_benchmarks import get_preset_constants_manager, get_session_config, get_synthetic_sequence, \
+    get_synthetic_alignment, get_latency_stats, get_run_info, write_results, compare_to_baseline, quiet, PRESETS
+import tensorflow as tf
+import numpy as np
+import cPickle
+import bz2
+import sys
+
+# USAGE:
+# Param 1: Preset of the model (tiny/small/rimes, see neural_transducer_benchmarks.py)
+# Param 2: Path of the JSON results file to write (e.g. ./benchmarks/rimes_training/training_step.json)
+# Param 3 (optional): Batch sizes, comma separated (e.g. 1,4,8), default is 1,4
+# Param 4 (optional): Encoder depths, comma separated (e.g. 1,3), default is the depth of the preset
+# Param 5 (optional): Input block sizes, comma separated (e.g. 50,100), default is the block size of the preset
+# Param 6 (optional): Training steps per configuration, default is 10
+# Param 7 (optional): JSON results of a previous run, exits with 1 if any configuration is over 20% slower ('none' to
+# skip the comparison)
+# Param 8 (optional): Cell backends, comma separated (e.g. lstm,lstm_block,lstm_block_fused), default is lstm
+
+# Times apply_training_step over synthetic RIMES shaped sequences with precomputed alignments, broken down into
+# sampling, target construction, feed construction and session.run.
+
+PHASES = ['sampling', 'targets', 'feed', 'run']
+
+
+def parse_list(argument, default):
+    if argument is None:
+        return default
+    return [int(x) for x in argument.split(',')]
+
+
+def run_configuration(preset, batch_size, encoder_hidden_layers, input_block_size, steps, cell_backend='lstm'):
+    """
+    Builds a fresh model for one configuration and times its training steps.
+    :return: Dictionary with the latency stats of the full step and of each phase, and the sequences per second.
+    """
+    tf.reset_default_graph()
+    np.random.seed(42)
+    tf.set_random_seed(42)
+
+    cons_manager = get_preset_constants_manager(preset, encoder_hidden_layers=encoder_hidden_layers,
+                                                input_block_size=input_block_size, cell_backend=cell_backend)
+    amount_of_blocks = int(np.ceil(PRESETS[preset]['input_length'] / float(input_block_size)))
+    target_length = min(PRESETS[preset]['target_length'], amount_of_blocks * (cons_manager.transducer_max_width - 1))
+
+    with tf.device(cons_manager.device_to_run):
+        model = Model(cons_manager=cons_manager)
+    init = tf.global_variables_initializer()
+
+    # All sequences of a batch have the same amount of blocks, as in nt_rimes.py after cutting to 300
+    inputs, targets = get_synthetic_sequence(cons_manager, amount_of_blocks, target_length,
+                                             batch_size=max(2 * batch_size, 8))
+
+    timings = dict([(phase, []) for phase in PHASES])
+    totals = []
+    with tf.Session(config=get_session_config(cons_manager)) as sess:
+        sess.run(init)
+
+        with quiet():
+            data_manager = DataManager(cons_manager, full_inputs=inputs, full_targets=targets, model=model,
+                                       session=sess, online_alignments=False)
+
+            # Alignments go through the same file the aligners write
+            alignments = dict([(inputs[:, i, :].tostring(), get_synthetic_alignment(target_length, amount_of_blocks))
+                               for i in range(inputs.shape[1])])
+            with bz2.BZ2File(cons_manager.path_to_alignments, 'w') as al_file:
+                cPickle.dump(alignments, al_file)
+            data_manager.load_in_alignments()
+
+            model.apply_training_step(session=sess, batch_size=batch_size, data_manager=data_manager)  # Warm up
+            for _ in range(steps):
+                step_timings = {}
+                model.apply_training_step(session=sess, batch_size=batch_size, data_manager=data_manager,
+                                          timings=step_timings)
+                for phase in PHASES:
+                    timings[phase].append(step_timings[phase])
+                totals.append(sum(step_timings.values()))
+
+    result = get_latency_stats(totals)
+    result.update({'batch_size': batch_size, 'encoder_hidden_layers': encoder_hidden_layers, 'cell_backend': cell_backend,
+                   'input_block_size': input_block_size, 'blocks': amount_of_blocks, 'target_length': target_length,
+                   'sequences_per_second': batch_size / max(result['p50_s'], 1e-12),
+                   'phases': dict([(phase, get_latency_stats(timings[phase])) for phase in PHASES])})
+    return result
+
+
+def main():
+    preset = sys.argv[1]
+    path_to_results = sys.argv[2]
+    batch_sizes = parse_list(sys.argv[3] if len(sys.argv) >= 4 else None, [1, 4])
+    encoder_depths = parse_list(sys.argv[4] if len(sys.argv) >= 5 else None,
+                                [PRESETS[preset]['encoder_hidden_layers']])
+    block_sizes = parse_list(sys.argv[5] if len(sys.argv) >= 6 else None, [PRESETS[preset]['input_block_size']])
+    steps = int(sys.argv[6]) if len(sys.argv) >= 7 else 10
+    cell_backends = sys.argv[8].split(',') if len(sys.argv) >= 9 else ['lstm']
+
+    results = []
+    for cell_backend in cell_backends:
+        for encoder_hidden_layers in encoder_depths:
+            for input_block_size in block_sizes:
+                for batch_size in batch_sizes:
+                    result = run_configuration(preset, batch_size, encoder_hidden_layers, input_block_size, steps,
+                                               cell_backend)
+                    results.append(result)
+                    print 'Cell backend: ' + cell_backend + ' / Batch size: ' + str(batch_size) + \
+                        ' / Encoder layers: ' + str(encoder_hidden_layers) + ' / Block size: ' + \
+                        str(input_block_size) + ' / p50: ' + '{0:.4f}s'.format(result['p50_s']) + \
+                        ' / p95: ' + '{0:.4f}s'.format(result['p95_s']) + \
+                        ' / Sequences per second: ' + '{0:.2f}'.format(result['sequences_per_second'])
+                    print '    ' + ' / '.join([phase + ': ' + '{0:.4f}s'.format(result['phases'][phase]['p50_s'])
+                                               for phase in PHASES])
+
+    # Sweep values are in the results, the info holds the preset
+    write_results(path_to_results, get_run_info(get_preset_constants_manager(preset), preset), results)
+
+    if len(sys.argv) >= 8 and sys.argv[7].lower() != 'none':
+        regressions = compare_to_baseline(results, sys.argv[7], ['cell_backend', 'batch_size',
+                                                                 'encoder_hidden_layers', 'input_block_size'])
+        if len(regressions) > 0:
+            print 'Regressions: ' + str(regressions)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
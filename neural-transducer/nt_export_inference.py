@@ -0,0 +1,26 @@
+from neural_transducer import freeze_inference_graph
+import tensorflow as tf
+import sys
+
+# USAGE:
+# Param 1: Path & Prefix of the checkpoint to export (e.g. ./checkpoint/2nd_full_run/rimes_2_full_rough_18360)
+# Param 2: Path of the frozen inference graph to write (e.g. ./rimes/rimes_inference.pb)
+
+# The frozen graph can then be loaded with InferenceManager.build_frozen_inference (nt_rimes_inference.py picks it
+# when given a .pb file).
+
+
+def main():
+    checkpoint_path = sys.argv[1]
+    export_path = sys.argv[2]
+
+    with tf.Graph().as_default():
+        with tf.Session() as sess:
+            # Restore the full training graph once, then strip it down
+            saver = tf.train.import_meta_graph(checkpoint_path + '.meta', clear_devices=True)
+            saver.restore(sess, checkpoint_path)
+            freeze_inference_graph(sess, export_path)
+
+
+if __name__ == '__main__':
+    main()
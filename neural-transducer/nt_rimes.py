@@ -1,5 +1,10 @@
 import os
-from neural_transducer import ConstantsManager, Model, DataManager
+from neural_transducer import ConstantsManager, Model, DataManager, InferenceManager
+from neural_transducer_scoring import character_error_rate, remove_ids
+import neural_transducer_metrics as metrics
+import neural_transducer_tracing as tracing
+from neural_transducer_resources import get_core_plan, describe_core_plan, pin_to_cores, get_session_config
+from nt_rimes_inference import load_rimes_data, save_alphabet
 import tensorflow as tf
 import numpy as np
 import dataset_loader
@@ -15,58 +20,68 @@ import datetime
 # Param 4: Max cores to use for TF (e.g. 5)
 # Param 5: Run offline alignments (True) or not (False)
 # Param 6: Path & Prefix of initial model load (e.g. ../model_800)
-# Param 7: Load in pre-computed alignments (True/False)
+# Param 7: Load in pre-computed alignments (True/False), or 'bootstrap' to start from approximate alignments of the
+# input frames while the model based ones run in the background
 # Param 8: Use greedy for online alignments (True/False)
+# Param 9 (optional): Validate on a held-out subset every n training steps (e.g. 100), 0 to disable (default)
+# Param 10 (optional): Path of a metrics file (Prometheus text format, or JSON if it ends with .json), written with
+# every checkpoint. Aligner processes write their own file next to it (e.g. metrics.aligner_1.prom)
+# Param 11 (optional): Directory for op level traces: every 100th session run of the training step and the alignments
+# is traced (Chrome trace) and summarized per op
+# Param 12 (optional): Cores for the trainer (e.g. 8), the other cores are split among the aligners. Every process is
+# pinned to its cores and sizes its thread pools to them (instead of Param 4 for every process)
+# Param 13 (optional): Maximum amount of aligners (e.g. 8). The aligner pool starts with Param 2 aligners and is resized
+# between 1 and this by measured alignment throughput
+# Param 14 (optional): LSTM backend: lstm (default), lstm_block or lstm_block_fused, checkpoints load with any of them
+# Param 15 (optional): Partial warm start from Param 6 (True/False, default False): only the variables found there are
+# loaded, e.g. after adding a layer
+# Param 16 (optional): Train in windows of this many blocks (e.g. 2), 0 trains on all blocks at once (default). With
+# windows the long sequences (300 and more in length) are kept, as memory no longer grows with the length
+# Param 17 (optional): Swap the activations of the training step to host memory (True/False, default False), for larger
+# batches on GPUs
+# Param 18 (optional): Beam width of the model based alignments (e.g. 4): only the most likely hypotheses are expanded
+# after each block, 0 searches all of them (default)
+# Param 19 (optional): Beam threshold of the model based alignments (e.g. 10.0): hypotheses with a log prob this much
+# below the best one are dropped, default is no threshold
+# Param 20 (optional): Band of the model based alignments (e.g. 2): only end positions within this many targets of the
+# previous alignment of a sequence are searched in each block, 0 searches all of them (default)
+# Param 21 (optional): Amount of online alignments to cache (e.g. 20000), 0 disables the cache (default)
+# Param 22 (optional): Training steps a cached online alignment is reused for (e.g. 500, default 50)
 
 # To make this work, put the RIMES 'train.0010' file into this directory
 
 
+def run_validation(session, inference_manager, inputs, targets, batch_size):
+    """
+    Decodes the validation inputs with the live session (batched greedy decoding) and scores them.
+    :param session: The training session.
+    :param inference_manager: Inference manager bound to the model being trained.
+    :param inputs: Validation inputs of shape [max_time, amount, input_dimensions] (Time major)
+    :param targets: Validation targets as list of lists of ids, without padding.
+    :param batch_size: Amount of sequences to decode at once.
+    :return: CER over the validation inputs.
+    """
+    vocab_ids = inference_manager.cons_manager.vocab_ids
+    pad_ids = [x for x in range(len(vocab_ids)) if vocab_ids[x] == '']
+    hypotheses = []
+    for start in range(0, inputs.shape[1], batch_size):
+        predict_ids, _ = inference_manager.run_inference_batch(session=session,
+                                                               full_inputs=inputs[:, start:start + batch_size, :],
+                                                               clean_e=True)
+        # The model emits the padding letter as well, it isn't scored (same as for the targets)
+        hypotheses += remove_ids(predict_ids, pad_ids)
+    cer, _ = character_error_rate(hypotheses, targets)
+    return cer
+
+
 def main():
 
     init_time_str = str(datetime.datetime.now())
     dir = os.path.dirname(os.path.realpath(__file__))
-    i = []
-    i_l = []
-    t = []
-    t_l = []
-
-    # We remove very long sequences (over 300 in length)
-    for iteration in range(1, 11):  # TODO: 11
-        print '/rimes/training-data/train.00{0:02d}'.format(iteration)
-        temp_i, temp_i_l, temp_t, temp_t_l = dataset_loader.load_from_file(
-            dir + '/rimes/training-data/train.00{0:02d}'.format(iteration),
-            max_length_input=502,
-            max_length_target=18)
-        # Remove all sequences above 300 length
-
-        to_remove = np.argwhere(temp_i_l >= 300)
-        if len(to_remove) > 0:
-            to_remove = to_remove[0]
-            print 'Removing: ' + str(to_remove)
-            temp_i = np.delete(temp_i, to_remove, axis=0)
-            temp_i_l = np.delete(temp_i_l, to_remove, axis=0)
-            temp_t = np.delete(temp_t, to_remove, axis=0)
-            temp_t_l = np.delete(temp_t_l, to_remove, axis=0)
-
-        i.append(temp_i)
-        i_l.append(temp_i_l)
-        t.append(temp_t)
-        t_l.append(temp_t_l)
-        """
-        print '\nShapes:'
-        print temp_i.shape
-        print temp_i_l.shape
-        print temp_t.shape
-        print temp_t_l.shape
-        """
+    training_window_blocks = int(sys.argv[16]) if len(sys.argv) >= 17 else 0
 
-    i = np.concatenate(i, axis=0)
-    i_l = np.concatenate(i_l, axis=0)
-    t = np.concatenate(t, axis=0)
-    t_l = np.concatenate(t_l, axis=0)
-
-    # Cut down to correct size
-    i = i[:, 0:300, :]
+    # Training in windows keeps the long sequences, padded to whole blocks (input_block_size is 100)
+    i, i_l, t, t_l = load_rimes_data('train', pad_to_blocks=100 if training_window_blocks > 0 else None)
 
     # Get size:
     print 'Size of inputs: ' + str(sys.getsizeof(i))
@@ -80,6 +95,34 @@ def main():
     bm = dataset_loader.BatchManager(i, i_l, t, t_l, pad='PAD')
     print bm.lookup
     print len(bm.lookup)
+    # Inference & evaluation map the ids back to letters with the same alphabet
+    save_alphabet(bm, dir + '/checkpoint/2nd_full_run/rimes_2_rough_fine')
+
+    # Held-out subset for validation during training, only letters known from training are usable
+    validation_interval = int(sys.argv[9]) if len(sys.argv) >= 10 else 0
+    path_to_metrics = sys.argv[10] if len(sys.argv) >= 11 else None
+    if path_to_metrics is not None:
+        metrics.enable(process='trainer')
+    path_to_traces = sys.argv[11] if len(sys.argv) >= 12 else None
+    max_aligners = int(sys.argv[13]) if len(sys.argv) >= 14 else None
+    cell_backend = sys.argv[14] if len(sys.argv) >= 15 else 'lstm'
+    alignment_beam_width = int(sys.argv[18]) if len(sys.argv) >= 19 else 0
+    alignment_beam_threshold = float(sys.argv[19]) if len(sys.argv) >= 20 else None
+    alignment_band = int(sys.argv[20]) if len(sys.argv) >= 21 else 0
+    alignment_cache_size = int(sys.argv[21]) if len(sys.argv) >= 22 else 0
+    alignment_max_age = int(sys.argv[22]) if len(sys.argv) >= 23 else 50
+    core_plan = None
+    if len(sys.argv) >= 13:
+        # Cores for the largest pool
+        core_plan = get_core_plan(amount_of_aligners=max(int(sys.argv[2]), max_aligners),
+                                  trainer_cores=int(sys.argv[12]))
+        print 'Core layout:\n' + describe_core_plan(core_plan)
+    if validation_interval > 0:
+        v_i, _, v_t, _ = load_rimes_data('valid', parts=[1])
+        known = [k for k in range(len(v_t)) if all([letter in bm.lookup for letter in v_t[k]])][0:200]
+        validation_inputs = np.transpose(v_i[known], axes=[1, 0, 2])  # Time major
+        validation_targets = [[bm.lookup_letter(letter) for letter in v_t[k] if letter != ''] for k in known]
+        print 'Validation sequences: ' + str(len(known))
 
     model_save = dir + '/rimes/model_init'
     input_save = dir + '/rimes/inputs.npy'
@@ -96,7 +139,18 @@ def main():
                                          path_to_alignments=alignments_save, path_to_cons_manager=cons_man_save,
                                          amount_of_aligners=int(sys.argv[2]), device_to_run=str(sys.argv[1]),
                                          device_soft_placement=True, debug_devices=((sys.argv[3]).lower() == 'true'),
-                                         max_cores=int(sys.argv[4]))
+                                         max_cores=int(sys.argv[4]), path_to_metrics=path_to_metrics,
+                                         path_to_traces=path_to_traces, core_plan=core_plan,
+                                         max_aligners=max_aligners, alignment_cache_size=alignment_cache_size,
+                                         alignment_max_age=alignment_max_age, cell_backend=cell_backend,
+                                         training_window_blocks=training_window_blocks,
+                                         swap_memory=len(sys.argv) >= 18 and sys.argv[17].lower() == 'true',
+                                         alignment_beam_width=alignment_beam_width,
+                                         alignment_beam_threshold=alignment_beam_threshold,
+                                         alignment_band=alignment_band)
+    if path_to_traces is not None:
+        # Same sampling as the aligners
+        tracing.enable(path_to_traces, every_n=constants_manager.trace_every_n)
 
     with tf.device(constants_manager.device_to_run):  # Set device here
         model = Model(cons_manager=constants_manager)
@@ -119,12 +173,16 @@ def main():
 
         return targets_list
 
-    config = tf.ConfigProto(allow_soft_placement=constants_manager.device_soft_placement,
-                            log_device_placement=constants_manager.debug_devices,
-                            device_count={'CPU': constants_manager.max_cores},
-                            inter_op_parallelism_threads=constants_manager.max_cores,
-                            intra_op_parallelism_threads=constants_manager.max_cores)
-    config.gpu_options.allow_growth = True
+    if core_plan is not None:
+        pin_to_cores(core_plan['trainer'])
+        config = get_session_config(constants_manager, core_plan['trainer'])
+    else:
+        config = tf.ConfigProto(allow_soft_placement=constants_manager.device_soft_placement,
+                                log_device_placement=constants_manager.debug_devices,
+                                device_count={'CPU': constants_manager.max_cores},
+                                inter_op_parallelism_threads=constants_manager.max_cores,
+                                intra_op_parallelism_threads=constants_manager.max_cores)
+        config.gpu_options.allow_growth = True
 
     run_offline_alignments = sys.argv[5].lower() == 'true'
 
@@ -132,8 +190,8 @@ def main():
         sess.run(init)
 
         # Try loading in prev built model from param 6 if it exists
-        if len(sys.argv) >= 7 and os.path.isfile(sys.argv[6] + '.meta') is True:
-            model.load_model(sess, sys.argv[6])
+        if len(sys.argv) >= 7 and os.path.isfile(sys.argv[6] + '.index') is True:
+            model.load_model(sess, sys.argv[6], partial=len(sys.argv) >= 16 and sys.argv[15].lower() == 'true')
 
         # For benchmarking
         inputs = np.transpose(i, axes=[1, 0, 2])  # Time major
@@ -147,9 +205,16 @@ def main():
         data_manager = DataManager(constants_manager, full_inputs=inputs, full_targets=targets, model=model,
                                    session=sess, online_alignments=False, use_greedy=use_greedy)
 
+        # Validation reuses the graph and session of the training
+        validation_manager = InferenceManager(cons_manager=constants_manager)
+        validation_manager.build_from_model(model)
+
         if run_offline_alignments is True:
             if sys.argv[7].lower() == 'true':
                 data_manager.load_in_alignments()
+            elif sys.argv[7].lower() == 'bootstrap':
+                data_manager.bootstrap_alignments()
+                data_manager.run_new_alignments(background=True)
             else:
                 data_manager.run_new_alignments()
             print 'Time Needed for Alignments: ' + str(time.time() - init_time)
@@ -161,6 +226,7 @@ def main():
         t__1 = time.time()
 
         for i in range(4000):
+            data_manager.update_alignments()
             loss = model.apply_training_step(session=sess, batch_size=8, data_manager=data_manager)
             t_0 = time.time() - t__1
             t__1 = time.time()
@@ -170,14 +236,28 @@ def main():
                 myfile.write('\nLoss: ' + str(loss))
                 myfile.write('\nTime: ' + str(t_0))
 
-            # Switch to offline alignments after 1000 batches & run new alignmentsinput_block_size
+            # Switch to offline alignments after 1000 batches & realign in the background, sequences without a new
+            # alignment yet get aligned when sampled
             if i == 1000 and run_offline_alignments is False and use_greedy is False:
                 data_manager.set_online_alignment(False)
-                data_manager.run_new_alignments()
+                data_manager.run_new_alignments(background=True)
+
+            # Validate on the held-out subset
+            if validation_interval > 0 and i % validation_interval == 0:
+                validation_time = time.time()
+                cer = run_validation(sess, validation_manager, validation_inputs, validation_targets, batch_size=50)
+                print 'Validation CER: ' + str(cer) + ' / Time: ' + str(time.time() - validation_time)
+                with open(dir + '/rimes/rimes_2nd_full_run/outputs_rough_fine_' + init_time_str + '.txt', 'a') as myfile:
+                    myfile.write('\nValidation CER: ' + str(cer))
 
             # Save the model every 20 iterations
             if i % 20 == 0:
-                model.save_model_for_inference(session=sess, path_name=dir + '/checkpoint/2nd_full_run/rimes_2_rough_fine' + str(i))
+                model.save_model_for_inference(session=sess, path_name=dir + '/checkpoint/2nd_full_run/rimes_2_rough_fine' + str(i),
+                                               asynchronous=True)
+                if path_to_metrics is not None:
+                    metrics.export(path_to_metrics)
+                    print 'Timers:\n' + metrics.get_timer_summary()
+                tracing.export_summary()
 
         """
         # Display correlation
@@ -187,6 +267,11 @@ def main():
         plt.plot(x_data, y_data, 'go')
         plt.show()
         """
+        model.wait_for_checkpoints()
+        if path_to_metrics is not None:
+            metrics.export(path_to_metrics)
+            print 'Timers:\n' + metrics.get_timer_summary()
+        tracing.export_summary()
         print 'Total Time Needed: ' + str(time.time() - init_time)
 
 
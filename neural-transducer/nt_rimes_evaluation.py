@@ -0,0 +1,140 @@
+from neural_transducer import InferenceManager
+from neural_transducer_scoring import character_error_rate, remove_ids
+from nt_rimes_inference import load_rimes_data, get_correct_alphabet, get_constants_manager
+from neural_transducer_resources import get_available_cores, pin_to_cores, get_session_config
+from multiprocessing import Process, Queue
+from Queue import Empty
+import tensorflow as tf
+import numpy as np
+import sys
+import time
+
+# USAGE:
+# Param 1: Path & Prefix of the model to evaluate (e.g. ../model_800), or path to a frozen graph (e.g. ../model_800.pb)
+# Param 2: Amount of worker processes (e.g. 8)
+# Param 3: Cores per worker process (e.g. 2)
+# Param 4: Path of the per-line results file to write (e.g. ./rimes/evaluation_results.txt)
+# Param 5 (optional): Amount of sequences to evaluate, default is the full validation set
+# Param 6 (optional): Keep the long sequences padded to whole blocks (True/False, default False) when building the
+# alphabet, as nt_rimes.py does when training in windows (its Param 16). Only used for models without a saved alphabet
+
+# Shards the RIMES validation set over several processes, each with its own session pinned to its own cores.
+
+
+def run_shard(shard_index, indices, inputs, cons_manager, model_path, cores, queue_output):
+    """
+    Runs greedy inference over one shard of the evaluation set.
+    :param shard_index: Index of this shard.
+    :param indices: The sequence indices of this shard.
+    :param inputs: The full inputs, shape [max_time, amount, input_dimensions] (Time major)
+    :param cons_manager: The constants manager.
+    :param model_path: Checkpoint prefix or frozen graph (.pb) to load.
+    :param cores: List of CPU cores this process is pinned to.
+    :param queue_output: Receives (index, hypothesis) for every line and (shard_index, None) when done.
+    :return:
+    """
+    # Pin the process to its cores, so that the shards don't compete with each other
+    pin_to_cores(cores)
+    config = get_session_config(cons_manager, cores)
+
+    with tf.Session(config=config) as sess:
+        inference_manager = InferenceManager(cons_manager=cons_manager)
+        if model_path.endswith('.pb'):
+            inference_manager.build_frozen_inference(path=model_path, session=sess)
+        else:
+            inference_manager.build_greedy_inference(path=model_path, session=sess)
+
+        init_time = time.time()
+        for i in range(len(indices)):
+            index = indices[i]
+            inp = np.reshape(inputs[:, index, :], newshape=(-1, 1, cons_manager.input_dimensions))
+            hypothesis, _ = inference_manager.run_inference(session=sess, full_inputs=inp, clean_e=True)
+            queue_output.put((index, hypothesis))
+
+            if (i + 1) % 100 == 0:
+                print 'Shard ' + str(shard_index) + ': ' + str(i + 1) + '/' + str(len(indices)) + \
+                      ' / Time running: ' + str(int(time.time() - init_time))
+                sys.stdout.flush()
+
+    queue_output.put((shard_index, None))
+
+
+def main():
+    model_path = sys.argv[1]
+    amount_of_workers = int(sys.argv[2])
+    cores_per_worker = int(sys.argv[3])
+    path_to_results = sys.argv[4]
+
+    i, _, t, _ = load_rimes_data('valid')
+    if len(sys.argv) >= 6:
+        i = i[0:int(sys.argv[5])]
+        t = t[0:int(sys.argv[5])]
+
+    pad_to_blocks = 100 if len(sys.argv) >= 7 and sys.argv[6].lower() == 'true' else None
+    bm = get_correct_alphabet(pad_to_blocks=pad_to_blocks, model_path=model_path)
+    constants_manager = get_constants_manager(bm, input_dimensions=i.shape[2], device_to_run='CPU:0',
+                                              debug_devices=False, max_cores=cores_per_worker)
+
+    # Targets to ids, without the padding (the model emits it as well, it is removed from the hypotheses below)
+    inputs = np.transpose(i, axes=[1, 0, 2])  # Time major
+    pad_ids = [bm.lookup_letter('')] if '' in bm.lookup else []
+    targets = remove_ids([[bm.lookup_letter(letter) for letter in target_seq] for target_seq in t.tolist()], pad_ids)
+
+    # Interleaved shards, so that each shard gets a similar mix of lengths. Forked workers share the loaded data.
+    results_queue = Queue()
+    processes = []
+    available_cores = get_available_cores()
+    for shard_index in range(amount_of_workers):
+        indices = range(shard_index, len(targets), amount_of_workers)
+        cores = [available_cores[(shard_index * cores_per_worker + c) % len(available_cores)]
+                 for c in range(cores_per_worker)]
+        p = Process(target=run_shard, args=(shard_index, indices, inputs, constants_manager, model_path, cores,
+                                            results_queue))
+        p.daemon = True
+        processes.append(p)
+        p.start()
+
+    # Merge the per line results of all shards
+    init_time = time.time()
+    hypotheses = {}
+    finished_shards = 0
+    while finished_shards < amount_of_workers:
+        try:
+            (index, hypothesis) = results_queue.get(timeout=5)
+        except Empty:
+            if not any([p.is_alive() for p in processes]):
+                print 'All workers stopped, ' + str(amount_of_workers - finished_shards) + ' shard(s) incomplete'
+                break
+            continue
+        if hypothesis is None:
+            finished_shards += 1
+        else:
+            hypotheses[index] = remove_ids([hypothesis], pad_ids)[0]
+
+    for p in processes:
+        p.join()
+
+    def lookup(ids):
+        return ''.join([constants_manager.vocab_ids[x] for x in ids])
+
+    # Score all lines at once
+    indices = sorted(hypotheses.keys())
+    cer, errors = character_error_rate([hypotheses[index] for index in indices],
+                                       [targets[index] for index in indices])
+
+    with open(path_to_results, 'w') as results_file:
+        results_file.write('index\terrors\treference_length\treference\thypothesis\n')
+        for index, line_errors in zip(indices, errors):
+            results_file.write('{0}\t{1}\t{2}\t{3}\t{4}\n'.format(index, line_errors, len(targets[index]),
+                                                                 lookup(targets[index]), lookup(hypotheses[index])))
+
+    print 'Evaluated lines: ' + str(len(hypotheses)) + '/' + str(len(targets))
+    print 'CER: ' + str(cer)
+    print 'Character accuracy: ' + str(1.0 - cer)
+    print 'Line accuracy: ' + str(float((errors == 0).sum()) / max(len(hypotheses), 1))
+    print 'Time needed: ' + str(time.time() - init_time)
+    print 'Results written to ' + str(path_to_results)
+
+
+if __name__ == '__main__':
+    main()
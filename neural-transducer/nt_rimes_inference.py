@@ -1,38 +1,50 @@
 import os
 from neural_transducer import ConstantsManager, Model, DataManager, InferenceManager
+from neural_transducer_scoring import character_error_rate, remove_ids
 import tensorflow as tf
 import numpy as np
 import dataset_loader
+import cPickle
 import sys
 import time
 import datetime
-import matplotlib.pyplot as plt
 
 # USAGE:
 # Param 1: Device (e.g. CPU:0)
 # Param 2: Debug device (True/False)
 # Param 3: Max cores to use for TF (e.g. 5)
-# Param 4: Path & Prefix of initial model load (e.g. ../model_800)
-
-
-def get_correct_alphabet():
+# Param 4: Path & Prefix of initial model load (e.g. ../model_800), or path to a frozen graph (e.g. ../model_800.pb)
+# Param 5 (optional): Keep the long sequences padded to whole blocks (True/False, default False) when building the
+# alphabet, as nt_rimes.py does when training in windows (its Param 16). Only used for models without a saved alphabet
+
+
+def load_rimes_data(split, parts=range(1, 11), pad_to_blocks=None):
+    """
+    Loads all parts of a RIMES split, removing very long sequences (over 300 in length).
+    :param split: Name of the split, e.g. 'train' or 'valid'.
+    :param parts: Which of the files of the split to load (1 to 10).
+    :param pad_to_blocks: Block size (e.g. 100) to keep the long sequences instead and pad the inputs to whole blocks
+    (e.g. for training in windows, see ConstantsManager.training_window_blocks). None removes them.
+    :return: inputs [amount, 300 (or padded length), input_dims], input lengths, targets [amount, max_target_length],
+    target lengths
+    """
     dir = os.path.dirname(os.path.realpath(__file__))
     i = []
     i_l = []
     t = []
     t_l = []
 
-    # We remove very long sequences (over 300 in length)
-    for iteration in range(1, 11):  # TODO: 11
-        print '/rimes/training-data/train.00{0:02d}'.format(iteration)
+    # We remove very long sequences (over 300 in length), unless padding to blocks
+    for iteration in parts:
+        print '/rimes/training-data/' + split + '.00{0:02d}'.format(iteration)
         temp_i, temp_i_l, temp_t, temp_t_l = dataset_loader.load_from_file(
-            dir + '/rimes/training-data/train.00{0:02d}'.format(iteration),
+            dir + '/rimes/training-data/' + split + '.00{0:02d}'.format(iteration),
             max_length_input=502,
             max_length_target=18)
         # Remove all sequences above 300 length
 
         to_remove = np.argwhere(temp_i_l >= 300)
-        if len(to_remove) > 0:
+        if len(to_remove) > 0 and pad_to_blocks is None:
             to_remove = to_remove[0]
             print 'Removing: ' + str(to_remove)
             temp_i = np.delete(temp_i, to_remove, axis=0)
@@ -50,59 +62,84 @@ def get_correct_alphabet():
     t = np.concatenate(t, axis=0)
     t_l = np.concatenate(t_l, axis=0)
 
-    # Cut down to correct size
-    i = i[:, 0:300, :]
+    # Cut down to correct size, or pad to whole blocks
+    if pad_to_blocks is None:
+        i = i[:, 0:300, :]
+    else:
+        i = np.pad(i, ((0, 0), (0, -i.shape[1] % pad_to_blocks), (0, 0)), 'constant')
+
+    return i, i_l, t, t_l
+
+
+def get_alphabet_path(model_path):
+    """
+    :param model_path: Path & prefix of a checkpoint, or path to a frozen graph.
+    :return: Path of the alphabet saved next to it by the training run (see save_alphabet).
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(model_path)), 'alphabet.pkl')
+
+
+def save_alphabet(bm, model_path):
+    """
+    Saves the alphabet of the training run next to its checkpoints, so that the ids of the model can be mapped back to
+    letters with the same alphabet (see get_correct_alphabet). Call before the ConstantsManager extends bm.lookup.
+    :param bm: Batch manager holding the alphabet of the training split.
+    :param model_path: Path & prefix of the checkpoints of the training run.
+    """
+    alphabet_path = get_alphabet_path(model_path)
+    if not os.path.isdir(os.path.dirname(alphabet_path)):
+        os.makedirs(os.path.dirname(alphabet_path))
+    with open(alphabet_path, 'wb') as alphabet_file:
+        cPickle.dump(list(bm.lookup), alphabet_file)
+
+
+def get_correct_alphabet(train_data=None, pad_to_blocks=None, model_path=None):
+    """
+    :param train_data: The training split as returned by load_rimes_data, loaded if None.
+    :param pad_to_blocks: When loading the training split, see load_rimes_data. Has to match the training run, the long
+    sequences add letters.
+    :param model_path: Path & prefix of a checkpoint (or path to a frozen graph), the alphabet saved next to it by the
+    training run is used if there is one.
+    :return: Batch manager holding the alphabet of the training split.
+    """
+    if model_path is not None and os.path.isfile(get_alphabet_path(model_path)):
+        bm = dataset_loader.BatchManager([], [], [], [], pad='PAD')
+        with open(get_alphabet_path(model_path), 'rb') as alphabet_file:
+            bm.lookup = cPickle.load(alphabet_file)
+        print 'Alphabet loaded from: ' + get_alphabet_path(model_path)
+        return bm
+
+    if train_data is None:
+        train_data = load_rimes_data('train', pad_to_blocks=pad_to_blocks)
+    i, i_l, t, t_l = train_data
 
     # Vocab processing and shit
     bm = dataset_loader.BatchManager(i, i_l, t, t_l, pad='PAD')
     return bm
 
 
-def main():
-
+def get_constants_manager(bm, input_dimensions, device_to_run, debug_devices, max_cores):
     dir = os.path.dirname(os.path.realpath(__file__))
-    i = []
-    i_l = []
-    t = []
-    t_l = []
-
-    # We remove very long sequences (over 300 in length)
-    for iteration in range(1, 11):  # TODO: 11
-        print '/rimes/training-data/valid.00{0:02d}'.format(iteration)
-        temp_i, temp_i_l, temp_t, temp_t_l = dataset_loader.load_from_file(
-            dir + '/rimes/training-data/valid.00{0:02d}'.format(iteration),
-            max_length_input=502,
-            max_length_target=18)
-        # Remove all sequences above 300 length
+    model_save = dir + '/rimes/model_init'
+    input_save = dir + '/rimes/inputs.npy'
+    target_save = dir + '/rimes/targets.npy'
+    alignments_save = dir + '/rimes/alignments'
+    cons_man_save = dir + '/rimes/cons_manager'
 
-        to_remove = np.argwhere(temp_i_l >= 300)
-        if len(to_remove) > 0:
-            to_remove = to_remove[0]
-            print 'Removing: ' + str(to_remove)
-            temp_i = np.delete(temp_i, to_remove, axis=0)
-            temp_i_l = np.delete(temp_i_l, to_remove, axis=0)
-            temp_t = np.delete(temp_t, to_remove, axis=0)
-            temp_t_l = np.delete(temp_t_l, to_remove, axis=0)
+    # Note: set input_block_size correctly
+    # TODO: note input block size!
+    return ConstantsManager(input_dimensions=input_dimensions, input_embedding_size=input_dimensions,
+                            inputs_embedded=True, encoder_hidden_units=512, transducer_hidden_units=1024,
+                            vocab_ids=bm.lookup, input_block_size=100, beam_width=5, encoder_hidden_layers=3,
+                            transducer_max_width=8, path_to_model=model_save, path_to_inputs=input_save,
+                            path_to_targets=target_save, path_to_alignments=alignments_save,
+                            path_to_cons_manager=cons_man_save, amount_of_aligners=4, device_to_run=device_to_run,
+                            device_soft_placement=True, debug_devices=debug_devices, max_cores=max_cores)
 
-        i.append(temp_i)
-        i_l.append(temp_i_l)
-        t.append(temp_t)
-        t_l.append(temp_t_l)
-        """
-        print '\nShapes:'
-        print temp_i.shape
-        print temp_i_l.shape
-        print temp_t.shape
-        print temp_t_l.shape
-        """
 
-    i = np.concatenate(i, axis=0)
-    i_l = np.concatenate(i_l, axis=0)
-    t = np.concatenate(t, axis=0)
-    t_l = np.concatenate(t_l, axis=0)
+def main():
 
-    # Cut down to correct size
-    i = i[:, 0:300, :]
+    i, i_l, t, t_l = load_rimes_data('valid')
 
     # Get size:
     print 'Size of inputs: ' + str(sys.getsizeof(i))
@@ -113,28 +150,16 @@ def main():
     assert i.shape[0] == i_l.shape[0] == t.shape[0] == t_l.shape[0], 'Incorrect sequence amounts!'
 
     # Vocab processing and shit
-    bm = get_correct_alphabet()
+    pad_to_blocks = 100 if len(sys.argv) >= 6 and sys.argv[5].lower() == 'true' else None
+    bm = get_correct_alphabet(pad_to_blocks=pad_to_blocks, model_path=sys.argv[4])
     print 'Lookup: ' + str(bm.lookup)
 
-    model_save = dir + '/rimes/model_init'
-    input_save = dir + '/rimes/inputs.npy'
-    target_save = dir + '/rimes/targets.npy'
-    alignments_save = dir + '/rimes/alignments'
-    cons_man_save = dir + '/rimes/cons_manager'
-
-    # Note: set input_block_size correctly
-    # TODO: note input block size!
-    constants_manager = ConstantsManager(input_dimensions=i.shape[2], input_embedding_size=i.shape[2], inputs_embedded=True,
-                                         encoder_hidden_units=512, transducer_hidden_units=1024, vocab_ids=bm.lookup,
-                                         input_block_size=100, beam_width=5, encoder_hidden_layers=3, transducer_max_width=8,
-                                         path_to_model=model_save, path_to_inputs=input_save, path_to_targets=target_save,
-                                         path_to_alignments=alignments_save, path_to_cons_manager=cons_man_save,
-                                         amount_of_aligners=4, device_to_run=str(sys.argv[1]),
-                                         device_soft_placement=True, debug_devices=((sys.argv[2]).lower() == 'true'),
-                                         max_cores=int(sys.argv[3]))
+    constants_manager = get_constants_manager(bm, input_dimensions=i.shape[2], device_to_run=str(sys.argv[1]),
+                                              debug_devices=((sys.argv[2]).lower() == 'true'),
+                                              max_cores=int(sys.argv[3]))
 
     with tf.device(constants_manager.device_to_run):  # Set device here
-        model = Model(cons_manager=constants_manager)
+        model = Model(cons_manager=constants_manager, objective=None)  # Only the forward graph is needed
 
     init = tf.global_variables_initializer()
 
@@ -164,13 +189,19 @@ def main():
         # Load in inference
         inference_manager = InferenceManager(cons_manager=constants_manager)
 
-        # Rebuild graph
-        inference_manager.build_greedy_inference(path=sys.argv[4],
-                                                 session=sess)
+        # Rebuild graph, frozen graphs (see nt_export_inference.py) load a lot quicker
+        if sys.argv[4].endswith('.pb'):
+            inference_manager.build_frozen_inference(path=sys.argv[4], session=sess)
+        else:
+            inference_manager.build_greedy_inference(path=sys.argv[4],
+                                                     session=sess)
+
+        # The targets are padded with '' and so is the output of the model, the padding isn't scored
+        pad_ids = [bm.lookup_letter('')] if '' in bm.lookup else []
 
         # For data
         totalCharacters = 0
-        totalCorrectCharacters = 0
+        totalErrors = 0
 
         for i in range(7464):
             # Try out inference
@@ -181,25 +212,15 @@ def main():
             targReadable = map(lookup, targ)
             inferred = inference_manager.run_inference(session=sess, full_inputs=inp, clean_e=True)
 
-            targ = [x for x in targ if x != 3]
+            targ = remove_ids([targ], pad_ids)[0]
 
-            if len(inferred[0]) >= len(targ) > 0:
-
-                # Check statistics
-                localLen = len(targ)
-                localCorrect = 0
+            if len(targ) > 0:
 
+                # Check statistics (Levenshtein based)
+                _, localErrors = character_error_rate(remove_ids([inferred[0]], pad_ids), [targ])
                 totalCharacters += len(targ)
-                for i in range(len(targ)):
-                    if targ[i] == inferred[0][i]:
-                        totalCorrectCharacters += 1
-                        localCorrect += 1
-                totalCharacters += len([x for x in inferred[0][len(targ):-1] if x != 3])
-                localLen += len([x for x in inferred[0][len(targ):-1] if x != 3])
-
-                # TODO: Find out which label is pad [3]
-                # TODO: get true length
-                # TODO: compare how well inferred performed vs targ
+                totalErrors += localErrors[0]
+
                 # TODO: save data
 
                 print '\n'
@@ -208,8 +229,8 @@ def main():
                 print inferred[1]
                 print 'Ground truth: '
                 print targReadable
-                print 'Current total accuracy: ' + str(float(totalCorrectCharacters)/totalCharacters)
-                print 'Local accuracy: ' + str(float(localCorrect)/localLen)
+                print 'Current total CER: ' + str(float(totalErrors)/totalCharacters)
+                print 'Local CER: ' + str(float(localErrors[0])/len(targ))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,179 @@
+import os
+from neural_transducer import Model, DataManager
+from nt_rimes_inference import load_rimes_data, get_correct_alphabet, get_constants_manager, save_alphabet
+from neural_transducer_resources import get_available_cores, pin_to_cores, get_session_config
+from multiprocessing import Process
+import tensorflow as tf
+import numpy as np
+import socket
+import sys
+import time
+
+# USAGE:
+# Param 1: Amount of worker processes (e.g. 4)
+# Param 2: Cores per worker process (e.g. 4)
+# Param 3: Batch size per worker (e.g. 8), the gradients of all workers are averaged for each update
+# Param 4: Amount of updates (e.g. 4000)
+# Param 5: Path to the pre-computed alignments (e.g. ./rimes/alignments, written by nt_rimes.py or
+# neural_transducer_helpers.py for the same data)
+# Param 6 (optional): Path & Prefix of initial model load (e.g. ../model_800)
+# Param 7 (optional): Keep the long sequences padded to whole blocks (True/False, default False), as nt_rimes.py does
+# when training in windows (its Param 16). Has to match the run that wrote the alignments of Param 5
+
+# Data parallel training: every worker process holds a replica of the model and trains on its own shard of the data.
+# The variables live on a parameter server process, the gradients of all workers are averaged (SyncReplicasOptimizer)
+# before each update. All processes talk over local sockets and are pinned to their own cores.
+
+
+def get_free_ports(amount):
+    sockets = []
+    for _ in range(amount):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind(('localhost', 0))
+        sockets.append(s)
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+
+def run_parameter_server(cluster, cons_manager, cores):
+    pin_to_cores(cores)
+    server = tf.train.Server(cluster, job_name='ps', task_index=0, config=get_session_config(cons_manager, cores))
+    server.join()
+
+
+def run_worker(task_index, cluster, cons_manager, inputs, targets, batch_size, steps, cores, init_path, save_path):
+    """
+    Trains one replica of the model on a shard of the data.
+    :param task_index: Index of this worker, worker 0 is the chief (initializes, saves).
+    :param cluster: The cluster spec.
+    :param cons_manager: The constants manager.
+    :param inputs: Inputs of this shard, shape [max_time, amount, input_dimensions] (Time major)
+    :param targets: Targets of this shard (Batch major lists of ids)
+    :param batch_size: Batch size of this worker.
+    :param steps: Amount of updates (global steps).
+    :param cores: List of CPU cores this process is pinned to.
+    :param init_path: Checkpoint to start from, or None.
+    :param save_path: Path & prefix for the checkpoints of the chief.
+    :return:
+    """
+    pin_to_cores(cores)
+    is_chief = task_index == 0
+    amount_of_workers = cluster.num_tasks('worker')
+    config = get_session_config(cons_manager, cores)
+    server = tf.train.Server(cluster, job_name='worker', task_index=task_index, config=config)
+
+    # Variables go onto the parameter server, everything else stays on this worker
+    with tf.device(tf.train.replica_device_setter(worker_device='/job:worker/task:' + str(task_index),
+                                                  cluster=cluster)):
+        model = Model(cons_manager=cons_manager, sync_replicas=amount_of_workers)
+        init_op = tf.global_variables_initializer()
+
+    # All ops have to exist before the supervisor finalizes the graph
+    sync_optimizer = model.sync_optimizer
+    local_init_op = sync_optimizer.chief_init_op if is_chief else sync_optimizer.local_step_init_op
+    init_tokens_op = sync_optimizer.get_init_tokens_op()
+    chief_queue_runner = sync_optimizer.get_chief_queue_runner()
+    # The chief restores the model before it is marked ready, so the other workers never train on the initial values
+    init_fn = None
+    if is_chief and init_path is not None and os.path.isfile(init_path + '.index') is True:
+        init_fn = lambda session: model.train_saver.restore(session, init_path)
+        print 'Loading in model from: ' + str(init_path)
+    supervisor = tf.train.Supervisor(is_chief=is_chief, logdir=None, init_op=init_op, init_fn=init_fn,
+                                     local_init_op=local_init_op,
+                                     ready_for_local_init_op=sync_optimizer.ready_for_local_init_op,
+                                     global_step=model.global_step, recovery_wait_secs=1)
+    sess = supervisor.prepare_or_wait_for_session(server.target, config=config)
+
+    if is_chief:
+        sess.run(init_tokens_op)
+        supervisor.start_queue_runners(sess, [chief_queue_runner])
+
+    # The alignments were computed beforehand, the data manager only takes the ones of this shard
+    data_manager = DataManager(cons_manager, full_inputs=inputs, full_targets=targets, model=model, session=sess,
+                               online_alignments=False, save_data=False)
+    data_manager.load_in_alignments()
+
+    init_time = time.time()
+    step = sess.run(model.global_step)
+    last_saved_step = step
+    while step < steps:
+        loss = model.apply_training_step(session=sess, batch_size=batch_size, data_manager=data_manager)
+        step = sess.run(model.global_step)
+        print 'Worker ' + str(task_index) + ' / Step: ' + str(step) + ' / Loss: ' + str(loss) + \
+              ' / Time running: ' + str(int(time.time() - init_time))
+        sys.stdout.flush()
+
+        # Save the model every 20 updates
+        if is_chief and step - last_saved_step >= 20:
+            model.save_model_for_inference(session=sess, path_name=save_path + str(step))
+            last_saved_step = step
+
+    if is_chief:
+        model.save_model_for_inference(session=sess, path_name=save_path + str(step))
+    print 'Worker ' + str(task_index) + ' done.'
+    sys.stdout.flush()
+
+
+def main():
+    dir = os.path.dirname(os.path.realpath(__file__))
+    amount_of_workers = int(sys.argv[1])
+    cores_per_worker = int(sys.argv[2])
+    batch_size = int(sys.argv[3])
+    steps = int(sys.argv[4])
+    init_path = sys.argv[6] if len(sys.argv) >= 7 else None
+
+    pad_to_blocks = 100 if len(sys.argv) >= 8 and sys.argv[7].lower() == 'true' else None
+    train_data = load_rimes_data('train', pad_to_blocks=pad_to_blocks)
+    i, i_l, t, t_l = train_data
+    bm = get_correct_alphabet(train_data)
+    save_alphabet(bm, dir + '/checkpoint/parallel/rimes_parallel')
+    constants_manager = get_constants_manager(bm, input_dimensions=i.shape[2], device_to_run='CPU:0',
+                                              debug_devices=False, max_cores=cores_per_worker)
+    constants_manager.path_to_alignments = sys.argv[5]
+
+    inputs = np.transpose(i, axes=[1, 0, 2])  # Time major
+    targets = [[bm.lookup_letter(letter) for letter in target_seq] for target_seq in t.tolist()]
+
+    if not os.path.isdir(dir + '/checkpoint/parallel'):
+        os.makedirs(dir + '/checkpoint/parallel')
+
+    # No TF session may exist in this process before forking
+    ports = get_free_ports(amount_of_workers + 1)
+    cluster = tf.train.ClusterSpec({'ps': ['localhost:' + str(ports[0])],
+                                    'worker': ['localhost:' + str(port) for port in ports[1:]]})
+
+    # The parameter server shares the cores of the chief
+    processes = []
+    available_cores = get_available_cores()
+    p = Process(target=run_parameter_server, args=(cluster, constants_manager, available_cores[0:cores_per_worker]))
+    p.daemon = True
+    p.start()
+    parameter_server = p
+
+    for task_index in range(amount_of_workers):
+        cores = [available_cores[(task_index * cores_per_worker + c) % len(available_cores)]
+                 for c in range(cores_per_worker)]
+        # Interleaved shards
+        shard = range(task_index, len(targets), amount_of_workers)
+        p = Process(target=run_worker, args=(task_index, cluster, constants_manager, inputs[:, shard, :],
+                                             [targets[k] for k in shard], batch_size, steps, cores, init_path,
+                                             dir + '/checkpoint/parallel/rimes_parallel'))
+        p.daemon = True
+        processes.append(p)
+        p.start()
+
+    # Once the chief is done, all updates are done. Other workers might wait for gradients that never come.
+    init_time = time.time()
+    processes[0].join()
+    for p in processes[1:]:
+        p.join(timeout=10)
+        if p.is_alive():
+            p.terminate()
+    parameter_server.terminate()
+    print 'Total Time Needed: ' + str(time.time() - init_time)
+
+
+if __name__ == '__main__':
+    main()